@@ -0,0 +1,120 @@
+import html
+import io
+import re
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+from common_types import PlaceDataBronze
+
+# Bronze content is the markdown of every crawled page, each one preceded by its URL
+SECTION_PATTERN = re.compile(r"^(https?://\S+)\n", re.MULTILINE)
+
+
+def content_sections(content: str) -> List[str]:
+    parts = SECTION_PATTERN.split(content)
+    # split() keeps the URLs at the odd indexes, the text of each page follows its URL
+    sections = [parts[i + 1].strip() for i in range(1, len(parts), 2)]
+    return [section for section in sections if section] or [content.strip()]
+
+
+def page_html(title: str, section: str, image_paths: List[str]) -> str:
+    paragraphs = "\n".join(f"<p>{html.escape(paragraph.strip())}</p>"
+                           for paragraph in section.split("\n\n") if paragraph.strip())
+    # No width attribute: the crawler only keeps images without one
+    images = "\n".join(f'<img src="{path}" alt="{html.escape(title)}">' for path in image_paths)
+    return f"""<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>{html.escape(title)}</title></head>
+<body>
+<article>
+<h1>{html.escape(title)}</h1>
+{paragraphs}
+{images}
+</article>
+</body>
+</html>
+"""
+
+
+def make_image(width: int = 1600, height: int = 1000) -> bytes:
+    from PIL import Image
+
+    image = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+class FixtureSite:
+    """Local website with one set of pages per synthetic place, made from the bronze data.
+
+    Place `i` is served under `/places/{i}/{page}.html`, one page per crawled source of its bronze
+    data, with `images_per_place` JPEGs under `/images/`.
+    """
+
+    def __init__(self, places: List[PlaceDataBronze], images_per_place: int = 3,
+                 latency_ms: int = 0):
+        self.places = places
+        self.images_per_place = images_per_place
+        self.latency_ms = latency_ms
+        self.pages: Dict[str, bytes] = {}
+        self.image: Optional[bytes] = None
+        self.server: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def image_paths(self, index: int) -> List[str]:
+        return [f"/images/{index}-{k}.jpg" for k in range(self.images_per_place)]
+
+    def page_urls(self, index: int) -> List[str]:
+        return [f"{self.url}/places/{index}/{k}.html"
+                for k in range(len(content_sections(self.places[index].content)))]
+
+    def image_urls(self, index: int) -> List[str]:
+        return [f"{self.url}{path}" for path in self.image_paths(index)]
+
+    def start(self) -> "FixtureSite":
+        for index, place in enumerate(self.places):
+            for k, section in enumerate(content_sections(place.content)):
+                self.pages[f"/places/{index}/{k}.html"] = page_html(
+                    place.name, section, self.image_paths(index)).encode()
+        if self.images_per_place:
+            self.image = make_image()
+
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if site.latency_ms:
+                    time.sleep(site.latency_ms / 1000)
+                if self.path in site.pages:
+                    self.reply(site.pages[self.path], "text/html; charset=utf-8")
+                elif self.path.startswith("/images/") and site.image is not None:
+                    self.reply(site.image, "image/jpeg")
+                else:
+                    self.send_error(404)
+
+            def reply(self, body: bytes, content_type: str):
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
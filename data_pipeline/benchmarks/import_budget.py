@@ -0,0 +1,106 @@
+"""Import-time budget of the flow entry points.
+
+Fails when importing an entry point loads a heavy dependency it only needs while running a
+stage, data_pipeline/tests/test_import_budget.py asserts the same in the test suite. The
+import times are reported against their budgets, `--enforce-budgets` fails on them too.
+Every import runs in a fresh interpreter:
+
+    python data_pipeline/benchmarks/import_budget.py --top 10
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+from typing import Dict, List, Tuple
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_PIPELINE_DIR = os.path.dirname(BENCHMARKS_DIR)
+REPO_DIR = os.path.dirname(DATA_PIPELINE_DIR)
+FLOWS_DIR = os.path.join(DATA_PIPELINE_DIR, "flows")
+
+CRAWL = ["crawl4ai", "playwright"]
+SCRIPT = ["openai"]
+TTS = ["edge_tts", "mutagen"]
+AWS = ["boto3", "botocore", "prefect_aws"]
+DATABASE = ["supabase"]
+IMAGES = ["PIL"]
+
+# Entry point: (budget in seconds, top-level packages it must not load on import)
+BUDGETS: Dict[str, Tuple[float, List[str]]] = {
+    "data_pipeline.flows.main": (2.5, CRAWL + SCRIPT + TTS + AWS + DATABASE + IMAGES),
+    "s01_crawl_websites": (2.5, CRAWL + SCRIPT + TTS + AWS + DATABASE + IMAGES),
+    "s02_make_audio_script": (2.5, CRAWL + SCRIPT + TTS + AWS + DATABASE + IMAGES),
+    "s03_generate_audio_guides": (2.5, CRAWL + SCRIPT + TTS + AWS + DATABASE + IMAGES),
+    # Stage 4 always talks to S3
+    "s04_update_production_database": (4.0, CRAWL + SCRIPT + TTS + DATABASE + IMAGES),
+}
+
+MEASURE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "packages": sorted({{name.split(".")[0] for name in sys.modules}})}}))
+"""
+
+
+def environment() -> dict:
+    env = dict(os.environ)
+    # main is imported as a package module, the stages import each other by file name
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [FLOWS_DIR, REPO_DIR, env.get("PYTHONPATH")]))
+    return env
+
+
+def measure(module: str) -> dict:
+    result = subprocess.run([sys.executable, "-c", MEASURE.format(module=module)], cwd=REPO_DIR,
+                            env=environment(), capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Could not import {module}:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def slowest_imports(module: str, top: int) -> List[Tuple[int, str]]:
+    # -X importtime prints "import time: self [us] | cumulative | imported package" on stderr
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=REPO_DIR,
+                            env=environment(), capture_output=True, text=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[0].startswith("import time:") and parts[1].strip().isdigit():
+            imports.append((int(parts[1].strip()), parts[2].rstrip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the import time of the flow entry points.")
+    parser.add_argument("--repeat", type=int, default=3, help="Imports per entry point, the fastest counts")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiplies the budgets, for slower machines")
+    parser.add_argument("--top", type=int, default=0, help="Also print the N slowest imports of each entry point")
+    parser.add_argument("--enforce-budgets", action="store_true",
+                        help="Also fail when an entry point takes longer than its budget")
+    args = parser.parse_args()
+
+    failures = []
+    for module, (budget, forbidden) in BUDGETS.items():
+        results = [measure(module) for _ in range(args.repeat)]
+        seconds = min(result["seconds"] for result in results)
+        loaded = sorted(set(forbidden) & set(results[0]["packages"]))
+
+        status = "ok"
+        if loaded:
+            status = f"loads {', '.join(loaded)}"
+            failures.append(module)
+        elif seconds > budget * args.scale:
+            status = "over budget"
+            if args.enforce_budgets:
+                failures.append(module)
+        print(f"{module:<36} {seconds:6.2f}s / {budget * args.scale:.2f}s  {status}")
+
+        for cumulative_us, name in slowest_imports(module, args.top):
+            print(f"    {cumulative_us / 1e6:6.2f}s {name}")
+
+    if failures:
+        print(f"{len(failures)} entry points over their import budget: {', '.join(failures)}")
+        sys.exit(1)
@@ -0,0 +1,71 @@
+import os
+import socket
+
+from typing import Optional
+
+import boto3
+
+from setup_dynamodb_tables import create_audio_guides_table, create_places_table
+
+REGION_NAME = "us-east-1"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class LocalAWS:
+    """moto server standing in for S3 and DynamoDB, with the bucket and tables the flows write to.
+
+    The flows reach it through an AwsCredentials block whose client parameters point at
+    `endpoint_url`, so their code runs unchanged.
+    """
+
+    def __init__(self, bucket_name: str = "localgaid-benchmark",
+                 places_table_name: str = "localgaid-places",
+                 audio_guides_table_name: str = "localgaid-audio-guides"):
+        self.bucket_name = bucket_name
+        self.places_table_name = places_table_name
+        self.audio_guides_table_name = audio_guides_table_name
+        self.server = None
+        self.endpoint_url: Optional[str] = None
+
+    def start(self) -> "LocalAWS":
+        from moto.server import ThreadedMotoServer
+
+        # moto accepts any key, but boto3 refuses to sign without one
+        for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+            os.environ.setdefault(name, "benchmark")
+
+        port = free_port()
+        self.server = ThreadedMotoServer(ip_address="127.0.0.1", port=port, verbose=False)
+        self.server.start()
+        self.endpoint_url = f"http://127.0.0.1:{port}"
+
+        boto3.client("s3", endpoint_url=self.endpoint_url, region_name=REGION_NAME) \
+            .create_bucket(Bucket=self.bucket_name)
+        dynamodb = boto3.resource("dynamodb", endpoint_url=self.endpoint_url, region_name=REGION_NAME)
+        create_places_table(dynamodb, self.places_table_name)
+        create_audio_guides_table(dynamodb, self.audio_guides_table_name)
+        return self
+
+    def save_credentials_block(self, block_name: str):
+        from prefect_aws import AwsClientParameters, AwsCredentials
+
+        AwsCredentials(
+            aws_access_key_id=os.environ["AWS_ACCESS_KEY_ID"],
+            aws_secret_access_key=os.environ["AWS_SECRET_ACCESS_KEY"],
+            region_name=REGION_NAME,
+            aws_client_parameters=AwsClientParameters(endpoint_url=self.endpoint_url),
+        ).save(block_name, overwrite=True)
+
+    def object_count(self) -> int:
+        paginator = boto3.client("s3", endpoint_url=self.endpoint_url, region_name=REGION_NAME) \
+            .get_paginator("list_objects_v2")
+        return sum(page.get("KeyCount", 0) for page in paginator.paginate(Bucket=self.bucket_name))
+
+    def stop(self):
+        if self.server is not None:
+            self.server.stop()
@@ -0,0 +1,103 @@
+import itertools
+import json
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+
+from common_types import PlaceDataSilver
+
+
+class MockOpenAIServer:
+    """OpenAI-compatible chat completions endpoint replaying the scripts of the silver data.
+
+    Answers any `POST .../chat/completions`, the Azure deployment routes included, with the
+    script of the silver place whose crawled content is in the prompt, or the next one in turn.
+    `latency_ms` and `tokens_per_second` simulate the time the model takes.
+    """
+
+    def __init__(self, places: List[PlaceDataSilver], latency_ms: int = 0,
+                 tokens_per_second: Optional[float] = None):
+        self.places = places
+        self.latency_ms = latency_ms
+        self.tokens_per_second = tokens_per_second
+        self.requests = 0
+        self.turns = itertools.cycle(places)
+        self.lock = threading.Lock()
+        self.server: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def script_for(self, prompt: str) -> str:
+        for place in self.places:
+            if place.content[:200] in prompt:
+                return place.script
+        with self.lock:
+            return next(self.turns).script
+
+    def completion(self, body: dict) -> dict:
+        prompt = "\n".join(str(message.get("content", "")) for message in body.get("messages", []))
+        script = self.script_for(prompt)
+        # Close enough to count tokens for the simulated generation time
+        prompt_tokens = len(prompt) // 4
+        completion_tokens = len(script) // 4
+
+        delay = self.latency_ms / 1000
+        if self.tokens_per_second:
+            delay += completion_tokens / self.tokens_per_second
+        if delay:
+            time.sleep(delay)
+
+        with self.lock:
+            self.requests += 1
+            request_number = self.requests
+
+        return {
+            "id": f"chatcmpl-benchmark-{request_number}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model") or "benchmark",
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": script, "refusal": None},
+                "logprobs": None,
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    def start(self) -> "MockOpenAIServer":
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if not self.path.split("?", 1)[0].endswith("/chat/completions"):
+                    self.send_error(404)
+                    return
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                response = json.dumps(mock.completion(body), ensure_ascii=False).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
@@ -0,0 +1,308 @@
+"""Offline end-to-end benchmark of the stage flows.
+
+Every external service is replaced by a local stand-in: a fixture website made from the bronze
+data, an OpenAI-compatible server replaying the silver scripts, the fake TTS backend, and moto
+for S3 and DynamoDB. N synthetic places go through the stages, and the throughput, latency and
+memory of each stage are printed and saved, to compare a change with the previous run:
+
+    python data_pipeline/benchmarks/run_benchmark.py --places 20 --compare data_pipeline/benchmarks/results/latest.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from datetime import datetime, timezone
+from typing import Dict, List, Tuple
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_PIPELINE_DIR = os.path.dirname(BENCHMARKS_DIR)
+FLOWS_DIR = os.path.join(DATA_PIPELINE_DIR, "flows")
+# The flow modules import each other by file name
+sys.path[:0] = [FLOWS_DIR, BENCHMARKS_DIR]
+
+from pydantic_core import from_json  # noqa: E402
+
+from common_types import PlaceDataBronze, PlaceDataSilver  # noqa: E402
+from rate_limiter import DEFAULT_RATE_LIMITS  # noqa: E402
+
+STAGES = ["s01", "s02", "s03", "s04"]
+AWS_CREDENTIALS_BLOCK_NAME = "localgaid-benchmark-aws"
+DEFAULT_RESULTS_DIR = os.path.join(BENCHMARKS_DIR, "results")
+
+
+def load_run_data(folder_name: str, model):
+    folder = os.path.join(DATA_PIPELINE_DIR, "run_data", folder_name)
+    places = []
+    for run_id in sorted(os.listdir(folder)):
+        for file_name in sorted(os.listdir(os.path.join(folder, run_id))):
+            if file_name.endswith(".json"):
+                with open(os.path.join(folder, run_id, file_name), "r") as file:
+                    places.append(model.model_validate(from_json(file.read(), allow_partial=True)))
+    return places
+
+
+def synthetic_places(bronze_places: List[PlaceDataBronze], count: int) -> List[PlaceDataBronze]:
+    # The recorded places in turn, each copy with its own name so nothing is shared between them
+    places = []
+    for i in range(count):
+        place = bronze_places[i % len(bronze_places)]
+        places.append(place.model_copy(update={"name": f"{place.name} {i:03d}"}))
+    return places
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=DATA_PIPELINE_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def run_stage(stage, inputs: Dict[str, object]) -> Tuple[Dict[str, object], List[float], object]:
+    """Runs a PipelineStage for every place, `stage.concurrency` at a time.
+
+    Returns the outputs, the latency of every place and the TaskMetrics of the whole stage.
+    """
+    from instrumentation import TaskMeasurement
+
+    semaphore = asyncio.Semaphore(stage.concurrency)
+    latencies = []
+
+    async def run_one(place: str, value):
+        async with semaphore:
+            start = time.perf_counter()
+            result = await stage.call(place, value)
+            latencies.append(time.perf_counter() - start)
+            return place, result
+
+    measurement = TaskMeasurement(stage.name)
+    measurement.start()
+    status = "failed"
+    try:
+        results = await asyncio.gather(*(run_one(place, value) for place, value in inputs.items()))
+        status = "completed"
+    finally:
+        metrics = measurement.stop(status)
+    return dict(results), latencies, metrics
+
+
+def stage_row(name: str, places: int, latencies: List[float], metrics) -> dict:
+    from telemetry import percentile
+
+    return {
+        "stage": name,
+        "places": places,
+        "wall_s": metrics.wall_seconds,
+        "places_per_hour": places / metrics.wall_seconds * 3600 if metrics.wall_seconds else None,
+        "p50_s": percentile(latencies, 0.50),
+        "p95_s": percentile(latencies, 0.95),
+        "cpu_s": metrics.cpu_seconds,
+        "tracemalloc_peak_mb": metrics.tracemalloc_peak_bytes / 2 ** 20,
+        "peak_rss_mb": metrics.peak_rss_bytes / 2 ** 20,
+    }
+
+
+def compare_rows(rows: List[dict], previous_rows: List[dict]) -> List[dict]:
+    previous = {row["stage"]: row for row in previous_rows}
+
+    def change(current, before) -> str:
+        if not current or not before:
+            return "-"
+        return f"{current / before - 1:+.0%}"
+
+    for row in rows:
+        before = previous.get(row["stage"], {})
+        row["p50_change"] = change(row["p50_s"], before.get("p50_s"))
+        row["throughput_change"] = change(row["places_per_hour"], before.get("places_per_hour"))
+        row["rss_change"] = change(row["peak_rss_mb"], before.get("peak_rss_mb"))
+    return rows
+
+
+async def run_benchmark(args, work_dir: str) -> List[dict]:
+    # Imported once the environment points at the stand-ins
+    from fixture_site import FixtureSite
+    from handoff import PlaceDataHandle, write_checkpoint
+    from local_aws import LocalAWS
+    from mock_openai import MockOpenAIServer
+    from pipeline import PipelineStage
+    from s01_crawl_websites import crawl_flow
+    from s02_make_audio_script import make_audio_script_flow
+    from s03_generate_audio_guides import generate_audio_guides_flow
+    from s04_update_production_database import update_production_database_flow
+
+    places = synthetic_places(load_run_data("data_bronze", PlaceDataBronze), args.places)
+    site = FixtureSite(places, images_per_place=args.images_per_place,
+                       latency_ms=args.site_latency_ms).start()
+    llm = MockOpenAIServer(load_run_data("data_silver", PlaceDataSilver),
+                           latency_ms=args.llm_latency_ms,
+                           tokens_per_second=args.llm_tokens_per_second).start()
+    aws = LocalAWS().start()
+
+    os.environ.update({
+        "AOAI_ENDPOINT": llm.url,
+        "AOAI_API_VERSION": "2024-10-21",
+        "AOAI_MODEL": "benchmark",
+        "AZURE_OPENAI_API_KEY": "benchmark",
+        "LOCALGAID_TTS_BACKEND": "fake",
+    })
+    aws.save_credentials_block(AWS_CREDENTIALS_BLOCK_NAME)
+
+    bronze_dir = os.path.join(work_dir, "data_bronze")
+    silver_dir = os.path.join(work_dir, "data_silver")
+    gold_dir = os.path.join(work_dir, "data_gold")
+    prompt_path = os.path.join(DATA_PIPELINE_DIR, "prompts", args.prompt)
+
+    # Place configs pointing at the fixture site, or, without the crawl stage, its bronze data
+    inputs = {}
+    for index, place in enumerate(places):
+        key = f"benchmark_place{index:03d}"
+        if "s01" in args.stages:
+            config_file_path = os.path.join(work_dir, "place_configs", f"{key}.json")
+            os.makedirs(os.path.dirname(config_file_path), exist_ok=True)
+            with open(config_file_path, "w+") as file:
+                json.dump({"name": place.name, "urls": site.page_urls(index),
+                           "location": f"{place.latitude}, {place.longitude}"}, file, ensure_ascii=False)
+            inputs[key] = config_file_path
+        else:
+            place = place.model_copy(update={"images": site.image_urls(index)})
+            inputs[key] = PlaceDataHandle(
+                path=write_checkpoint(os.path.join(bronze_dir, "seed", f"{place.name}.json"), place), data=place)
+
+    async def crawl(place: str, config_file_path: str):
+        return await crawl_flow(config_file_path=config_file_path, output_dir=bronze_dir, force=True)
+
+    async def make_script(place: str, s01_output):
+        return await make_audio_script_flow(prompt_template_path=prompt_path,
+                                            place_data_path=s01_output.path,
+                                            output_dir=silver_dir,
+                                            force=True)
+
+    def generate_audio(place: str, s02_output):
+        return generate_audio_guides_flow(place_data_path=s02_output.path,
+                                          output_dir=os.path.join(gold_dir, place),
+                                          tts_backend_name="fake",
+                                          rendition_profiles=args.renditions,
+                                          image_widths=args.image_widths,
+                                          force=True)
+
+    def publish(place: str, s03_output):
+        return update_production_database_flow(place_data_path=s03_output.wait(),
+                                               bucket_name=aws.bucket_name,
+                                               parent_folder_name="audio-guides",
+                                               database_backend="dynamodb",
+                                               aws_credentials_block_name=AWS_CREDENTIALS_BLOCK_NAME,
+                                               places_table_name=aws.places_table_name,
+                                               audio_guides_table_name=aws.audio_guides_table_name,
+                                               force=True)
+
+    stages = {
+        "s01": PipelineStage("s01", crawl, args.concurrency),
+        "s02": PipelineStage("s02", make_script, args.concurrency),
+        "s03": PipelineStage("s03", generate_audio, args.concurrency),
+        "s04": PipelineStage("s04", publish, args.concurrency),
+    }
+
+    rows = []
+    try:
+        for name in args.stages:
+            print(f"Benchmarking {name} with {len(inputs)} places...")
+            inputs, latencies, metrics = await run_stage(stages[name], inputs)
+            rows.append(stage_row(name, len(latencies), latencies, metrics))
+        if "s04" in args.stages:
+            print(f"{aws.object_count()} objects in the local bucket, {llm.requests} completions served.")
+    finally:
+        aws.stop()
+        llm.stop()
+        site.stop()
+    return rows
+
+
+def stage_list(value: str) -> List[str]:
+    stages = [stage.strip() for stage in value.split(",") if stage.strip()]
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"Unknown stages {unknown}, available: {', '.join(STAGES)}")
+    # Each stage takes the output of the previous one
+    return sorted(stages, key=STAGES.index)
+
+
+def int_list(value: str) -> List[int]:
+    return [int(part) for part in value.split(",") if part.strip()]
+
+
+def name_list(value: str) -> List[str]:
+    return [part.strip() for part in value.split(",") if part.strip()]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the stage flows against local stand-ins.")
+    parser.add_argument("--places", type=int, default=10, help="Number of synthetic places")
+    parser.add_argument("--stages", type=stage_list, default=STAGES,
+                        help="Comma separated stages, without s01 the bronze data is seeded directly")
+    parser.add_argument("--concurrency", type=int, default=1, help="Places run at once in every stage")
+    parser.add_argument("--prompt", default="narration_2.jinja", help="Prompt template in data_pipeline/prompts")
+    parser.add_argument("--renditions", type=name_list, default=[],
+                        help="Audio rendition profiles, needs ffmpeg (default: none)")
+    parser.add_argument("--image-widths", type=int_list, default=None,
+                        help="Image variant widths, e.g. 320,640,1280 (default: no image processing)")
+    parser.add_argument("--images-per-place", type=int, default=3)
+    parser.add_argument("--site-latency-ms", type=int, default=0)
+    parser.add_argument("--llm-latency-ms", type=int, default=0)
+    parser.add_argument("--llm-tokens-per-second", type=float, default=None)
+    parser.add_argument("--rate-limits", default=json.dumps({name: None for name in DEFAULT_RATE_LIMITS}),
+                        help="LOCALGAID_RATE_LIMITS of the run (default: no limits)")
+    parser.add_argument("--compare", help="Results file of a previous run")
+    parser.add_argument("--output-dir", default=DEFAULT_RESULTS_DIR)
+    parser.add_argument("--work-dir", help="Where the stage outputs go (default: a temporary folder)")
+    parser.add_argument("--keep", action="store_true", help="Keep the stage outputs")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="localgaid-benchmark-")
+    # Blocks and flow runs go to a throwaway Prefect home, not the profile of the user
+    os.environ["PREFECT_HOME"] = os.path.join(work_dir, "prefect")
+    # An empty task cache per run, a cache hit would measure the lookup instead of the stage
+    os.makedirs(work_dir, exist_ok=True)
+    os.environ["LOCALGAID_TASK_CACHE_DIR"] = tempfile.mkdtemp(prefix="task-cache-", dir=work_dir)
+    # Nor do the stand-ins share the API quotas of real runs, and they are not throttled unless asked
+    os.environ["LOCALGAID_RATE_LIMIT_DB"] = os.path.join(work_dir, "rate_limits.sqlite")
+    os.environ["LOCALGAID_RATE_LIMITS"] = args.rate_limits
+    os.environ.setdefault("PREFECT_LOGGING_LEVEL", "WARNING")
+
+    from telemetry import print_table
+
+    started_at = datetime.now(timezone.utc)
+    try:
+        rows = asyncio.run(run_benchmark(args, work_dir))
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = {
+        "commit": git_commit(),
+        "started_at": started_at.isoformat(),
+        "arguments": {name: value for name, value in vars(args).items()
+                      if name not in ("compare", "output_dir", "work_dir", "keep")},
+        "stages": rows,
+    }
+
+    if args.compare:
+        with open(args.compare, "r") as file:
+            rows = compare_rows([dict(row) for row in rows], json.load(file)["stages"])
+    print_table(rows)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    results_file_path = os.path.join(args.output_dir, f"benchmark_{started_at.strftime('%Y%m%d_%H%M%S')}.json")
+    for path in (results_file_path, os.path.join(args.output_dir, "latest.json")):
+        with open(path, "w+") as file:
+            json.dump(results, file, indent=2)
+    print(f"Saved the results to {results_file_path}")
@@ -0,0 +1,150 @@
+import os
+import shutil
+import subprocess
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+from pydantic import BaseModel
+
+from common_types import AudioRendition
+
+# EBU R128 based target for speech listened to on phone speakers and earbuds
+LOUDNESS_FILTER = "loudnorm=I=-16:TP=-1.5:LRA=11"
+
+
+class RenditionProfile(BaseModel):
+    name: str
+    codec: str
+    extension: str
+    bitrate_kbps: int
+    sample_rate: int
+    extra_args: List[str] = []
+
+
+RENDITION_PROFILES = {
+    "opus-24k": RenditionProfile(
+        name="opus-24k",
+        codec="libopus",
+        extension="opus",
+        bitrate_kbps=24,
+        sample_rate=24000,
+        extra_args=["-application", "voip"],
+    ),
+    "aac-32k": RenditionProfile(
+        name="aac-32k",
+        codec="aac",
+        extension="m4a",
+        bitrate_kbps=32,
+        sample_rate=24000,
+        extra_args=["-movflags", "+faststart"],
+    ),
+}
+
+DEFAULT_RENDITION_PROFILES = ["opus-24k"]
+
+HLS_PLAYLIST_NAME = "playlist.m3u8"
+
+
+def ffmpeg_path() -> str:
+    path = shutil.which("ffmpeg")
+    if path is None:
+        raise RuntimeError(
+            "ffmpeg is required for the audio renditions and HLS segments but was not found on PATH, "
+            "install it or pass rendition_profiles=[] and no hls_segment_seconds to skip them")
+    return path
+
+
+def run_ffmpeg(args: List[str]):
+    subprocess.run([ffmpeg_path(), "-hide_banner", "-loglevel", "error", "-y", *args],
+                   check=True, capture_output=True)
+
+
+def rendition_file_path(audio_file_path: str, profile: RenditionProfile) -> str:
+    base_path = audio_file_path.rsplit(".", 1)[0]
+    return f"{base_path}.{profile.name}.{profile.extension}"
+
+
+def transcode_rendition(audio_file_path: str, profile_name: str) -> AudioRendition:
+    profile = RENDITION_PROFILES[profile_name]
+    output_file_path = rendition_file_path(audio_file_path, profile)
+
+    run_ffmpeg([
+        "-i", audio_file_path,
+        "-af", LOUDNESS_FILTER,
+        "-ac", "1",
+        "-ar", str(profile.sample_rate),
+        "-c:a", profile.codec,
+        "-b:a", f"{profile.bitrate_kbps}k",
+        *profile.extra_args,
+        output_file_path,
+    ])
+
+    return AudioRendition(
+        profile=profile.name,
+        codec=profile.codec,
+        bitrate_kbps=profile.bitrate_kbps,
+        audio_url=output_file_path,
+        size_bytes=os.path.getsize(output_file_path),
+    )
+
+
+def transcode_renditions(audio_file_paths: List[str], profile_names: List[str],
+                         max_workers: Optional[int] = None) -> Dict[str, List[AudioRendition]]:
+    for profile_name in profile_names:
+        if profile_name not in RENDITION_PROFILES:
+            raise ValueError(
+                f"Unknown rendition profile '{profile_name}', available: {', '.join(RENDITION_PROFILES)}")
+
+    renditions = {path: [] for path in audio_file_paths}
+
+    # ffmpeg is CPU bound, one process per core keeps every core busy
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(transcode_rendition, path, profile_name): path
+            for path in audio_file_paths
+            for profile_name in profile_names
+        }
+        for future, path in futures.items():
+            renditions[path].append(future.result())
+
+    return renditions
+
+
+def hls_output_dir(audio_file_path: str) -> str:
+    return f"{audio_file_path.rsplit('.', 1)[0]}_hls"
+
+
+def segment_hls(audio_file_path: str, segment_seconds: int) -> str:
+    output_dir = hls_output_dir(audio_file_path)
+    os.makedirs(output_dir, exist_ok=True)
+    playlist_path = os.path.join(output_dir, HLS_PLAYLIST_NAME)
+
+    # The MP3 frames are copied as-is into MPEG-TS segments, no re-encoding
+    run_ffmpeg([
+        "-i", audio_file_path,
+        "-c:a", "copy",
+        "-f", "hls",
+        "-hls_time", str(segment_seconds),
+        "-hls_playlist_type", "vod",
+        "-hls_segment_filename", os.path.join(output_dir, "segment_%03d.ts"),
+        playlist_path,
+    ])
+
+    return playlist_path
+
+
+def segment_hls_playlists(audio_file_paths: List[str], segment_seconds: int,
+                          max_workers: Optional[int] = None) -> Dict[str, str]:
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            path: executor.submit(segment_hls, path, segment_seconds)
+            for path in audio_file_paths
+        }
+        return {path: future.result() for path, future in futures.items()}
+
+
+def read_hls_segment_paths(playlist_path: str) -> List[str]:
+    playlist_dir = os.path.dirname(playlist_path)
+    with open(playlist_path, "r") as file:
+        lines = [line.strip() for line in file.readlines()]
+    return [os.path.join(playlist_dir, line) for line in lines if line and not line.startswith("#")]
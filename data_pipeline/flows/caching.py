@@ -0,0 +1,64 @@
+import functools
+import os
+
+from datetime import timedelta
+from typing import Iterable, Optional
+
+from pydantic_core import to_jsonable_python
+
+from prefect.cache_policies import NO_CACHE, TASK_SOURCE, CacheKeyFnPolicy
+
+from fingerprints import fingerprint
+from storage import file_sha256
+
+CACHE_DIR_ENV_VAR = "LOCALGAID_TASK_CACHE_DIR"
+
+# How long a cached task result is reused, by task type
+LOCAL_COMPUTE_EXPIRATION = timedelta(days=30)  # reads and pure transformations of their inputs
+CRAWL_EXPIRATION = timedelta(days=1)  # the pages change
+LLM_EXPIRATION = timedelta(days=7)
+TTS_EXPIRATION = timedelta(days=7)
+# Tasks writing into the folder of a run only hit on a retry of that run, their files are still there
+RUN_FILES_EXPIRATION = timedelta(days=1)
+
+
+def task_cache_dir() -> str:
+    return os.environ.get(CACHE_DIR_ENV_VAR) or os.path.join(os.path.expanduser("~"), ".localgaid", "task-cache")
+
+
+def parameter_value(name: str, value):
+    # A path stands for the contents of its file, a file rewritten in place is a new input
+    if name.endswith("_path") and isinstance(value, str) and os.path.isfile(value):
+        return {"sha256": file_sha256(value)}
+    if name.endswith("_paths") and isinstance(value, list) and \
+            all(isinstance(path, str) and os.path.isfile(path) for path in value):
+        return [{"sha256": file_sha256(path)} for path in value]
+    return to_jsonable_python(value, fallback=repr)
+
+
+def input_hash_key(context, parameters: dict, exclude: Iterable[str] = (),
+                   uncached_when: Iterable[str] = ()) -> Optional[str]:
+    if any(parameters.get(name) is not None for name in uncached_when):
+        return None
+    return fingerprint({name: parameter_value(name, value)
+                        for name, value in parameters.items() if name not in exclude})
+
+
+def cached(expiration: timedelta, exclude: Iterable[str] = (), uncached_when: Iterable[str] = ()) -> dict:
+    """`@task` options caching the result across runs under a hash of the inputs and the task source.
+
+    `exclude` leaves parameters out of the key. A call with any `uncached_when` parameter set
+    is neither looked up nor cached, e.g. a callback with side effects that a hit would skip.
+    """
+    key_fn = functools.partial(input_hash_key, exclude=tuple(exclude), uncached_when=tuple(uncached_when))
+    # Prefect only takes a saved block as `result_storage`, the cache records go to the key storage
+    # of the policy instead and the results they point at to the default result storage
+    return dict(
+        cache_policy=(CacheKeyFnPolicy(cache_key_fn=key_fn) + TASK_SOURCE).configure(key_storage=task_cache_dir()),
+        cache_expiration=expiration,
+        persist_result=True,
+    )
+
+
+# Tasks with side effects (files, uploads, database writes), or results that can't be pickled
+NOT_CACHED = dict(cache_policy=NO_CACHE, persist_result=False)
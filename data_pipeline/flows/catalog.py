@@ -0,0 +1,359 @@
+import gzip
+import hashlib
+import json
+import random
+import re
+import time
+import unicodedata
+
+from datetime import datetime, timezone
+from typing import Callable, List, Optional, Tuple
+
+from botocore.exceptions import ClientError
+
+from common_types import PlaceDataGold, AudioGuide, ImageAsset
+from geo import geo_attributes
+
+# Manifests are named after their content so they can be cached forever by the CDN,
+# only the small per-city pointer changes between publishes
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+POINTER_CACHE_CONTROL = "public, max-age=60"
+
+MANIFEST_FORMAT_VERSION = 1
+POINTER_FILE_NAME = "latest.json"
+
+# Every this many catalog versions the full city manifest is kept as a snapshot, and the deltas
+# older than DELTA_WINDOW versions are deleted: clients further behind download the city manifest
+SNAPSHOT_INTERVAL = 20
+DELTA_WINDOW = 100
+
+# Publishes of the same city racing for latest.json, the loser reads it again and retries
+PUBLISH_ATTEMPTS = 5
+PRECONDITION_FAILED_CODES = ("PreconditionFailed", "ConditionalRequestConflict")
+
+
+def slugify(text: str) -> str:
+    text = text.replace("Đ", "D").replace("đ", "d")
+    text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode()
+    return re.sub(r"[^a-z0-9]+", "-", text.lower()).strip("-")
+
+
+def asset_url(key: Optional[str], asset_base_url: Optional[str]) -> Optional[str]:
+    if key is None or asset_base_url is None:
+        return key
+    return f"{asset_base_url.rstrip('/')}/{key}"
+
+
+def audio_guide_manifest(ag: AudioGuide, asset_base_url: Optional[str] = None) -> dict:
+    return {
+        "title": ag.title,
+        "duration_seconds": ag.duration_seconds,
+        "audio_url": asset_url(ag.audio_url, asset_base_url),
+        "subtitle_url": asset_url(ag.subtitle_url, asset_base_url),
+        "vtt_url": asset_url(ag.vtt_url, asset_base_url),
+        "word_index_url": asset_url(ag.word_index_url, asset_base_url),
+        "hls_playlist_url": asset_url(ag.hls_playlist_url, asset_base_url),
+        "renditions": [
+            {
+                "profile": rendition.profile,
+                "codec": rendition.codec,
+                "bitrate_kbps": rendition.bitrate_kbps,
+                "size_bytes": rendition.size_bytes,
+                "audio_url": asset_url(rendition.audio_url, asset_base_url),
+            }
+            for rendition in ag.renditions
+        ],
+    }
+
+
+def image_asset_manifest(asset: ImageAsset, asset_base_url: Optional[str] = None) -> dict:
+    return {
+        "width": asset.width,
+        "height": asset.height,
+        "variants": [
+            {
+                "width": variant.width,
+                "height": variant.height,
+                "format": variant.format,
+                "size_bytes": variant.size_bytes,
+                "image_url": asset_url(variant.image_url, asset_base_url),
+            }
+            for variant in asset.variants
+        ],
+    }
+
+
+def place_manifest(place_data: PlaceDataGold, asset_base_url: Optional[str] = None) -> dict:
+    return {
+        "slug": slugify(place_data.name),
+        "name": place_data.name,
+        "latitude": place_data.latitude,
+        "longitude": place_data.longitude,
+        **geo_attributes(place_data.latitude, place_data.longitude),
+        "images": [asset_url(image, asset_base_url) if not image.startswith("http") else image
+                   for image in place_data.images],
+        "image_assets": [image_asset_manifest(asset, asset_base_url) for asset in place_data.image_assets],
+        "audio_guides": [audio_guide_manifest(ag, asset_base_url) for ag in place_data.audio_guides],
+    }
+
+
+def manifest_hash(data: dict) -> str:
+    return content_hash(json.dumps(data, ensure_ascii=False, sort_keys=True).encode())
+
+
+def diff_audio_guides(previous: List[dict], current: List[dict]) -> dict:
+    previous_guides = {ag["title"]: ag for ag in previous}
+    current_guides = {ag["title"]: ag for ag in current}
+    return {
+        "added": [ag for title, ag in current_guides.items() if title not in previous_guides],
+        "changed": [ag for title, ag in current_guides.items()
+                    if title in previous_guides and manifest_hash(previous_guides[title]) != manifest_hash(ag)],
+        "removed": [title for title in previous_guides if title not in current_guides],
+    }
+
+
+def diff_city_places(previous: dict, current: dict) -> dict:
+    """Places added, changed and removed between two {slug: place} city states."""
+    changed = []
+    for slug, place in current.items():
+        if slug not in previous or manifest_hash(previous[slug]) == manifest_hash(place):
+            continue
+        place_metadata = {k: v for k, v in place.items() if k != "audio_guides"}
+        changed.append({**place_metadata,
+                        "audio_guides": diff_audio_guides(previous[slug]["audio_guides"], place["audio_guides"])})
+    return {
+        "added": [place for slug, place in current.items() if slug not in previous],
+        "changed": changed,
+        "removed": [slug for slug in previous if slug not in current],
+    }
+
+
+def compress_json(data: dict) -> bytes:
+    body = json.dumps(data, ensure_ascii=False, sort_keys=True,
+                      separators=(",", ":")).encode()
+    # mtime=0 keeps the bytes, and so the content hash, stable across publishes
+    return gzip.compress(body, compresslevel=9, mtime=0)
+
+
+def content_hash(body: bytes) -> str:
+    return hashlib.sha256(body).hexdigest()[:16]
+
+
+def is_precondition_failed(error: ClientError) -> bool:
+    return error.response["Error"]["Code"] in PRECONDITION_FAILED_CODES
+
+
+class CatalogPublisher:
+    """Publishes gzip-compressed, content-addressed catalog manifests to S3.
+
+    Layout under `{folder_name}/{city}/`:
+        places/{slug}.{hash}.json.gz        one place with its audio guides
+        city.{hash}.json.gz                 every place of the city
+        deltas/{version}.{hash}.json.gz     changes from `version - 1` to `version`
+        snapshots/{version}.{hash}.json.gz  the city manifest kept every SNAPSHOT_INTERVAL versions
+        latest.json                         current version and manifests, short cache
+
+    Each publish that changes something increments `catalog_version`. A client at version `v`
+    reads latest.json and, when `v >= min_delta_version`, applies the deltas `v + 1` to
+    `catalog_version` in order, named in its `deltas` under `deltas_url`; otherwise it downloads
+    the city manifest again. Deltas are content-addressed and only become part of the catalog
+    when latest.json names them, so a publish that crashes or loses the race leaves nothing a
+    later publish has to get past. At each snapshot
+    the deltas older than `delta_window` versions are deleted and `min_delta_version` moves up.
+    """
+
+    def __init__(self, s3_client, bucket_name: str, folder_name: str = "catalog",
+                 snapshot_interval: int = SNAPSHOT_INTERVAL, delta_window: int = DELTA_WINDOW,
+                 max_attempts: int = PUBLISH_ATTEMPTS):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.folder_name = folder_name
+        self.snapshot_interval = snapshot_interval
+        self.delta_window = delta_window
+        self.max_attempts = max_attempts
+
+    def city_folder(self, city: str) -> str:
+        return f"{self.folder_name}/{slugify(city)}"
+
+    def put_immutable(self, key: str, body: bytes):
+        try:
+            self.s3_client.head_object(Bucket=self.bucket_name, Key=key)
+            return
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("404", "NoSuchKey", "NotFound"):
+                raise
+        self.s3_client.put_object(Bucket=self.bucket_name, Key=key, Body=body,
+                                  ContentType="application/json",
+                                  ContentEncoding="gzip",
+                                  CacheControl=IMMUTABLE_CACHE_CONTROL)
+
+    def put_compressed_manifest(self, folder: str, name: str, data: dict) -> str:
+        body = compress_json(data)
+        key = f"{folder}/{name}.{content_hash(body)}.json.gz"
+        self.put_immutable(key, body)
+        return key
+
+    def get_object(self, key: str) -> Tuple[Optional[bytes], Optional[str]]:
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return None, None
+            raise
+        body = response["Body"].read()
+        if body[:2] == b"\x1f\x8b":
+            body = gzip.decompress(body)
+        return body, response["ETag"]
+
+    def prune_deltas(self, folder: str, up_to_version: int):
+        """Deletes the deltas of versions up to `up_to_version`, and those of publishes that never committed."""
+        keys = []
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=f"{folder}/deltas/"):
+            for item in page.get("Contents", []):
+                version = item["Key"].rsplit("/", 1)[-1].split(".", 1)[0]
+                if version.isdigit() and int(version) <= up_to_version:
+                    keys.append({"Key": item["Key"]})
+        for i in range(0, len(keys), 1000):
+            self.s3_client.delete_objects(Bucket=self.bucket_name,
+                                          Delete={"Objects": keys[i:i + 1000], "Quiet": True})
+
+    def retry_on_conflict(self, city: str, publish: Callable[[], Optional[dict]]) -> Optional[dict]:
+        for attempt in range(self.max_attempts):
+            try:
+                return publish()
+            except ClientError as e:
+                if not is_precondition_failed(e) or attempt == self.max_attempts - 1:
+                    raise
+                print(
+                    f"Catalog of '{city}' was published concurrently, reading it again ({attempt + 1}/{self.max_attempts}).")
+                time.sleep(min(0.2 * 2 ** attempt, 5) * random.uniform(0.5, 1.5))
+
+    def read_json(self, key: str) -> Optional[dict]:
+        body, _ = self.get_object(key)
+        return json.loads(body) if body is not None else None
+
+    def read_pointer(self, city: str) -> Tuple[Optional[dict], Optional[str]]:
+        body, etag = self.get_object(f"{self.city_folder(city)}/{POINTER_FILE_NAME}")
+        return (json.loads(body), etag) if body is not None else (None, None)
+
+    def read_city_places(self, pointer: Optional[dict]) -> dict:
+        if pointer is None:
+            return {}
+        city_manifest = self.read_json(pointer["city_manifest"])
+        return {place["slug"]: place for place in city_manifest["places"]}
+
+    def write_pointer(self, city: str, pointer: dict, previous_etag: Optional[str]):
+        # Conditional write: a concurrent publish makes this one retry instead of losing a version
+        condition = {"IfMatch": previous_etag} if previous_etag else {
+            "IfNoneMatch": "*"}
+        self.s3_client.put_object(Bucket=self.bucket_name,
+                                  Key=f"{self.city_folder(city)}/{POINTER_FILE_NAME}",
+                                  Body=json.dumps(pointer, ensure_ascii=False).encode(),
+                                  ContentType="application/json",
+                                  CacheControl=POINTER_CACHE_CONTROL,
+                                  **condition)
+
+    def publish(self, city: str, places: List[PlaceDataGold],
+                removed_place_names: Optional[List[str]] = None,
+                asset_base_url: Optional[str] = None) -> dict:
+        return self.retry_on_conflict(city, lambda: self.try_publish(city, places, removed_place_names,
+                                                                     asset_base_url))
+
+    def try_publish(self, city: str, places: List[PlaceDataGold],
+                    removed_place_names: Optional[List[str]] = None,
+                    asset_base_url: Optional[str] = None) -> dict:
+        folder = self.city_folder(city)
+        pointer, pointer_etag = self.read_pointer(city)
+        previous_places = self.read_city_places(pointer)
+        city_places = dict(previous_places)
+
+        for place_data in places:
+            manifest = place_manifest(place_data, asset_base_url)
+            manifest_key = self.put_compressed_manifest(f"{folder}/places", manifest["slug"],
+                                                        manifest)
+            city_places[manifest["slug"]] = {**manifest,
+                                             "manifest_url": asset_url(manifest_key, asset_base_url)}
+        for name in removed_place_names or []:
+            city_places.pop(slugify(name), None)
+
+        delta = diff_city_places(previous_places, city_places)
+        if pointer is not None and not any(delta.values()):
+            print(f"Catalog of '{city}' is unchanged at version {pointer['catalog_version']}.")
+            return pointer
+
+        catalog_version = pointer["catalog_version"] + 1 if pointer else 1
+
+        city_manifest = {
+            "format_version": MANIFEST_FORMAT_VERSION,
+            "city": city,
+            "catalog_version": catalog_version,
+            "places": sorted(city_places.values(), key=lambda place: place["slug"]),
+        }
+        city_manifest_key = self.put_compressed_manifest(folder, "city", city_manifest)
+
+        delta_key = self.put_compressed_manifest(f"{folder}/deltas", f"{catalog_version:08d}", {
+            "format_version": MANIFEST_FORMAT_VERSION,
+            "city": city,
+            "from_version": catalog_version - 1,
+            "to_version": catalog_version,
+            "places": delta,
+        })
+
+        snapshot_version = pointer.get("snapshot_version", 0) if pointer else 0
+        snapshot_manifest = pointer.get("snapshot_manifest") if pointer else None
+        min_delta_version = pointer.get("min_delta_version", 0) if pointer else 0
+        if pointer and "deltas" not in pointer:
+            # Published before the deltas were listed in latest.json, clients behind it start over
+            min_delta_version = pointer["catalog_version"]
+        deltas = {version: name for version, name in (pointer or {}).get("deltas", {}).items()
+                  if int(version) > min_delta_version}
+        offline_pack = {k: v for k, v in (pointer or {}).items() if k.startswith("offline_pack")}
+        pruned_version = None
+        if catalog_version - snapshot_version >= self.snapshot_interval:
+            snapshot_version = catalog_version
+            snapshot_manifest = self.put_compressed_manifest(f"{folder}/snapshots",
+                                                             f"{catalog_version:08d}", city_manifest)
+            min_delta_version = max(min_delta_version, catalog_version - self.delta_window)
+            pruned_version = min_delta_version
+            deltas = {version: name for version, name in deltas.items() if int(version) > min_delta_version}
+        deltas[str(catalog_version)] = delta_key.rsplit("/", 1)[-1]
+
+        pointer = {
+            "format_version": MANIFEST_FORMAT_VERSION,
+            "city": city,
+            "catalog_version": catalog_version,
+            "city_manifest": city_manifest_key,
+            "city_manifest_url": asset_url(city_manifest_key, asset_base_url),
+            "deltas_url": asset_url(f"{folder}/deltas", asset_base_url),
+            "min_delta_version": min_delta_version,
+            "deltas": deltas,
+            "snapshot_version": snapshot_version,
+            "snapshot_manifest": snapshot_manifest,
+            "place_count": len(city_places),
+            "updated_at": str(datetime.now(timezone.utc)),
+            **offline_pack,
+        }
+        self.write_pointer(city, pointer, pointer_etag)
+
+        # Only once latest.json no longer offers them
+        if pruned_version:
+            self.prune_deltas(folder, pruned_version)
+        return pointer
+
+    def attach_offline_pack(self, city: str, index_key: str,
+                            asset_base_url: Optional[str] = None) -> Optional[dict]:
+        """Points latest.json at the offline pack index, without bumping the catalog version."""
+        return self.retry_on_conflict(city, lambda: self.try_attach_offline_pack(city, index_key, asset_base_url))
+
+    def try_attach_offline_pack(self, city: str, index_key: str,
+                                asset_base_url: Optional[str] = None) -> Optional[dict]:
+        pointer, pointer_etag = self.read_pointer(city)
+        if pointer is None:
+            print(f"No catalog published for '{city}' yet, the offline pack is not referenced.")
+            return None
+        pointer = {**pointer,
+                   "offline_pack_index": index_key,
+                   "offline_pack_index_url": asset_url(index_key, asset_base_url)}
+        self.write_pointer(city, pointer, pointer_etag)
+        return pointer
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, ConfigDict
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 # PAGE DATA
 
@@ -22,16 +22,44 @@ class PlaceDataSilver(PlaceDataBronze):
     script: str
 
 
+class AudioRendition(BaseModel):
+    profile: str
+    codec: str
+    bitrate_kbps: int
+    audio_url: str
+    size_bytes: int
+
+
 class AudioGuide(BaseModel):
     title: str
-    full_subtitle: str
+    full_subtitle: Optional[str] = None
     audio_url: str
     duration_seconds: int
     subtitle_url: str
+    renditions: List[AudioRendition] = []
+    hls_playlist_url: Optional[str] = None
+    vtt_url: Optional[str] = None
+    word_index_url: Optional[str] = None
+
+
+class ImageVariant(BaseModel):
+    width: int
+    height: int
+    format: str
+    image_url: str
+    size_bytes: int
+
+
+class ImageAsset(BaseModel):
+    source_url: str
+    width: int
+    height: int
+    variants: List[ImageVariant] = []
 
 
 class PlaceDataGold(PlaceDataSilver):
     audio_guides: List[AudioGuide]
+    image_assets: List[ImageAsset] = []
 
     # Pydantic config type
     model_config = ConfigDict(arbitrary_types_allowed=True)
@@ -46,21 +74,13 @@ class BaseRunResult(BaseModel):
     end_time: Optional[str]
 
 
-class CrawlRunResult(BaseRunResult):
-    input: str
-    config: str
-    output: Optional[str] = None
-    urls_crawled: Optional[int] = None
-    images_crawled: Optional[int] = None
-
-
-class ScriptRunResult(BaseRunResult):
-    input_prompt_path: str
-    input_prompt: str
-    input_place_data: str
-    output: Optional[str] = None
-
-
-class AudioRunResult(BaseRunResult):
-    input_place_data: str
+class StageRunResult(BaseRunResult):
+    # References to the input and output files instead of copies of them
+    flow_run_id: str
+    stage: str
+    place: Optional[str] = None
+    duration_seconds: Optional[float] = None
+    input: Optional[str] = None
     output: Optional[str] = None
+    output_size_bytes: Optional[int] = None
+    counts: Dict[str, float] = {}
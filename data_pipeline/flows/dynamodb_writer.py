@@ -0,0 +1,190 @@
+import random
+import time
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import Dict, List
+
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from botocore.exceptions import ClientError
+
+from common_types import PlaceDataGold
+from geo import geo_attributes
+
+# DynamoDB limits per request
+MAX_BATCH_WRITE_ITEMS = 25
+MAX_BATCH_GET_KEYS = 100
+
+# Stable IDs: publishing the same place twice updates the same item
+PLACE_ID_NAMESPACE = uuid.UUID("6f6a1c8e-5a4b-4c36-9a43-0c2f4f1f7d10")
+
+serializer = TypeSerializer()
+deserializer = TypeDeserializer()
+
+
+def place_id_for(name: str) -> str:
+    return str(uuid.uuid5(PLACE_ID_NAMESPACE, name))
+
+
+def to_dynamodb_value(value):
+    # DynamoDB numbers must be Decimal and attributes can't be None
+    if isinstance(value, float):
+        return Decimal(str(value))
+    if isinstance(value, dict):
+        return {k: to_dynamodb_value(v) for k, v in value.items() if v is not None}
+    if isinstance(value, list):
+        return [to_dynamodb_value(v) for v in value]
+    return value
+
+
+def to_item(data: dict) -> dict:
+    return {k: serializer.serialize(v) for k, v in to_dynamodb_value(data).items()}
+
+
+def chunks(items: list, size: int) -> List[list]:
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+class DynamoDBPlaceWriter:
+    """Publishes places and their audio guides to the tables made by setup_dynamodb_tables.py.
+
+    For each place, guides are written under a fresh `guides_version`, then the place item is
+    switched to them with a conditional write on the version it had before, then the guides it
+    pointed at are deleted. A concurrent publish of the same place fails the condition instead
+    of mixing guides, and its new guides are deleted.
+    """
+
+    def __init__(self, client, places_table_name: str = "localgaid-places",
+                 audio_guides_table_name: str = "localgaid-audio-guides",
+                 max_workers: int = 4, max_retries: int = 8):
+        self.client = client
+        self.places_table_name = places_table_name
+        self.audio_guides_table_name = audio_guides_table_name
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+
+    def backoff(self, attempt: int):
+        time.sleep(min(0.05 * 2 ** attempt, 5) * random.uniform(0.5, 1.5))
+
+    def write_batch(self, table_name: str, requests: List[dict]):
+        pending = {table_name: requests}
+        for attempt in range(self.max_retries + 1):
+            response = self.client.batch_write_item(RequestItems=pending)
+            pending = response.get("UnprocessedItems", {})
+            if not pending:
+                return
+            self.backoff(attempt)
+        raise RuntimeError(
+            f"{len(pending[table_name])} items still unprocessed for '{table_name}' after {self.max_retries} retries")
+
+    def batch_write(self, table_name: str, requests: List[dict]):
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.write_batch, table_name, batch)
+                       for batch in chunks(requests, MAX_BATCH_WRITE_ITEMS)]
+            for future in futures:
+                future.result()
+
+    def get_places(self, place_ids: List[str]) -> Dict[str, dict]:
+        places = {}
+        for batch in chunks(place_ids, MAX_BATCH_GET_KEYS):
+            pending = {self.places_table_name: {
+                "Keys": [{"id": {"S": place_id}} for place_id in batch],
+                "ProjectionExpression": "id, guides_version, audio_guide_ids",
+                # The guides to replace are the ones the place points at right now
+                "ConsistentRead": True,
+            }}
+            for attempt in range(self.max_retries + 1):
+                response = self.client.batch_get_item(RequestItems=pending)
+                for item in response["Responses"].get(self.places_table_name, []):
+                    place = {k: deserializer.deserialize(v)
+                             for k, v in item.items()}
+                    places[place["id"]] = place
+                pending = response.get("UnprocessedKeys", {})
+                if not pending:
+                    break
+                self.backoff(attempt)
+        return places
+
+    def delete_guides(self, guide_ids: List[str]):
+        self.batch_write(self.audio_guides_table_name,
+                         [{"DeleteRequest": {"Key": {"id": {"S": guide_id}}}} for guide_id in guide_ids])
+
+    def put_place(self, place_data: PlaceDataGold, place_id: str, guides_version: str,
+                  guide_ids: List[str], previous_guides_version: str = None):
+        item = to_item({
+            "id": place_id,
+            "name": place_data.name,
+            "tags": [],
+            "latitude": place_data.latitude,
+            "longitude": place_data.longitude,
+            "images": place_data.images,
+            "image_assets": [asset.model_dump() for asset in place_data.image_assets],
+            **geo_attributes(place_data.latitude, place_data.longitude),
+            "guides_version": guides_version,
+            "audio_guide_ids": guide_ids,
+            "updated_at": str(datetime.now(timezone.utc)),
+        })
+
+        if previous_guides_version is None:
+            condition = {"ConditionExpression": "attribute_not_exists(id)"}
+        else:
+            condition = {
+                "ConditionExpression": "guides_version = :previous",
+                "ExpressionAttributeValues": {":previous": {"S": previous_guides_version}},
+            }
+        self.client.put_item(TableName=self.places_table_name,
+                             Item=item, **condition)
+
+    def publish_place(self, place_data: PlaceDataGold, place_id: str, existing_place: dict, created_at: str):
+        guides_version = uuid.uuid4().hex
+        guide_ids = []
+        guide_requests = []
+        for number, ag in enumerate(place_data.audio_guides):
+            guide_id = str(uuid.uuid5(uuid.UUID(place_id), f"{guides_version}/{number}"))
+            guide_ids.append(guide_id)
+            guide_requests.append({"PutRequest": {"Item": to_item({
+                "id": guide_id,
+                "place_id": place_id,
+                "guides_version": guides_version,
+                "number": number + 1,
+                "created_at": created_at,
+                **ag.model_dump(),
+            })}})
+
+        # New guides first, they stay invisible until the place item points at their version
+        self.batch_write(self.audio_guides_table_name, guide_requests)
+        try:
+            self.put_place(place_data, place_id, guides_version, guide_ids,
+                           existing_place.get("guides_version"))
+        except Exception as e:
+            # The place still points at its old guides, the new ones would never be referenced
+            self.delete_guides(guide_ids)
+            if isinstance(e, ClientError) and e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                raise RuntimeError(
+                    f"'{place_data.name}' was published concurrently, its guides were not replaced") from e
+            raise
+
+        self.delete_guides([guide_id for guide_id in existing_place.get("audio_guide_ids", [])
+                            if guide_id not in guide_ids])
+
+    def upsert_places(self, places: List[PlaceDataGold]) -> Dict[str, str]:
+        place_ids = {place_data.name: place_id_for(place_data.name)
+                     for place_data in places}
+        existing_places = self.get_places(list(place_ids.values()))
+
+        created_at = str(datetime.now(timezone.utc))
+        # Every place is published on its own, a failed place leaves neither orphaned guides nor
+        # the old guides of the others behind
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {place_data.name: executor.submit(self.publish_place, place_data, place_ids[place_data.name],
+                                                        existing_places.get(place_ids[place_data.name], {}),
+                                                        created_at)
+                       for place_data in places}
+        failures = {name: future.exception() for name, future in futures.items() if future.exception()}
+        if failures:
+            raise RuntimeError(
+                f"{len(failures)} of {len(places)} places were not published: {', '.join(failures)}") \
+                from next(iter(failures.values()))
+        return place_ids
@@ -0,0 +1,79 @@
+import fcntl
+import hashlib
+import json
+import os
+import threading
+
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+FINGERPRINTS_FILE_NAME = ".fingerprints.json"
+
+_lock = threading.Lock()
+
+
+def fingerprint(*parts) -> str:
+    """Hash of the inputs that decide a stage output, the same inputs give the same fingerprint."""
+    body = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(body.encode()).hexdigest()
+
+
+class FingerprintIndex:
+    """`.fingerprints.json` in a stage output directory: the input fingerprint of the last
+    output of every place, so a stage whose inputs didn't change can reuse it, like make.
+
+    {stage: {place name: {"fingerprint", "output_path", "updated_at"}}}
+    """
+
+    def __init__(self, output_dir: str):
+        self.path = os.path.join(output_dir, FINGERPRINTS_FILE_NAME)
+
+    @contextmanager
+    def locked(self):
+        # Places of a batch are recorded from several threads, and possibly several workers
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with _lock, open(f"{self.path}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read(self) -> Dict[str, dict]:
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, "r") as file:
+            return json.load(file)
+
+    def lookup(self, stage: str, key: str, fingerprint: str) -> Optional[str]:
+        """Path of the output made from the same inputs, if it still exists."""
+        with self.locked():
+            entry = self.read().get(stage, {}).get(key)
+        if entry is None or entry["fingerprint"] != fingerprint or not os.path.exists(entry["output_path"]):
+            return None
+        return entry["output_path"]
+
+    def record(self, stage: str, key: str, fingerprint: str, output_path: str):
+        with self.locked():
+            index = self.read()
+            index.setdefault(stage, {})[key] = {
+                "fingerprint": fingerprint,
+                "output_path": output_path,
+                "updated_at": str(datetime.now(timezone.utc)),
+            }
+            with open(f"{self.path}.tmp", "w+") as file:
+                json.dump(index, file, ensure_ascii=False, indent=2)
+            os.replace(f"{self.path}.tmp", self.path)
+
+    def record_when_written(self, stage: str, key: str, fingerprint: str, handle):
+        """Records the output of a PlaceDataHandle once its checkpoint is on disk."""
+        if handle.checkpoint is None:
+            self.record(stage, key, fingerprint, handle.path)
+            return
+
+        def record_if_written(future):
+            if future.exception() is None:
+                self.record(stage, key, fingerprint, handle.path)
+
+        handle.checkpoint.add_done_callback(record_if_written)
@@ -0,0 +1,118 @@
+import math
+
+from typing import List, Set, Tuple
+
+from boto3.dynamodb.types import TypeDeserializer
+
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+# Full precision stored on each place (~5 m), and the coarser cell used as the index
+# partition (~39 x 20 km), so a city lives in a handful of partitions
+GEOHASH_PRECISION = 9
+GEOHASH_CELL_PRECISION = 4
+
+GEOHASH_INDEX_NAME = "geohash-index"
+
+EARTH_RADIUS_METERS = 6_371_000
+
+deserializer = TypeDeserializer()
+
+
+def encode_geohash(latitude: float, longitude: float, precision: int = GEOHASH_PRECISION) -> str:
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(geohash) < precision:
+        value_range, value = (lon_range, longitude) if even else (lat_range, latitude)
+        middle = (value_range[0] + value_range[1]) / 2
+        if value >= middle:
+            bits = bits * 2 + 1
+            value_range[0] = middle
+        else:
+            bits = bits * 2
+            value_range[1] = middle
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(GEOHASH_ALPHABET[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(geohash)
+
+
+def geohash_cell_size(precision: int) -> Tuple[float, float]:
+    # (height, width) of a cell in degrees
+    lon_bits = math.ceil(precision * 5 / 2)
+    lat_bits = math.floor(precision * 5 / 2)
+    return 180 / 2 ** lat_bits, 360 / 2 ** lon_bits
+
+
+def haversine_meters(latitude_1: float, longitude_1: float,
+                     latitude_2: float, longitude_2: float) -> float:
+    phi_1 = math.radians(latitude_1)
+    phi_2 = math.radians(latitude_2)
+    d_phi = math.radians(latitude_2 - latitude_1)
+    d_lambda = math.radians(longitude_2 - longitude_1)
+    a = math.sin(d_phi / 2) ** 2 + \
+        math.cos(phi_1) * math.cos(phi_2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * math.asin(math.sqrt(a))
+
+
+def covering_cells(latitude: float, longitude: float, radius_m: float,
+                   precision: int = GEOHASH_CELL_PRECISION) -> Set[str]:
+    """Geohash cells intersecting the bounding box of the circle."""
+    lat_delta = math.degrees(radius_m / EARTH_RADIUS_METERS)
+    lon_delta = lat_delta / max(math.cos(math.radians(latitude)), 1e-6)
+    min_lat, max_lat = max(latitude - lat_delta, -90.0), min(latitude + lat_delta, 90.0)
+    min_lon, max_lon = max(longitude - lon_delta, -180.0), min(longitude + lon_delta, 180.0)
+
+    cell_height, cell_width = geohash_cell_size(precision)
+    cells = set()
+    lat = min_lat
+    while True:
+        lon = min_lon
+        while True:
+            cells.add(encode_geohash(lat, lon, precision))
+            if lon >= max_lon:
+                break
+            lon = min(lon + cell_width, max_lon)
+        if lat >= max_lat:
+            break
+        lat = min(lat + cell_height, max_lat)
+    return cells
+
+
+def geo_attributes(latitude: float, longitude: float) -> dict:
+    geohash = encode_geohash(latitude, longitude)
+    return {
+        "geohash": geohash,
+        "geohash_cell": geohash[:GEOHASH_CELL_PRECISION],
+    }
+
+
+def find_places_nearby(client, latitude: float, longitude: float, radius_m: float,
+                       places_table_name: str = "localgaid-places", limit: int = None) -> List[dict]:
+    """Places within `radius_m` meters, nearest first, with their `distance_m`.
+
+    Queries the geohash GSI of the places table once per covering cell instead of scanning it.
+    """
+    places = []
+    paginator = client.get_paginator("query")
+    for cell in covering_cells(latitude, longitude, radius_m):
+        for page in paginator.paginate(TableName=places_table_name,
+                                       IndexName=GEOHASH_INDEX_NAME,
+                                       KeyConditionExpression="geohash_cell = :cell",
+                                       ExpressionAttributeValues={":cell": {"S": cell}}):
+            for item in page["Items"]:
+                place = {k: deserializer.deserialize(v) for k, v in item.items()}
+                distance_m = haversine_meters(latitude, longitude,
+                                              float(place["latitude"]), float(place["longitude"]))
+                if distance_m <= radius_m:
+                    place["distance_m"] = distance_m
+                    places.append(place)
+
+    places.sort(key=lambda place: place["distance_m"])
+    return places[:limit] if limit else places
@@ -0,0 +1,78 @@
+import atexit
+import os
+import weakref
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Generic, Optional, Type, TypeVar
+
+from pydantic import BaseModel
+from pydantic_core import from_json
+
+PlaceData = TypeVar("PlaceData", bound=BaseModel)
+
+# Checkpoints are written in the background, in order, while the next stage already runs
+_checkpoint_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint")
+atexit.register(_checkpoint_executor.shutdown, wait=True)
+
+# The handles alive in this process by checkpoint path. Only the path goes through the flow
+# parameters, which the API stores with the flow run, the next stage takes the data from here
+_handles: "weakref.WeakValueDictionary[str, PlaceDataHandle]" = weakref.WeakValueDictionary()
+
+
+def write_checkpoint(path: str, place_data: BaseModel) -> str:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", "w+") as file:
+        file.write(place_data.model_dump_json(indent=2))
+    # A reader never sees a half-written checkpoint
+    os.replace(f"{path}.tmp", path)
+    return path
+
+
+class PlaceDataHandle(Generic[PlaceData]):
+    """Output of a stage: the validated place data, and the path of its checkpoint file.
+
+    In the same process the next stage is given the path and takes `data` as-is from
+    `handed_over_place_data`. The file is only read back to resume from it or on another
+    machine, `wait()` returns its path once it is fully written.
+    """
+
+    def __init__(self, path: str, data: PlaceData, checkpoint: Optional[Future] = None):
+        self.path = path
+        self.data = data
+        self.checkpoint = checkpoint
+        _handles[os.path.abspath(path)] = self
+
+    def wait(self) -> str:
+        if self.checkpoint is not None:
+            self.checkpoint.result()
+        return self.path
+
+    def __fspath__(self) -> str:
+        return self.wait()
+
+    def __getstate__(self) -> dict:
+        # Persisted as the result of a stage deployment: the next stage may run on another
+        # machine and reads the checkpoint, so it has to be written first
+        return {"path": self.wait(), "data": self.data, "checkpoint": None}
+
+    def __repr__(self) -> str:
+        return f"PlaceDataHandle(path={self.path!r}, data={type(self.data).__name__})"
+
+
+def handed_over_place_data(path: str, model: Type[PlaceData]) -> Optional[PlaceData]:
+    """The data of the handle made in this process for the checkpoint `path`, if any."""
+    handle = _handles.get(os.path.abspath(path))
+    if handle is not None and isinstance(handle.data, model):
+        return handle.data
+    return None
+
+
+def load_checkpoint(path: str, model: Type[PlaceData]) -> PlaceDataHandle[PlaceData]:
+    with open(path, "r") as file:
+        place_data = model.model_validate(from_json(file.read(), allow_partial=True))
+    return PlaceDataHandle(path=path, data=place_data)
+
+
+def checkpoint_place_data(path: str, place_data: PlaceData) -> PlaceDataHandle[PlaceData]:
+    return PlaceDataHandle(path=path, data=place_data,
+                           checkpoint=_checkpoint_executor.submit(write_checkpoint, path, place_data))
@@ -0,0 +1,134 @@
+import hashlib
+import os
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from common_types import ImageAsset, ImageVariant
+
+DEFAULT_IMAGE_WIDTHS = [320, 640, 1280]
+
+# Width of the variant that `images` points at, for clients that don't read `image_assets`
+DEFAULT_IMAGE_WIDTH = 640
+
+IMAGE_FORMATS = {
+    "webp": {"quality": 80, "method": 6},
+    "avif": {"quality": 55, "speed": 6},
+}
+
+FETCH_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (compatible; localgaid-image-fetcher)",
+    "Accept": "image/avif,image/webp,image/*;q=0.8",
+}
+
+
+def available_image_formats() -> List[str]:
+    from PIL import features
+
+    # AVIF needs a Pillow build with libavif, WebP is always produced
+    return [image_format for image_format in IMAGE_FORMATS
+            if image_format == "webp" or features.check(image_format)]
+
+
+def source_file_name(url: str) -> str:
+    return hashlib.sha256(url.encode()).hexdigest()[:16]
+
+
+def fetch_images(urls: List[str], output_dir: str, max_workers: int = 8,
+                 timeout_seconds: float = 20.0) -> Dict[str, Optional[str]]:
+    """Downloads the images into `output_dir`, returns {url: local path} (None when it failed).
+
+    One client is shared by the threads so connections to the same host are pooled and kept alive.
+    """
+    import httpx
+
+    os.makedirs(output_dir, exist_ok=True)
+    limits = httpx.Limits(max_connections=max_workers,
+                          max_keepalive_connections=max_workers)
+
+    with httpx.Client(headers=FETCH_HEADERS, limits=limits, timeout=timeout_seconds,
+                      follow_redirects=True) as client:
+
+        def fetch(url: str) -> Optional[str]:
+            path = os.path.join(output_dir, source_file_name(url))
+            if os.path.exists(path):
+                return path
+            try:
+                response = client.get(url)
+                response.raise_for_status()
+            except httpx.HTTPError as e:
+                print(f"Could not download image '{url}': {e}")
+                return None
+            with open(f"{path}.tmp", "wb") as file:
+                file.write(response.content)
+            os.replace(f"{path}.tmp", path)
+            return path
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return dict(zip(urls, executor.map(fetch, urls)))
+
+
+def variant_file_path(source_path: str, width: int, image_format: str) -> str:
+    return f"{source_path}.w{width}.{image_format}"
+
+
+def make_image_variants(source_url: str, source_path: str, widths: List[int],
+                        image_formats: List[str]) -> ImageAsset:
+    from PIL import Image, ImageOps
+
+    with Image.open(source_path) as image:
+        # Phone photos are often stored sideways with an EXIF orientation
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+
+        variants = []
+        # Never upscale, the largest variant is at most the original width
+        for width in sorted({min(width, image.width) for width in widths}):
+            height = round(image.height * width / image.width)
+            resized = image.resize((width, height), Image.Resampling.LANCZOS)
+            for image_format in image_formats:
+                path = variant_file_path(source_path, width, image_format)
+                resized.save(path, format=image_format.upper(), **IMAGE_FORMATS[image_format])
+                variants.append(ImageVariant(
+                    width=width,
+                    height=height,
+                    format=image_format,
+                    image_url=path,
+                    size_bytes=os.path.getsize(path),
+                ))
+
+        return ImageAsset(source_url=source_url, width=image.width, height=image.height,
+                          variants=variants)
+
+
+def make_image_assets(source_paths: Dict[str, str], widths: List[int],
+                      image_formats: Optional[List[str]] = None,
+                      max_workers: Optional[int] = None) -> Dict[str, Optional[ImageAsset]]:
+    from PIL import Image
+
+    if image_formats is None:
+        image_formats = available_image_formats()
+
+    def result(future) -> Optional[ImageAsset]:
+        try:
+            return future.result()
+        except (OSError, Image.DecompressionBombError) as e:
+            print(f"Could not decode image: {e}")
+            return None
+
+    # Resizing and encoding are CPU bound, one process per core
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            url: executor.submit(make_image_variants, url, path, widths, image_formats)
+            for url, path in source_paths.items()
+        }
+        return {url: result(future) for url, future in futures.items()}
+
+
+def default_variant(asset: ImageAsset, width: int = DEFAULT_IMAGE_WIDTH,
+                    image_format: str = "webp") -> ImageVariant:
+    # The smallest variant at least `width` wide, the largest one otherwise
+    variants = sorted([variant for variant in asset.variants if variant.format == image_format],
+                      key=lambda variant: variant.width)
+    return next((variant for variant in variants if variant.width >= width), variants[-1])
@@ -0,0 +1,149 @@
+import asyncio
+import functools
+import os
+import resource
+import sys
+import time
+import tracemalloc
+
+from typing import Optional, Tuple
+from pydantic import BaseModel
+
+from prefect import get_run_logger
+from prefect.artifacts import create_table_artifact
+from prefect.events import emit_event
+
+PROFILE_ENV_VAR = "LOCALGAID_PROFILE_TASKS"
+
+
+class TaskMetrics(BaseModel):
+    task_name: str
+    status: str
+    wall_seconds: float
+    cpu_seconds: float
+    tracemalloc_peak_bytes: int
+    peak_rss_bytes: int
+    read_bytes: Optional[int] = None
+    write_bytes: Optional[int] = None
+
+
+def profiling_enabled() -> bool:
+    return os.environ.get(PROFILE_ENV_VAR, "").lower() in ("1", "true", "yes")
+
+
+def read_io_counters() -> Tuple[Optional[int], Optional[int]]:
+    # Linux only; rchar/wchar count every read()/write() of the process, page cache hits included
+    try:
+        with open("/proc/self/io", "r") as file:
+            counters = dict(line.split(": ", 1) for line in file.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def cpu_seconds() -> float:
+    # Children are included so ffmpeg and process pool workers count towards the task
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def peak_rss_bytes() -> int:
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+class TaskMeasurement:
+    """Measures one task call.
+
+    Tasks running concurrently in the same process share the tracemalloc peak and the
+    I/O counters, so the numbers are exact only for tasks running one at a time.
+    """
+
+    def __init__(self, task_name: str):
+        self.task_name = task_name
+
+    def start(self):
+        self.started_tracing = not tracemalloc.is_tracing()
+        if self.started_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        self.read_bytes, self.write_bytes = read_io_counters()
+        self.cpu_time = cpu_seconds()
+        self.wall_time = time.perf_counter()
+
+    def stop(self, status: str) -> TaskMetrics:
+        wall_seconds = time.perf_counter() - self.wall_time
+        cpu_time = cpu_seconds() - self.cpu_time
+        read_bytes, write_bytes = read_io_counters()
+        _, tracemalloc_peak = tracemalloc.get_traced_memory()
+        if self.started_tracing:
+            tracemalloc.stop()
+
+        return TaskMetrics(
+            task_name=self.task_name,
+            status=status,
+            wall_seconds=round(wall_seconds, 3),
+            cpu_seconds=round(cpu_time, 3),
+            tracemalloc_peak_bytes=tracemalloc_peak,
+            peak_rss_bytes=peak_rss_bytes(),
+            read_bytes=read_bytes - self.read_bytes if read_bytes is not None else None,
+            write_bytes=write_bytes - self.write_bytes if write_bytes is not None else None,
+        )
+
+
+def emit_task_metrics(metrics: TaskMetrics):
+    get_run_logger().info("Task metrics: %s", metrics.model_dump_json())
+
+    emit_event(
+        event="localgaid.task.metrics",
+        resource={"prefect.resource.id": f"localgaid.task.{metrics.task_name}"},
+        payload=metrics.model_dump(),
+    )
+
+    create_table_artifact(
+        key=f"task-metrics-{metrics.task_name.replace('_', '-')}",
+        table=[metrics.model_dump()],
+        description=f"Resource usage of '{metrics.task_name}'",
+    )
+
+
+def instrument_task(fn):
+    """Records time, memory and I/O of a task function when LOCALGAID_PROFILE_TASKS is set.
+
+    Goes under the @task decorator:
+
+        @task(log_prints=True, name="Crawl task")
+        @instrument_task
+        async def crawl(...):
+    """
+    if asyncio.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def async_wrapper(*args, **kwargs):
+            if not profiling_enabled():
+                return await fn(*args, **kwargs)
+            measurement = TaskMeasurement(fn.__name__)
+            measurement.start()
+            status = "failed"
+            try:
+                result = await fn(*args, **kwargs)
+                status = "completed"
+                return result
+            finally:
+                emit_task_metrics(measurement.stop(status))
+        return async_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not profiling_enabled():
+            return fn(*args, **kwargs)
+        measurement = TaskMeasurement(fn.__name__)
+        measurement.start()
+        status = "failed"
+        try:
+            result = fn(*args, **kwargs)
+            status = "completed"
+            return result
+        finally:
+            emit_task_metrics(measurement.stop(status))
+    return wrapper
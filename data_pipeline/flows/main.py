@@ -1,15 +1,117 @@
 import asyncio
+import importlib
+import inspect
+import os
 
 from datetime import datetime
+from typing import TYPE_CHECKING, Dict, List, Optional
 
 from prefect import runtime, flow, get_client
+from prefect.artifacts import create_table_artifact
+from prefect.deployments import run_deployment
 from prefect.flow_runs import pause_flow_run
 from prefect.input import RunInput
 
-from data_pipeline.flows.s01_crawl_websites import crawl_flow
-from data_pipeline.flows.s02_make_audio_script import make_audio_script_flow
-from data_pipeline.flows.s03_generate_audio_guides import generate_audio_guides_flow
-from data_pipeline.flows.s04_update_production_database import update_production_database_flow
+from data_pipeline.flows.pipeline import PipelineStage, run_pipeline
+
+if TYPE_CHECKING:
+    from data_pipeline.flows.handoff import PlaceDataHandle
+
+# The stage modules, and crawl4ai, openai, edge-tts, boto3 or supabase with them, are only
+# imported by the flow run that reaches the stage in this process, serving the deployment
+# or running the stage on another work pool doesn't load them
+STAGE_FLOWS = {
+    "crawl": "data_pipeline.flows.s01_crawl_websites:crawl_flow",
+    "script": "data_pipeline.flows.s02_make_audio_script:make_audio_script_flow",
+    "audio": "data_pipeline.flows.s03_generate_audio_guides:generate_audio_guides_flow",
+    "upload": "data_pipeline.flows.s04_update_production_database:update_production_database_flow",
+}
+
+
+def city_from_config_file_path(config_file_path: str) -> Optional[str]:
+    # Place configs are named {city}_{place}.json, e.g. vungtau_bachdinh.json
+    name = config_file_path.rsplit("/", 1)[-1].rsplit(".", 1)[0]
+    return name.split("_", 1)[0] if "_" in name else None
+
+
+def place_name_from_config_file_path(config_file_path: str) -> str:
+    return config_file_path.rsplit("/", 1)[-1].rsplit(".", 1)[0]
+
+
+class BatchApproval(RunInput):
+    approve: bool = True
+    # Places left out of the next stages, by config name
+    rejected_places: List[str] = []
+
+
+def load_stage_flow(stage_name: str):
+    module_name, flow_name = STAGE_FLOWS[stage_name].split(":")
+    return getattr(importlib.import_module(module_name), flow_name)
+
+
+async def run_stage(stage_name: str, parameters: dict,
+                    stage_deployments: Optional[Dict[str, str]] = None):
+    """Runs the flow of one stage for one place.
+
+    When `stage_deployments` names a deployment for the stage, e.g. {"audio": "Generate narration
+    audio flow/localgaid-audio"}, the stage runs on the work pool of that deployment and reads
+    the checkpoints, the output directories have to be shared between the pools.
+    Otherwise it runs here: async stages on the event loop, sync ones in a thread so their
+    blocking calls don't hold up the loop.
+    """
+    deployment_name = (stage_deployments or {}).get(stage_name)
+    if deployment_name:
+        flow_run = await run_deployment(name=deployment_name, parameters=parameters, as_subflow=True)
+        if not flow_run.state.is_completed():
+            raise RuntimeError(f"'{deployment_name}' ended as {flow_run.state.name}: {flow_run.state.message}")
+        # The stage result is persisted by the worker, result() is awaitable when called from async code
+        result = flow_run.state.result()
+        return await result if inspect.isawaitable(result) else result
+
+    stage = load_stage_flow(stage_name)
+    if asyncio.iscoroutinefunction(stage.fn):
+        return await stage(**parameters)
+    return await asyncio.to_thread(stage, **parameters)
+
+
+async def run_batch_stage(stage_name: str, inputs: Dict[str, dict], concurrency: int,
+                          stage_deployments: Optional[Dict[str, str]] = None) -> Dict[str, object]:
+    """Runs the stage with `inputs[place]` for every place, at most `concurrency` at once.
+
+    A failed place is reported and left out of the results instead of failing the whole batch.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(kwargs: dict):
+        async with semaphore:
+            return await run_stage(stage_name, kwargs, stage_deployments)
+
+    results = await asyncio.gather(*(run(kwargs) for kwargs in inputs.values()),
+                                   return_exceptions=True)
+
+    outputs = {}
+    for place, result in zip(inputs, results):
+        if isinstance(result, BaseException):
+            print(f"[{stage_name}] '{place}' failed: {result}")
+        else:
+            outputs[place] = result
+    print(f"[{stage_name}] {len(outputs)}/{len(inputs)} places succeeded.")
+    return outputs
+
+
+async def approve_batch(stage_name: str, outputs: Dict[str, "PlaceDataHandle"]) -> List[str]:
+    # Reviewers read the checkpoint files, they have to be written by now
+    create_table_artifact(
+        key=f"batch-review-{stage_name}",
+        table=[{"place": place, "output": handle.wait()} for place, handle in outputs.items()],
+        description=f"Outputs of {stage_name} waiting for review.",
+    )
+    print(f"Review the {len(outputs)} outputs of {stage_name}, then approve or reject places.")
+    approval = await pause_flow_run(wait_for_input=BatchApproval.with_initial_data(
+        description=f"Continue after {stage_name} with these places: {', '.join(outputs)}"))
+    if not approval.approve:
+        return []
+    return [place for place in outputs if place not in approval.rejected_places]
 
 
 @flow(log_prints=True, name="audiogaid flow")
@@ -18,11 +120,18 @@ async def main(config_file_path: str,
                bronze_output_dir: str,
                silver_output_dir: str,
                gold_output_dir: str,
-               #    run_result_dir: str,
                bucket_name: str,
                parent_folder_name: str,
                database_block_name: str,
                aws_credentials_block_name: str,
+               tts_backend_name: Optional[str] = None,
+               fallback_tts_backend_name: Optional[str] = None,
+               city: Optional[str] = None,
+               asset_base_url: Optional[str] = None,
+               run_result_dir: Optional[str] = None,
+               pipelined: bool = False,
+               force: bool = False,
+               stage_deployments: Optional[Dict[str, str]] = None,
                ):
 
     async with get_client() as client:
@@ -30,42 +139,194 @@ async def main(config_file_path: str,
         ts = datetime.now().strftime("%Y%m%d_%H%M%S")
         await client.update_flow_run(flow_run_id=runtime.flow_run.id, name=f"{name}_{ts}")
 
-    s01_output_file_path = await crawl_flow(
+    # Each stage hands its validated output to the next one by checkpoint path, in the same
+    # process the data itself is taken from the handle and the file is only a checkpoint
+    s01_output = await run_stage("crawl", dict(
         config_file_path=config_file_path,
         output_dir=bronze_output_dir,
-        # run_result_dir=run_result_dir,
-    )
+        force=force,
+        run_result_dir=run_result_dir,
+    ), stage_deployments)
 
-    s02_output_file_path = make_audio_script_flow(
+    s02_output = await run_stage("script", dict(
         prompt_template_path=make_audio_script_prompt_path,
-        place_data_path=s01_output_file_path,
+        place_data_path=s01_output.path,
         output_dir=silver_output_dir,
-        # run_result_dir=run_result_dir,
-    )
+        force=force,
+        run_result_dir=run_result_dir,
+    ), stage_deployments)
 
+    print(f"Review {s02_output.wait()}")
     print("Generate the audio guide files? (Y/n): ")
     s02_confirmation = await pause_flow_run(wait_for_input=str)
     if s02_confirmation.lower() != "y":
         return
 
-    s03_output_file_path = generate_audio_guides_flow(
-        place_data_path=s02_output_file_path,
+    s03_output = await run_stage("audio", dict(
+        place_data_path=s02_output.path,
         output_dir=gold_output_dir,
-        # run_result_dir=run_result_dir,
-    )
+        tts_backend_name=tts_backend_name,
+        fallback_tts_backend_name=fallback_tts_backend_name,
+        # Uploads the sections while they are rendered, the approval below then only publishes them
+        staging_bucket_name=bucket_name if pipelined else None,
+        staging_folder_name=parent_folder_name,
+        aws_credentials_block_name=aws_credentials_block_name,
+        force=force,
+        run_result_dir=run_result_dir,
+    ), stage_deployments)
 
+    print(f"Review {s03_output.wait()}")
     print("Update the production database? (Y/n): ")
     s03_confirmation = await pause_flow_run(wait_for_input=str)
     if s03_confirmation.lower() != "y":
         return
 
-    update_production_database_flow(
-        place_data_path=s03_output_file_path,
+    await run_stage("upload", dict(
+        place_data_path=s03_output.path,
         bucket_name=bucket_name,
         parent_folder_name=parent_folder_name,
         database_block_name=database_block_name,
         aws_credentials_block_name=aws_credentials_block_name,
-    )
+        city=city or city_from_config_file_path(config_file_path),
+        asset_base_url=asset_base_url,
+        force=force,
+        run_result_dir=run_result_dir,
+    ), stage_deployments)
+
+
+@flow(log_prints=True, name="audiogaid batch flow")
+async def main_batch(config_file_paths: List[str],
+                     make_audio_script_prompt_path: str,
+                     bronze_output_dir: str,
+                     silver_output_dir: str,
+                     gold_output_dir: str,
+                     bucket_name: str,
+                     parent_folder_name: str,
+                     database_block_name: str,
+                     aws_credentials_block_name: str,
+                     tts_backend_name: Optional[str] = None,
+                     fallback_tts_backend_name: Optional[str] = None,
+                     city: Optional[str] = None,
+                     asset_base_url: Optional[str] = None,
+                     run_result_dir: Optional[str] = None,
+                     pipelined: bool = False,
+                     crawl_concurrency: int = 4,
+                     script_concurrency: int = 4,
+                     tts_concurrency: int = 2,
+                     upload_concurrency: int = 4,
+                     streaming: bool = False,
+                     queue_size: int = 2,
+                     force: bool = False,
+                     stage_deployments: Optional[Dict[str, str]] = None,
+                     ):
+    """Runs the pipeline for many places, with one approval per stage for the whole batch.
+
+    With `streaming`, crawl, script and audio run as a pipeline with bounded queues instead of
+    one stage after the other, and scripts are reviewed together with the audio.
+    With `stage_deployments`, the stages it names run on the work pools of their deployments.
+    """
+    config_file_paths = {place_name_from_config_file_path(path): path
+                         for path in config_file_paths}
+
+    def audio_parameters(place: str, s02_output: "PlaceDataHandle") -> dict:
+        # Subflows share the batch run ID, one gold folder per place keeps the section files apart
+        return dict(place_data_path=s02_output.path,
+                    output_dir=os.path.join(gold_output_dir, place),
+                    tts_backend_name=tts_backend_name,
+                    fallback_tts_backend_name=fallback_tts_backend_name,
+                    staging_bucket_name=bucket_name if pipelined else None,
+                    staging_folder_name=parent_folder_name,
+                    aws_credentials_block_name=aws_credentials_block_name,
+                    force=force,
+                    run_result_dir=run_result_dir)
+
+    if streaming:
+        async def crawl(place: str, config_file_path: str) -> "PlaceDataHandle":
+            return await run_stage("crawl", dict(config_file_path=config_file_path,
+                                                 output_dir=bronze_output_dir,
+                                                 force=force,
+                                                 run_result_dir=run_result_dir), stage_deployments)
+
+        async def make_script(place: str, s01_output: "PlaceDataHandle") -> "PlaceDataHandle":
+            return await run_stage("script", dict(prompt_template_path=make_audio_script_prompt_path,
+                                                  place_data_path=s01_output.path,
+                                                  output_dir=silver_output_dir,
+                                                  force=force,
+                                                  run_result_dir=run_result_dir), stage_deployments)
+
+        async def generate_audio(place: str, s02_output: "PlaceDataHandle") -> "PlaceDataHandle":
+            return await run_stage("audio", audio_parameters(place, s02_output), stage_deployments)
+
+        s03_outputs, _ = await run_pipeline(config_file_paths, [
+            PipelineStage("crawl", crawl, crawl_concurrency),
+            PipelineStage("script", make_script, script_concurrency),
+            PipelineStage("audio", generate_audio, tts_concurrency),
+        ], queue_size=queue_size)
+    else:
+        s01_outputs = await run_batch_stage("crawl", {
+            place: dict(config_file_path=path, output_dir=bronze_output_dir, force=force,
+                        run_result_dir=run_result_dir)
+            for place, path in config_file_paths.items()
+        }, crawl_concurrency, stage_deployments)
+
+        s02_outputs = await run_batch_stage("script", {
+            place: dict(prompt_template_path=make_audio_script_prompt_path,
+                        place_data_path=s01_output.path,
+                        output_dir=silver_output_dir,
+                        force=force,
+                        run_result_dir=run_result_dir)
+            for place, s01_output in s01_outputs.items()
+        }, script_concurrency, stage_deployments)
+
+        approved_places = await approve_batch("script", s02_outputs)
+        if not approved_places:
+            return
+
+        s03_outputs = await run_batch_stage("audio", {
+            place: audio_parameters(place, s02_outputs[place])
+            for place in approved_places
+        }, tts_concurrency, stage_deployments)
+
+    approved_places = await approve_batch("audio", s03_outputs)
+    if not approved_places:
+        return
+
+    # The places are written to the database and the catalog published once for the batch,
+    # concurrent publishes of one city would conflict
+    s04_outputs = await run_batch_stage("upload", {
+        place: dict(place_data_path=s03_outputs[place].path,
+                    bucket_name=bucket_name,
+                    parent_folder_name=parent_folder_name,
+                    database_block_name=database_block_name,
+                    aws_credentials_block_name=aws_credentials_block_name,
+                    write_database=False,
+                    force=force,
+                    run_result_dir=run_result_dir)
+        for place in approved_places
+    }, upload_concurrency, stage_deployments)
+    if not s04_outputs:
+        return
+
+    from data_pipeline.flows.s04_update_production_database import publish_catalog_task, write_places_to_database
+    from data_pipeline.flows.upload_journal import default_journal_path
+
+    write_places_to_database(places=list(s04_outputs.values()),
+                             journal_paths={place_data.name: default_journal_path(s03_outputs[place].path)
+                                            for place, place_data in s04_outputs.items()},
+                             database_block_name=database_block_name)
+
+    places_by_city = {}
+    for place, place_data in s04_outputs.items():
+        place_city = city or city_from_config_file_path(config_file_paths[place])
+        if place_city:
+            places_by_city.setdefault(place_city, []).append(place_data)
+
+    for place_city, places in places_by_city.items():
+        publish_catalog_task(places=places,
+                             city=place_city,
+                             bucket_name=bucket_name,
+                             aws_credentials_block_name=aws_credentials_block_name,
+                             asset_base_url=asset_base_url)
 
 
 if __name__ == "__main__":
@@ -75,7 +336,7 @@ if __name__ == "__main__":
         "bronze_output_dir": "/Users/quanbm/Dev/sides/localgaid_notebooks/run_data/data_bronze",
         "silver_output_dir": "/Users/quanbm/Dev/sides/localgaid_notebooks/run_data/data_silver",
         "gold_output_dir": "/Users/quanbm/Dev/sides/localgaid_notebooks/run_data/data_gold",
-        # "run_result_dir": "/Users/quanbm/Dev/sides/localgaid_notebooks/run_data/run_results",
+        "run_result_dir": "/Users/quanbm/Dev/sides/localgaid_notebooks/run_data/run_results",
         "make_audio_script_prompt_path": "/Users/quanbm/Dev/sides/localgaid_notebooks/prompts/narration_2.jinja",
         "bucket_name": "localgaid-dev",
         "parent_folder_name": "audio-guides",
@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import struct
+import zipfile
+
+from typing import List, Tuple
+from pydantic import BaseModel
+
+from storage import content_type, file_sha256
+
+# Downloads are resumed and verified per chunk
+PACK_CHUNK_SIZE = 1024 * 1024
+PACK_FORMAT_VERSION = 1
+
+ZIP_LOCAL_HEADER_SIZE = 30
+
+
+class PackEntry(BaseModel):
+    path: str
+    offset: int
+    size: int
+    sha256: str
+    content_type: str
+
+
+class PackIndex(BaseModel):
+    format_version: int = PACK_FORMAT_VERSION
+    city: str
+    pack_file: str
+    pack_size: int
+    pack_sha256: str
+    chunk_size: int
+    chunk_sha256s: List[str]
+    entries: List[PackEntry]
+
+
+def data_offset(archive, info: zipfile.ZipInfo) -> int:
+    # The file data starts after the local header, whose name/extra lengths may differ from the central directory
+    archive.seek(info.header_offset)
+    header = archive.read(ZIP_LOCAL_HEADER_SIZE)
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    return info.header_offset + ZIP_LOCAL_HEADER_SIZE + name_length + extra_length
+
+
+def chunk_sha256s(path: str, chunk_size: int) -> List[str]:
+    with open(path, "rb") as file:
+        return [hashlib.sha256(chunk).hexdigest() for chunk in iter(lambda: file.read(chunk_size), b"")]
+
+
+def build_pack(city: str, files: List[Tuple[str, str]], output_dir: str,
+               chunk_size: int = PACK_CHUNK_SIZE) -> Tuple[str, PackIndex]:
+    """Writes a ZIP of `(path in pack, local path)` files and its byte range index.
+
+    Entries are stored uncompressed (the audio already is), so the app can read any file with
+    a single range request at `offset` without unpacking the archive.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    tmp_pack_path = os.path.join(output_dir, f"{city}.pack.zip.tmp")
+
+    with zipfile.ZipFile(tmp_pack_path, "w", compression=zipfile.ZIP_STORED) as pack:
+        for pack_path, local_path in files:
+            pack.write(local_path, arcname=pack_path)
+
+    entries = []
+    with zipfile.ZipFile(tmp_pack_path, "r") as pack, open(tmp_pack_path, "rb") as archive:
+        local_paths = dict(files)
+        for info in pack.infolist():
+            entries.append(PackEntry(
+                path=info.filename,
+                offset=data_offset(archive, info),
+                size=info.file_size,
+                sha256=file_sha256(local_paths[info.filename]),
+                content_type=content_type(info.filename),
+            ))
+
+    pack_sha256 = file_sha256(tmp_pack_path)
+    pack_path = os.path.join(output_dir, f"{city}.{pack_sha256[:16]}.pack.zip")
+    os.replace(tmp_pack_path, pack_path)
+
+    index = PackIndex(
+        city=city,
+        pack_file=os.path.basename(pack_path),
+        pack_size=os.path.getsize(pack_path),
+        pack_sha256=pack_sha256,
+        chunk_size=chunk_size,
+        chunk_sha256s=chunk_sha256s(pack_path, chunk_size),
+        entries=entries,
+    )
+    return pack_path, index
+
+
+def write_pack_index(pack_path: str, index: PackIndex) -> str:
+    index_path = pack_path.rsplit(".zip", 1)[0] + ".index.json"
+    with open(index_path, "w+") as file:
+        file.write(index.model_dump_json())
+    return index_path
+
+
+def write_json(path: str, data: dict) -> str:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w+") as file:
+        file.write(json.dumps(data, ensure_ascii=False, separators=(",", ":")))
+    return path
@@ -0,0 +1,172 @@
+import asyncio
+import functools
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+
+from typing import Dict, Optional
+from pydantic import BaseModel
+
+RATE_LIMITS_ENV_VAR = "LOCALGAID_RATE_LIMITS"
+RATE_LIMIT_DB_ENV_VAR = "LOCALGAID_RATE_LIMIT_DB"
+
+AOAI_REQUESTS = "aoai-requests"
+AOAI_TOKENS = "aoai-tokens"
+EDGE_TTS = "edge-tts"
+CRAWL = "crawl"
+
+
+class RateLimit(BaseModel):
+    per_minute: float
+    # Tokens that can be spent at once after an idle period, ten seconds' worth by default
+    burst: Optional[float] = None
+
+    @property
+    def capacity(self) -> float:
+        return self.burst if self.burst is not None else max(1.0, self.per_minute / 6)
+
+    @property
+    def per_second(self) -> float:
+        return self.per_minute / 60
+
+
+# Totals for all the workers sharing the limiter database. A "service:host" key overrides the
+# limit of one host, every other host gets its own bucket with the limit of the service.
+DEFAULT_RATE_LIMITS: Dict[str, RateLimit] = {
+    AOAI_REQUESTS: RateLimit(per_minute=60),
+    AOAI_TOKENS: RateLimit(per_minute=30000),
+    # The pause of 5 seconds between two sections the stage used to make
+    EDGE_TTS: RateLimit(per_minute=12, burst=1),
+    CRAWL: RateLimit(per_minute=30, burst=4),
+}
+
+
+def load_rate_limits() -> Dict[str, RateLimit]:
+    """Default limits, overridden by the JSON of LOCALGAID_RATE_LIMITS, `null` removes a limit.
+
+    e.g. LOCALGAID_RATE_LIMITS='{"aoai-tokens": {"per_minute": 150000}, "crawl:vi.wikipedia.org": {"per_minute": 60}}'
+    """
+    limits = dict(DEFAULT_RATE_LIMITS)
+    overrides = os.environ.get(RATE_LIMITS_ENV_VAR)
+    if overrides:
+        for key, limit in json.loads(overrides).items():
+            if limit is None:
+                limits.pop(key, None)
+            else:
+                limits[key] = RateLimit.model_validate(limit)
+    return limits
+
+
+def default_rate_limit_path() -> str:
+    return os.environ.get(RATE_LIMIT_DB_ENV_VAR) or \
+        os.path.join(os.path.expanduser("~"), ".localgaid", "rate_limits.sqlite")
+
+
+class RateLimiter:
+    """Token buckets in a SQLite file, shared by every process and thread that opens it.
+
+    A bucket holds the time it was last refilled, each acquisition refills it from the elapsed
+    time and takes its tokens in one write transaction, so the workers never spend more than
+    the limit between them however many there are.
+    """
+
+    def __init__(self, path: str, limits: Dict[str, RateLimit]):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.limits = limits
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS buckets (
+                key TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )""")
+
+    def bucket(self, service: str, host: Optional[str] = None):
+        if host:
+            key = f"{service}:{host}"
+            return key, self.limits.get(key) or self.limits.get(service)
+        return service, self.limits.get(service)
+
+    def try_acquire(self, key: str, limit: RateLimit, amount: float) -> float:
+        """Takes `amount` tokens and returns 0, or returns the seconds to wait before trying again."""
+        # A request larger than the bucket waits for a full bucket and leaves it in debt
+        needed = min(amount, limit.capacity)
+        with self.lock:
+            # Takes the write lock first, two processes can't both read the same balance
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = self.connection.execute("SELECT tokens, updated_at FROM buckets WHERE key = ?",
+                                              (key,)).fetchone()
+                tokens = limit.capacity if row is None else \
+                    min(limit.capacity, row[0] + max(0.0, now - row[1]) * limit.per_second)
+                wait_seconds = 0.0
+                if tokens >= needed:
+                    tokens -= amount
+                else:
+                    wait_seconds = (needed - tokens) / limit.per_second
+                self.connection.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated_at) VALUES (?, ?, ?)",
+                                        (key, tokens, now))
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+        return wait_seconds
+
+    def acquire(self, service: str, amount: float = 1, host: Optional[str] = None):
+        key, limit = self.bucket(service, host)
+        if limit is None:
+            return
+        while True:
+            wait_seconds = self.try_acquire(key, limit, amount)
+            if not wait_seconds:
+                return
+            # Jitter, so the waiting workers don't all come back at the same moment
+            time.sleep(wait_seconds * random.uniform(1.0, 1.2))
+
+    async def acquire_async(self, service: str, amount: float = 1, host: Optional[str] = None):
+        key, limit = self.bucket(service, host)
+        if limit is None:
+            return
+        while True:
+            # The write lock can be held by another process, wait for it off the event loop
+            wait_seconds = await asyncio.to_thread(self.try_acquire, key, limit, amount)
+            if not wait_seconds:
+                return
+            await asyncio.sleep(wait_seconds * random.uniform(1.0, 1.2))
+
+    def close(self):
+        self.connection.close()
+
+
+@functools.lru_cache(maxsize=None)
+def process_rate_limiter(pid: int) -> RateLimiter:
+    return RateLimiter(default_rate_limit_path(), load_rate_limits())
+
+
+def get_rate_limiter() -> RateLimiter:
+    # A SQLite connection can't be used across a fork, every process opens its own
+    return process_rate_limiter(os.getpid())
+
+
+def acquire(service: Optional[str], amount: float = 1, host: Optional[str] = None):
+    # A service without a rate limit doesn't open the database
+    if service is None:
+        return
+    get_rate_limiter().acquire(service, amount, host)
+
+
+async def acquire_async(service: Optional[str], amount: float = 1, host: Optional[str] = None):
+    if service is None:
+        return
+    await get_rate_limiter().acquire_async(service, amount, host)
+
+
+def estimate_tokens(text: str) -> int:
+    # Vietnamese takes more tokens per character than English, count on the high side
+    return len(text) // 3 + 1
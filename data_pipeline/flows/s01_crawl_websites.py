@@ -3,21 +3,28 @@ import os
 from datetime import datetime, timezone
 from urllib.parse import urlparse
 from pydantic_core import from_json
-from typing import List, Tuple
+from typing import TYPE_CHECKING, List, Optional, Tuple
 
 from prefect import runtime, flow, task, Flow
 from prefect.artifacts import create_progress_artifact, update_progress_artifact, create_link_artifact
 from prefect.client.schemas.objects import FlowRun
 from prefect.states import State
 
-from crawl4ai import AsyncWebCrawler, BrowserConfig, CrawlerRunConfig, CacheMode
-from crawl4ai.content_filter_strategy import BM25ContentFilter
-from crawl4ai.markdown_generation_strategy import DefaultMarkdownGenerator
+from caching import CRAWL_EXPIRATION, LOCAL_COMPUTE_EXPIRATION, NOT_CACHED, cached
+from common_types import PlaceConfig, PlaceDataBronze
+from fingerprints import FingerprintIndex, fingerprint
+from handoff import PlaceDataHandle, checkpoint_place_data, load_checkpoint
+from instrumentation import instrument_task
+from rate_limiter import CRAWL, acquire_async
+from storage import file_sha256
+from telemetry import record_stage_run
 
-from common_types import PlaceConfig, PlaceDataBronze, CrawlRunResult
+if TYPE_CHECKING:
+    from crawl4ai import BrowserConfig
 
 
-@task(log_prints=True, name="Load page config task")
+@task(log_prints=True, name="Load page config task", **cached(LOCAL_COMPUTE_EXPIRATION))
+@instrument_task
 def load_place_config(config_file_path: str) -> PlaceConfig:
     with open(config_file_path, "r") as file:
         place_config = PlaceConfig.model_validate(
@@ -27,9 +34,15 @@ def load_place_config(config_file_path: str) -> PlaceConfig:
     return place_config
 
 
-@task(log_prints=True, name="Crawl task")
+@task(log_prints=True, name="Crawl task", **cached(CRAWL_EXPIRATION, exclude=["browser_cfg", "max_concurrent_pages"]))
+@instrument_task
 async def crawl(place_config: PlaceConfig,
-                browser_cfg: BrowserConfig = None) -> Tuple[str, List[dict]]:
+                browser_cfg: "BrowserConfig" = None,
+                max_concurrent_pages: int = 4) -> Tuple[str, List[dict]]:
+    # crawl4ai brings Playwright along, only a crawl that actually runs loads it
+    from crawl4ai import AsyncWebCrawler, BrowserConfig, CrawlerRunConfig, CacheMode
+    from crawl4ai.content_filter_strategy import BM25ContentFilter
+    from crawl4ai.markdown_generation_strategy import DefaultMarkdownGenerator
 
     bm25_filter = BM25ContentFilter(
         user_query=place_config.name,
@@ -65,12 +78,30 @@ async def crawl(place_config: PlaceConfig,
         progress_artifact_id = create_progress_artifact(
             progress=0.0,
             description="Indicates the progress of crawling data from the URLs.")
-        for i, url in enumerate(place_config.urls):
-            result = await crawler.arun(
-                url=url,
-                config=config,
-            )
+        # The pages of a place are fetched at the same time, each in its own browser tab
+        semaphore = asyncio.Semaphore(max_concurrent_pages)
+        crawled = 0
+
+        async def crawl_url(url: str):
+            nonlocal crawled
+            # Per site, whichever worker crawls it
+            await acquire_async(CRAWL, host=urlparse(url).netloc)
+            async with semaphore:
+                result = await crawler.arun(
+                    url=url,
+                    config=config,
+                )
+            crawled += 1
+            print(
+                f"Crawled from '{url}': {len(result.markdown.fit_markdown)} characters")
+            update_progress_artifact(
+                artifact_id=progress_artifact_id, progress=crawled/len(place_config.urls) * 100)
+            return result
+
+        results = await asyncio.gather(*(crawl_url(url) for url in place_config.urls))
 
+        # Same order as the config, whichever page finished first
+        for url, result in zip(place_config.urls, results):
             images.append({
                 url: result.media.get("images", [])
             })
@@ -79,16 +110,12 @@ async def crawl(place_config: PlaceConfig,
 {result.markdown.fit_markdown}
 \n\n
 """
-            print(
-                f"Crawled from '{url}': {len(result.markdown.fit_markdown)} characters")
-
-            update_progress_artifact(
-                artifact_id=progress_artifact_id, progress=i/len(place_config.urls) * 100)
 
     return page_content, images
 
 
-@task(log_prints=True, name="Extract place location task")
+@task(log_prints=True, name="Extract place location task", **cached(LOCAL_COMPUTE_EXPIRATION))
+@instrument_task
 def extract_place_location(page_config: PlaceConfig) -> Tuple[float, float]:
     parts = page_config.location.split(",")
     latitude = float(parts[0].strip())
@@ -96,7 +123,8 @@ def extract_place_location(page_config: PlaceConfig) -> Tuple[float, float]:
     return latitude, longitude
 
 
-@task(log_prints=True, name="Clean up images task")
+@task(log_prints=True, name="Clean up images task", **cached(LOCAL_COMPUTE_EXPIRATION))
+@instrument_task
 def clean_up_images(image_dict: List[dict]) -> List[str]:
     max_desc_length = 10000
 
@@ -126,10 +154,11 @@ def clean_up_images(image_dict: List[dict]) -> List[str]:
     return cleaned_image_urls
 
 
-@task(log_prints=True, name="Compose and save result task")
+@task(log_prints=True, name="Compose and save result task", **NOT_CACHED)
+@instrument_task
 def compose_place_data_and_save_result(name: str, page_content: str, images: List[str],
                                        latitude: float, longitude: float,
-                                       output_dir: str, run_id: str = None) -> str:
+                                       output_dir: str, run_id: str = None) -> PlaceDataHandle[PlaceDataBronze]:
     output_run_dir = os.path.join(output_dir, run_id)
     os.makedirs(output_run_dir, exist_ok=True)
 
@@ -142,12 +171,10 @@ def compose_place_data_and_save_result(name: str, page_content: str, images: Lis
     )
 
     output_file_path = os.path.join(output_run_dir, f"{name}.json")
-    with open(output_file_path, "w+") as file:
-        file.write(place_data.model_dump_json(indent=2))
+    handle = checkpoint_place_data(output_file_path, place_data)
 
-    print("Run result (PlaceDataBronze):")
-    print(place_data.model_dump_json(indent=2))
-    print(f"Saved to {output_file_path}")
+    print("Run result (PlaceDataBronze):", place_data)
+    print(f"Saving to {output_file_path}")
 
     create_link_artifact(
         key="s01-crawl-websites-output",
@@ -155,25 +182,31 @@ def compose_place_data_and_save_result(name: str, page_content: str, images: Lis
         description="Step 1 output"
     )
 
-    return output_file_path
+    return handle
 
 
 @flow(log_prints=True, name="Crawl flow")
 async def crawl_flow(config_file_path: str, output_dir: str,
-                     #  run_result_dir: str = None
-                     ) -> Tuple[str, str, str, str]:
-    browser_cfg = BrowserConfig(headless=True)
-
+                     force: bool = False,
+                     run_result_dir: Optional[str] = None,
+                     ) -> PlaceDataHandle[PlaceDataBronze]:
     run_id = str(
         runtime.flow_run.root_flow_run_id) if runtime.flow_run.root_flow_run_id is not None else str(runtime.flow_run.id)
 
     place_config = load_place_config(config_file_path=config_file_path)
 
-    page_content, image_dict = await crawl(place_config=place_config, browser_cfg=browser_cfg)
+    fingerprints = FingerprintIndex(output_dir)
+    input_fingerprint = fingerprint(file_sha256(config_file_path))
+    existing_output_path = None if force else fingerprints.lookup("s01", place_config.name, input_fingerprint)
+    if existing_output_path:
+        print(f"The config of '{place_config.name}' is unchanged, reusing {existing_output_path}")
+        return load_checkpoint(existing_output_path, PlaceDataBronze)
+
+    page_content, image_dict = await crawl(place_config=place_config)
     images = clean_up_images(image_dict=image_dict)
     latitude, longitude = extract_place_location(place_config)
 
-    output_file_path = compose_place_data_and_save_result(
+    place_data_handle = compose_place_data_and_save_result(
         name=place_config.name,
         page_content=page_content,
         images=images,
@@ -182,38 +215,15 @@ async def crawl_flow(config_file_path: str, output_dir: str,
         output_dir=output_dir,
         run_id=run_id,
     )
+    fingerprints.record_when_written("s01", place_config.name, input_fingerprint, place_data_handle)
 
-    return output_file_path
-
-    # return output_file_path, config_file_path, place_config.model_dump_json(), run_result_dir
-
-
-# @crawl_flow.on_completion
-# def handle_on_completion(flw: Flow, run: FlowRun, state: State):
-#     end_time = str(datetime.now(timezone.utc))
-
-#     output_file_path, config_file_path, place_config, run_result_dir = run.state.data.result
-
-#     run_id = str(
-#         runtime.flow_run.root_flow_run_id) if runtime.flow_run.root_flow_run_id is not None else str(runtime.flow_run.id)
-
-#     cr_result = CrawlRunResult(
-#         id=run_id,
-#         input=config_file_path,
-#         config=place_config,
-#         status=run.state.name,
-#         start_time=str(run.start_time),
-#         end_time=end_time,
-#         output=output_file_path
-#     )
+    return place_data_handle
 
-#     out_dir = os.path.join(run_result_dir, run_id)
-#     os.makedirs(out_dir, exist_ok=True)
 
-#     result_file_path = os.path.join(
-#         out_dir, f"crawl_{run.start_time.strftime("%Y%m%d_%H%M%S")}__{run_id}.json")
-#     with open(result_file_path, "w+") as file:
-#         file.write(cr_result.model_dump_json(indent=2))
+@crawl_flow.on_completion
+@crawl_flow.on_failure
+def handle_on_completion(flw: Flow, run: FlowRun, state: State):
+    record_stage_run("s01", run, state)
 
 
 if __name__ == "__main__":
@@ -221,6 +231,6 @@ if __name__ == "__main__":
         crawl_flow(
             config_file_path="/Users/quanbm/Dev/sides/localgaid_notebooks/run_data/place_configs/vungtau_bachdinh.json",
             output_dir="/Users/quanbm/Dev/sides/localgaid_notebooks/run_data/data_bronze",
-            # run_result_dir="/Users/quanbm/Dev/sides/localgaid_notebooks/run_data/run_results",
+            run_result_dir="/Users/quanbm/Dev/sides/localgaid_notebooks/run_data/run_results",
         )
     )
@@ -1,5 +1,5 @@
+import asyncio
 import os
-import openai
 
 from prefect import runtime, flow, task, Flow
 from prefect.client.schemas.objects import FlowRun
@@ -7,21 +7,33 @@ from prefect.states import State
 from prefect.artifacts import create_markdown_artifact, create_link_artifact
 
 from datetime import datetime, timezone
-from typing import List
+from typing import List, Optional
 from jinja2 import Template
 from pydantic_core import from_json
 
-from common_types import PlaceDataBronze, PlaceDataSilver, ScriptRunResult
+from caching import LLM_EXPIRATION, LOCAL_COMPUTE_EXPIRATION, NOT_CACHED, cached
+from common_types import PlaceDataBronze, PlaceDataSilver
+from fingerprints import FingerprintIndex, fingerprint
+from handoff import PlaceDataHandle, checkpoint_place_data, handed_over_place_data, load_checkpoint
+from instrumentation import instrument_task
+from rate_limiter import AOAI_REQUESTS, AOAI_TOKENS, acquire_async, estimate_tokens
+from storage import file_sha256
+from telemetry import record_stage_run
 
+# Room for the completion in the token estimate, a script is a few thousand words
+SCRIPT_COMPLETION_TOKENS = 3000
 
-@task(log_prints=True, name="Load prompt template task")
+
+@task(log_prints=True, name="Load prompt template task", **NOT_CACHED)
+@instrument_task
 def load_prompt_template(prompt_template_path: str) -> Template:
     prompt_content = open(prompt_template_path, "r").read()
     template = Template(prompt_content)
     return template
 
 
-@task(log_prints=True, name="Load place data (bronze) task")
+@task(log_prints=True, name="Load place data (bronze) task", **cached(LOCAL_COMPUTE_EXPIRATION))
+@instrument_task
 def load_place_data(place_data_path: str) -> PlaceDataBronze:
     with open(place_data_path, "r") as file:
         place_data = PlaceDataBronze.model_validate(
@@ -31,37 +43,46 @@ def load_place_data(place_data_path: str) -> PlaceDataBronze:
     return place_data
 
 
-@task(log_prints=True, name="Generate script task")
-def generate_script(prompt: str) -> str:
-    client = openai.AzureOpenAI(
+@task(log_prints=True, name="Generate script task", **cached(LLM_EXPIRATION))
+@instrument_task
+async def generate_script(prompt: str, model: Optional[str] = None) -> str:
+    import openai
+
+    # Shared by every worker calling the deployment, so that together they stay under its quota
+    await acquire_async(AOAI_REQUESTS)
+    await acquire_async(AOAI_TOKENS, estimate_tokens(prompt) + SCRIPT_COMPLETION_TOKENS)
+
+    # Waiting on the model doesn't hold a thread, a worker can keep many places in flight
+    async with openai.AsyncAzureOpenAI(
         api_version=os.environ.get("AOAI_API_VERSION"),
         azure_endpoint=os.environ.get("AOAI_ENDPOINT"),
-    )
-    completion = client.beta.chat.completions.parse(
-        temperature=0.2,
-        model=os.environ.get("AOAI_MODEL"),
-        messages=[{"role": "user", "content": prompt}]
-    )
+    ) as client:
+        completion = await client.beta.chat.completions.parse(
+            temperature=0.2,
+            model=model or os.environ.get("AOAI_MODEL"),
+            messages=[{"role": "user", "content": prompt}]
+        )
     result = completion.choices[0].message.content
 
     print(f"Generated audio script: {result}.")
     return result
 
 
-@task(log_prints=True, name="Compose and save result task")
+@task(log_prints=True, name="Compose and save result task", **NOT_CACHED)
+@instrument_task
 def compose_place_data_and_save_result(place_data_bronze: PlaceDataBronze, script: str,
-                                       output_dir: str, run_id: str = None):
+                                       output_dir: str, run_id: str = None) -> PlaceDataHandle[PlaceDataSilver]:
     output_run_dir = os.path.join(output_dir, run_id)
     os.makedirs(output_run_dir, exist_ok=True)
 
-    place_data = PlaceDataSilver(
-        **place_data_bronze.model_dump(),
+    # The bronze fields are already validated, they are reused instead of validated again
+    place_data = PlaceDataSilver.model_construct(
+        **dict(place_data_bronze),
         script=script
     )
 
     output_file_path = os.path.join(output_run_dir, f"{place_data.name}.json")
-    with open(output_file_path, "w+") as file:
-        file.write(place_data.model_dump_json(indent=2))
+    handle = checkpoint_place_data(output_file_path, place_data)
 
     create_markdown_artifact(
         key="audio-guide-script",
@@ -69,9 +90,8 @@ def compose_place_data_and_save_result(place_data_bronze: PlaceDataBronze, scrip
         description=place_data.name,
     )
 
-    print("Run result (PlaceDataSilver):")
-    print(place_data.model_dump_json(indent=2))
-    print(f"Saved to {output_file_path}")
+    print("Run result (PlaceDataSilver):", place_data)
+    print(f"Saving to {output_file_path}")
 
     create_link_artifact(
         key="s02-make-audio-script-output",
@@ -79,63 +99,56 @@ def compose_place_data_and_save_result(place_data_bronze: PlaceDataBronze, scrip
         description="Step 2 output"
     )
 
-    return output_file_path
+    return handle
 
 
 @flow(log_prints=True, name="Make audio script flow")
-def make_audio_script_flow(prompt_template_path: str, place_data_path: str, output_dir: str,
-                           #    run_result_dir: str = None
-                           ):
+async def make_audio_script_flow(prompt_template_path: str, place_data_path: str, output_dir: str,
+                                 force: bool = False,
+                                 run_result_dir: Optional[str] = None,
+                                 ) -> PlaceDataHandle[PlaceDataSilver]:
     run_id = str(
         runtime.flow_run.root_flow_run_id) if runtime.flow_run.root_flow_run_id is not None else str(runtime.flow_run.id)
 
-    place_data_bronze = load_place_data(place_data_path)
-    template = load_prompt_template(prompt_template_path)
-    prompt = template.render(content=place_data_bronze.content)
-    script = generate_script(prompt)
-
-    output_file_path = compose_place_data_and_save_result(place_data_bronze=place_data_bronze,
-                                                          script=script,
-                                                          output_dir=output_dir,
-                                                          run_id=run_id)
-
-    return output_file_path
-    # return output_file_path, prompt_template_path, prompt, place_data_bronze.model_dump_json(), run_result_dir
-
+    # Handed over by the previous stage in the same process, read from its checkpoint on resume
+    place_data_bronze = handed_over_place_data(place_data_path, PlaceDataBronze) or load_place_data(place_data_path)
 
-# @make_audio_script_flow.on_completion
-# def handle_on_completion(flw: Flow, run: FlowRun, state: State):
-#     end_time = str(datetime.now(timezone.utc))
+    fingerprints = FingerprintIndex(output_dir)
+    input_fingerprint = fingerprint(place_data_bronze.model_dump(mode="json"),
+                                    file_sha256(prompt_template_path),
+                                    os.environ.get("AOAI_MODEL"))
+    existing_output_path = None if force else fingerprints.lookup("s02", place_data_bronze.name, input_fingerprint)
+    if existing_output_path:
+        print(
+            f"The bronze data, prompt and model of '{place_data_bronze.name}' are unchanged, reusing {existing_output_path}")
+        return load_checkpoint(existing_output_path, PlaceDataSilver)
 
-#     output_file_path, prompt_template_path, prompt, place_data_bronze, run_result_dir = run.state.data.result
+    template = load_prompt_template(prompt_template_path)
+    prompt = template.render(content=place_data_bronze.content)
+    # The model is a parameter so that switching models misses the cache
+    script = await generate_script(prompt, model=os.environ.get("AOAI_MODEL"))
 
-#     run_id = str(
-#         runtime.flow_run.root_flow_run_id) if runtime.flow_run.root_flow_run_id is not None else str(runtime.flow_run.id)
+    place_data_handle = compose_place_data_and_save_result(place_data_bronze=place_data_bronze,
+                                                           script=script,
+                                                           output_dir=output_dir,
+                                                           run_id=run_id)
+    fingerprints.record_when_written("s02", place_data_bronze.name, input_fingerprint, place_data_handle)
 
-#     cr_result = ScriptRunResult(
-#         id=run_id,
-#         input_prompt_path=prompt_template_path,
-#         input_prompt=prompt,
-#         input_place_data=place_data_bronze,
-#         status=run.state.name,
-#         start_time=str(run.start_time),
-#         end_time=end_time,
-#         output=output_file_path
-#     )
+    return place_data_handle
 
-#     out_dir = os.path.join(run_result_dir, run_id)
-#     os.makedirs(out_dir, exist_ok=True)
 
-#     result_file_path = os.path.join(
-#         out_dir, f"script_{run.start_time.strftime("%Y%m%d_%H%M%S")}__{run_id}.json")
-#     with open(result_file_path, "w+") as file:
-#         file.write(cr_result.model_dump_json(indent=2))
+@make_audio_script_flow.on_completion
+@make_audio_script_flow.on_failure
+def handle_on_completion(flw: Flow, run: FlowRun, state: State):
+    record_stage_run("s02", run, state)
 
 
 if __name__ == "__main__":
-    make_audio_script_flow(
-        prompt_template_path="/Users/quanbm/Dev/sides/localgaid_notebooks/prompts/narration_2.jinja",
-        place_data_path="/Users/quanbm/Dev/sides/localgaid_notebooks/run_data/data_bronze/8c0c7045-03ce-43a2-91b5-9bdc8695cf2f/Bạch Dinh.json",
-        output_dir="/Users/quanbm/Dev/sides/localgaid_notebooks/run_data/data_silver",
-        # run_result_dir="/Users/quanbm/Dev/sides/localgaid_notebooks/run_data/run_results",
+    asyncio.run(
+        make_audio_script_flow(
+            prompt_template_path="/Users/quanbm/Dev/sides/localgaid_notebooks/prompts/narration_2.jinja",
+            place_data_path="/Users/quanbm/Dev/sides/localgaid_notebooks/run_data/data_bronze/8c0c7045-03ce-43a2-91b5-9bdc8695cf2f/Bạch Dinh.json",
+            output_dir="/Users/quanbm/Dev/sides/localgaid_notebooks/run_data/data_silver",
+            run_result_dir="/Users/quanbm/Dev/sides/localgaid_notebooks/run_data/run_results",
+        )
     )
@@ -1,10 +1,7 @@
 import os
-import io
-import edge_tts
-import time
 
 from datetime import datetime, timezone
-from typing import List
+from typing import Callable, List, Optional
 from pydantic import BaseModel
 from pydantic_core import from_json
 
@@ -12,8 +9,22 @@ from prefect import runtime, flow, task, Flow
 from prefect.client.schemas.objects import FlowRun
 from prefect.states import State
 from prefect.artifacts import create_link_artifact
-
-from common_types import PlaceDataSilver, PlaceDataGold, AudioRunResult, AudioGuide
+from prefect.task_runners import ThreadPoolTaskRunner
+
+from caching import LOCAL_COMPUTE_EXPIRATION, NOT_CACHED, RUN_FILES_EXPIRATION, TTS_EXPIRATION, cached
+from common_types import PlaceDataSilver, PlaceDataGold, AudioGuide, ImageAsset
+from fingerprints import FingerprintIndex, fingerprint
+from handoff import PlaceDataHandle, checkpoint_place_data, handed_over_place_data, load_checkpoint
+from instrumentation import instrument_task
+from telemetry import record_stage_run
+from audio_processing import DEFAULT_RENDITION_PROFILES, ffmpeg_path, segment_hls_playlists, transcode_renditions
+from image_processing import fetch_images, make_image_assets
+from rate_limiter import acquire
+from staging import SectionStager
+from storage import S3ObjectUploader, audio_guide_file_paths
+from subtitles import make_vtt, make_word_index
+from upload_journal import JOURNAL_FILE_NAME, UploadJournal
+from tts_backends import SynthesisResult, get_tts_backend, resolve_tts_backend_name, resolve_voice
 
 
 class AudioScriptSection(BaseModel):
@@ -22,7 +33,8 @@ class AudioScriptSection(BaseModel):
     content: str
 
 
-@task(log_prints=True, name="Load place data (silver) task")
+@task(log_prints=True, name="Load place data (silver) task", **cached(LOCAL_COMPUTE_EXPIRATION))
+@instrument_task
 def load_place_data(place_data_path: str) -> PlaceDataSilver:
     with open(place_data_path, "r") as file:
         place_data = PlaceDataSilver.model_validate(
@@ -32,7 +44,8 @@ def load_place_data(place_data_path: str) -> PlaceDataSilver:
     return place_data
 
 
-@task(log_prints=True, name="Pre-process script task")
+@task(log_prints=True, name="Pre-process script task", **cached(LOCAL_COMPUTE_EXPIRATION))
+@instrument_task
 def preprocess_script(script: str) -> List[AudioScriptSection]:
     text_sections = [s for s in script.split("#") if s.strip() != ""]
     sections = []
@@ -45,87 +58,198 @@ def preprocess_script(script: str) -> List[AudioScriptSection]:
     return sections
 
 
-@task(log_prints=True, name="Generate audio task")
-def generate_audio_files_and_subtitles(sections: List[AudioScriptSection]) -> dict:
+@task(log_prints=True, name="Generate audio task", **cached(TTS_EXPIRATION, exclude=["on_section"], uncached_when=["on_section"]))
+@instrument_task
+def generate_audio_files_and_subtitles(sections: List[AudioScriptSection],
+                                       language: str = "vi",
+                                       tts_backend_name: Optional[str] = None,
+                                       voice: Optional[str] = None,
+                                       fallback_tts_backend_name: Optional[str] = None,
+                                       on_section: Optional[Callable[[str, dict], None]] = None) -> dict:
+    backend = get_tts_backend(
+        resolve_tts_backend_name(language, tts_backend_name))
+    backend_voice = resolve_voice(backend, language, voice)
+    fallback_backend = get_tts_backend(
+        fallback_tts_backend_name) if fallback_tts_backend_name else None
+
     audio_data = {}
 
     for section in sections:
         number = f"{section.number:02d}"
         title = section.title.replace(" ", "-")
         text = section.content
-        voice = "vi-VN-NamMinhNeural"
 
         print(
-            f"Generating audio for section {number} ({title}) with '{voice}' voice.")
+            f"Generating audio for section {number} ({title}) with '{backend_voice}' voice ({backend.name}).")
 
         file_name = f"{number}_{title}"
 
-        communicate = edge_tts.Communicate(text, voice)
-        submaker = edge_tts.SubMaker()
-
-        audio_file = io.BytesIO()
-
-        for chunk in communicate.stream_sync():
-            if chunk["type"] == "audio":
-                audio_file.write(chunk["data"])
-            elif chunk["type"] == "WordBoundary":
-                submaker.feed(chunk)
+        try:
+            acquire(backend.rate_limit)
+            result: SynthesisResult = backend.synthesize(text, backend_voice)
+        except Exception as e:
+            if fallback_backend is None:
+                raise
+            print(
+                f"TTS backend '{backend.name}' failed ({e}), falling back to '{fallback_backend.name}'.")
+            acquire(fallback_backend.rate_limit)
+            result = fallback_backend.synthesize(
+                text, resolve_voice(fallback_backend, language))
 
         audio_data[file_name] = {
             "title": section.title,
             "full_subtitle": text,
-            "file": audio_file,
-            "subtitle": submaker.get_srt(),
+            "audio": result.audio,
+            "subtitle": result.subtitle,
+            "word_boundaries": result.word_boundaries,
         }
-        time.sleep(5)
+        if on_section:
+            on_section(file_name, audio_data[file_name])
 
     return audio_data
 
 
-@task(log_prints=True, name="Compose and save result task")
-def compose_place_data_and_save_result(place_data_silver: PlaceDataSilver, audio_data: dict,
-                                       output_dir: str, run_id: str):
+def save_section_files(audio_file_name: str, data: dict, output_run_dir: str) -> AudioGuide:
+    audio_file_path = os.path.join(
+        output_run_dir, audio_file_name + ".mp3")
+    subtitle_file_path = os.path.join(
+        output_run_dir, audio_file_name + ".srt")
+    vtt_file_path = os.path.join(
+        output_run_dir, audio_file_name + ".vtt")
+    word_index_file_path = os.path.join(
+        output_run_dir, audio_file_name + ".words.json")
+
+    with open(audio_file_path, "wb+") as file:
+        file.write(data["audio"])
+    print(f"Created audio file at '{audio_file_path}'")
+    with open(subtitle_file_path, "w+") as file:
+        file.write(data["subtitle"])
+    print(f"Created subtitle file at '{subtitle_file_path}'")
+    with open(vtt_file_path, "w+") as file:
+        file.write(make_vtt(data["word_boundaries"]))
+    print(f"Created WebVTT file at '{vtt_file_path}'")
+    with open(word_index_file_path, "w+") as file:
+        file.write(make_word_index(data["word_boundaries"]))
+    print(f"Created word timing index at '{word_index_file_path}'")
+
+    from mutagen.mp3 import MP3
+    duration_seconds = int(MP3(audio_file_path).info.length)
+
+    return AudioGuide(
+        title=data["title"],
+        full_subtitle=data["full_subtitle"],
+        audio_url=audio_file_path,
+        duration_seconds=duration_seconds,
+        subtitle_url=subtitle_file_path,
+        vtt_url=vtt_file_path,
+        word_index_url=word_index_file_path,
+    )
+
+
+@task(log_prints=True, name="Save audio files and subtitles task", **NOT_CACHED)
+@instrument_task
+def save_audio_files_and_subtitles(audio_data: dict, output_dir: str, run_id: str) -> List[AudioGuide]:
     output_run_dir = os.path.join(output_dir, run_id)
     os.makedirs(output_run_dir, exist_ok=True)
 
-    audio_guides = []
-
-    for audio_file_name, data in audio_data.items():
-        audio_file_path = os.path.join(
-            output_run_dir, audio_file_name + ".mp3")
-        subtitle_file_path = os.path.join(
-            output_run_dir, audio_file_name + ".srt")
-
-        with open(audio_file_path, "wb+") as file:
-            file.write(data["file"].getvalue())
-        print(f"Created audio file at '{audio_file_path}'")
-        with open(subtitle_file_path, "w+") as file:
-            file.write(data["subtitle"])
-        print(f"Created subtitle file at '{subtitle_file_path}'")
-
-        from mutagen.mp3 import MP3
-        duration_seconds = int(MP3(audio_file_path).info.length)
-
-        audio_guides.append(AudioGuide(
-            title=data["title"],
-            full_subtitle=data["full_subtitle"],
-            audio_url=audio_file_path,
-            duration_seconds=duration_seconds,
-            subtitle_url=subtitle_file_path,
-        ))
-
-    place_data = PlaceDataGold(
-        **place_data_silver.model_dump(),
+    return [save_section_files(audio_file_name, data, output_run_dir)
+            for audio_file_name, data in audio_data.items()]
+
+
+def make_section_stager(output_run_dir: str, bucket_name: str, folder_name: str,
+                        aws_credentials_block_name: str) -> SectionStager:
+    from prefect_aws import AwsCredentials
+
+    # Same journal as stage 4, which then finds the staged files already uploaded
+    aws_credentials = AwsCredentials.load(aws_credentials_block_name)
+    uploader = S3ObjectUploader(s3_client=aws_credentials.get_s3_client(),
+                                bucket_name=bucket_name,
+                                journal=UploadJournal(os.path.join(output_run_dir, JOURNAL_FILE_NAME)))
+    return SectionStager(uploader=uploader, folder_name=folder_name)
+
+
+@task(log_prints=True, name="Transcode audio renditions task", **cached(RUN_FILES_EXPIRATION, exclude=["max_workers"]))
+@instrument_task
+def transcode_audio_renditions(audio_guides: List[AudioGuide],
+                               rendition_profiles: List[str],
+                               max_workers: Optional[int] = None) -> List[AudioGuide]:
+    if not rendition_profiles:
+        return audio_guides
+
+    renditions = transcode_renditions(audio_file_paths=[ag.audio_url for ag in audio_guides],
+                                      profile_names=rendition_profiles,
+                                      max_workers=max_workers)
+
+    for ag in audio_guides:
+        ag.renditions = renditions[ag.audio_url]
+        original_size = os.path.getsize(ag.audio_url)
+        for rendition in ag.renditions:
+            print(
+                f"Created {rendition.profile} rendition at '{rendition.audio_url}': {rendition.size_bytes} bytes ({original_size} bytes original)")
+
+    return audio_guides
+
+
+@task(log_prints=True, name="Segment audio for HLS task", **cached(RUN_FILES_EXPIRATION, exclude=["max_workers"]))
+@instrument_task
+def segment_audio_for_hls(audio_guides: List[AudioGuide], segment_seconds: int,
+                          max_workers: Optional[int] = None) -> List[AudioGuide]:
+    playlists = segment_hls_playlists(audio_file_paths=[ag.audio_url for ag in audio_guides],
+                                      segment_seconds=segment_seconds,
+                                      max_workers=max_workers)
+
+    for ag in audio_guides:
+        ag.hls_playlist_url = playlists[ag.audio_url]
+        print(
+            f"Created HLS playlist at '{ag.hls_playlist_url}' ({segment_seconds}s segments)")
+
+    return audio_guides
+
+
+@task(log_prints=True, name="Make image derivatives task", **cached(RUN_FILES_EXPIRATION, exclude=["max_workers"]))
+@instrument_task
+def make_image_derivatives(images: List[str], output_dir: str, run_id: str,
+                           image_widths: List[int], max_workers: Optional[int] = None) -> List[ImageAsset]:
+    images_dir = os.path.join(output_dir, run_id, "images")
+    source_paths = fetch_images(urls=images, output_dir=images_dir)
+
+    assets = make_image_assets(source_paths={url: path for url, path in source_paths.items() if path},
+                               widths=image_widths,
+                               max_workers=max_workers)
+
+    image_assets = []
+    for url in images:
+        asset = assets.get(url)
+        if asset is None:
+            print(f"Skipped image '{url}'")
+            continue
+        image_assets.append(asset)
+        print(
+            f"Created {len(asset.variants)} variants of '{url}' ({asset.width}x{asset.height}): {sum(v.size_bytes for v in asset.variants)} bytes")
+
+    return image_assets
+
+
+@task(log_prints=True, name="Compose and save result task", **NOT_CACHED)
+@instrument_task
+def compose_place_data_and_save_result(place_data_silver: PlaceDataSilver, audio_guides: List[AudioGuide],
+                                       output_dir: str, run_id: str,
+                                       image_assets: Optional[List[ImageAsset]] = None) -> PlaceDataHandle[PlaceDataGold]:
+    output_run_dir = os.path.join(output_dir, run_id)
+    os.makedirs(output_run_dir, exist_ok=True)
+
+    # The silver fields are already validated, they are reused instead of validated again
+    place_data = PlaceDataGold.model_construct(
+        **dict(place_data_silver),
         audio_guides=audio_guides,
+        image_assets=image_assets or [],
     )
 
     output_file_path = os.path.join(output_run_dir, f"{place_data.name}.json")
-    with open(output_file_path, "w+") as file:
-        file.write(place_data.model_dump_json(indent=2))
+    handle = checkpoint_place_data(output_file_path, place_data)
 
-    print("Run result (PlaceDataGold):")
-    print(place_data.model_dump_json(indent=2))
-    print(f"Saved to {output_file_path}")
+    print("Run result (PlaceDataGold):", place_data)
+    print(f"Saving to {output_file_path}")
 
     create_link_artifact(
         key="s03-generate-audio-guides-output",
@@ -133,62 +257,149 @@ def compose_place_data_and_save_result(place_data_silver: PlaceDataSilver, audio
         description="Step 3 output"
     )
 
-    return output_file_path
+    return handle
 
 
-@flow(log_prints=True, name="Generate narration audio flow")
+# Tasks that don't depend on each other run in threads side by side, the CPU bound work inside
+# them (ffmpeg, image encoding) goes to process pools of `cpu_workers` processes
+@flow(log_prints=True, name="Generate narration audio flow", task_runner=ThreadPoolTaskRunner(max_workers=4))
 def generate_audio_guides_flow(place_data_path: str, output_dir: str,
-                               #    run_result_dir: str = None
-                               ):
+                               language: str = "vi",
+                               tts_backend_name: Optional[str] = None,
+                               voice: Optional[str] = None,
+                               fallback_tts_backend_name: Optional[str] = None,
+                               rendition_profiles: Optional[List[str]] = None,
+                               hls_segment_seconds: Optional[int] = None,
+                               image_widths: Optional[List[int]] = None,
+                               staging_bucket_name: Optional[str] = None,
+                               staging_folder_name: str = "audio-guides",
+                               aws_credentials_block_name: str = "localgaid-aws-credentials",
+                               force: bool = False,
+                               run_result_dir: Optional[str] = None,
+                               cpu_workers: Optional[int] = None,
+                               ) -> PlaceDataHandle[PlaceDataGold]:
     run_id = str(
         runtime.flow_run.root_flow_run_id) if runtime.flow_run.root_flow_run_id is not None else str(runtime.flow_run.id)
 
-    place_data = load_place_data(place_data_path)
+    # Handed over by the previous stage in the same process, read from its checkpoint on resume
+    place_data = handed_over_place_data(place_data_path, PlaceDataSilver) or load_place_data(place_data_path)
 
     sections = preprocess_script(place_data.script)
 
-    audio_data = generate_audio_files_and_subtitles(sections)
-
-    output_file_path = compose_place_data_and_save_result(place_data_silver=place_data,
-                                                          audio_data=audio_data,
+    if rendition_profiles is None:
+        rendition_profiles = DEFAULT_RENDITION_PROFILES
+
+    # Resolved here, so that the task cache key and the fingerprint name the backend and voice
+    # actually used rather than `None` and whatever LOCALGAID_TTS_BACKEND says at the time
+    tts_backend_name = resolve_tts_backend_name(language, tts_backend_name)
+    voice = resolve_voice(get_tts_backend(tts_backend_name), language, voice)
+
+    # Only what ends up in the audio guides, the crawled text and the staging target don't
+    fingerprints = FingerprintIndex(output_dir)
+    input_fingerprint = fingerprint([section.model_dump() for section in sections],
+                                    language,
+                                    tts_backend_name,
+                                    voice,
+                                    rendition_profiles,
+                                    hls_segment_seconds,
+                                    image_widths,
+                                    place_data.images if image_widths else None)
+    existing_output_path = None if force else fingerprints.lookup("s03", place_data.name, input_fingerprint)
+    if existing_output_path:
+        print(f"The sections and voice of '{place_data.name}' are unchanged, reusing the audio of {existing_output_path}")
+        existing_place_data = load_checkpoint(existing_output_path, PlaceDataGold).data
+        # The rest of the place (name, location, content) still comes from the current silver data
+        place_data_handle = compose_place_data_and_save_result(place_data_silver=place_data,
+                                                               audio_guides=existing_place_data.audio_guides,
+                                                               output_dir=output_dir,
+                                                               run_id=run_id,
+                                                               image_assets=existing_place_data.image_assets)
+        fingerprints.record_when_written("s03", place_data.name, input_fingerprint, place_data_handle)
+        return place_data_handle
+
+    if rendition_profiles or hls_segment_seconds:
+        # Fails before the sections are synthesized rather than after
+        ffmpeg_path()
+
+    # The images don't depend on the audio, they are fetched and resized while the sections are synthesized
+    image_assets_future = None
+    if image_widths and place_data.images:
+        image_assets_future = make_image_derivatives.submit(images=place_data.images,
+                                                            output_dir=output_dir,
+                                                            run_id=run_id,
+                                                            image_widths=image_widths,
+                                                            max_workers=cpu_workers)
+
+    stager = None
+    on_section = None
+    if staging_bucket_name:
+        # Pipelined mode: each section is saved and uploaded as soon as it is synthesized
+        output_run_dir = os.path.join(output_dir, run_id)
+        os.makedirs(output_run_dir, exist_ok=True)
+        stager = make_section_stager(output_run_dir=output_run_dir,
+                                     bucket_name=staging_bucket_name,
+                                     folder_name=staging_folder_name,
+                                     aws_credentials_block_name=aws_credentials_block_name)
+        staged_audio_guides = {}
+
+        def on_section(file_name: str, data: dict):
+            staged_audio_guides[file_name] = save_section_files(file_name, data, output_run_dir)
+            stager.stage(audio_guide_file_paths(staged_audio_guides[file_name]))
+
+    try:
+        audio_data = generate_audio_files_and_subtitles(sections,
+                                                        language=language,
+                                                        tts_backend_name=tts_backend_name,
+                                                        voice=voice,
+                                                        fallback_tts_backend_name=fallback_tts_backend_name,
+                                                        on_section=on_section)
+
+        if stager:
+            audio_guides = [staged_audio_guides[file_name] for file_name in audio_data]
+        else:
+            audio_guides = save_audio_files_and_subtitles(audio_data=audio_data,
                                                           output_dir=output_dir,
                                                           run_id=run_id)
 
-    return output_file_path
-
-    # return output_file_path, place_data.model_dump_json(), run_result_dir
+        audio_guides = transcode_audio_renditions(audio_guides=audio_guides,
+                                                  rendition_profiles=rendition_profiles,
+                                                  max_workers=cpu_workers)
 
+        if stager:
+            stager.stage([path for ag in audio_guides for path in audio_guide_file_paths(ag)])
+            results = stager.wait()
+            print(
+                f"Staged {len(results)} files ({sum(r.size_bytes for r in results.values())} bytes) to '{staging_bucket_name}'")
+    finally:
+        if stager:
+            stager.close()
 
-# @generate_audio_guides_flow.on_completion
-# def handle_on_completion(flw: Flow, run: FlowRun, state: State):
-#     end_time = str(datetime.now(timezone.utc))
+    if hls_segment_seconds:
+        audio_guides = segment_audio_for_hls(audio_guides=audio_guides,
+                                             segment_seconds=hls_segment_seconds,
+                                             max_workers=cpu_workers)
 
-#     output_file_path, place_data, run_result_dir = run.state.data.result
+    image_assets = image_assets_future.result() if image_assets_future else []
 
-#     run_id = str(
-#         runtime.flow_run.root_flow_run_id) if runtime.flow_run.root_flow_run_id is not None else str(runtime.flow_run.id)
+    place_data_handle = compose_place_data_and_save_result(place_data_silver=place_data,
+                                                           audio_guides=audio_guides,
+                                                           output_dir=output_dir,
+                                                           run_id=run_id,
+                                                           image_assets=image_assets)
+    fingerprints.record_when_written("s03", place_data.name, input_fingerprint, place_data_handle)
 
-#     cr_result = AudioRunResult(
-#         id=run_id,
-#         status=run.state.name,
-#         start_time=str(run.start_time),
-#         end_time=end_time,
-#         input_place_data=place_data,
-#         output=output_file_path
-#     )
+    return place_data_handle
 
-#     out_dir = os.path.join(run_result_dir, run_id)
-#     os.makedirs(out_dir, exist_ok=True)
 
-#     result_file_path = os.path.join(
-#         out_dir, f"audio_{run.start_time.strftime("%Y%m%d_%H%M%S")}__{run_id}.json")
-#     with open(result_file_path, "w+") as file:
-#         file.write(cr_result.model_dump_json(indent=2))
+@generate_audio_guides_flow.on_completion
+@generate_audio_guides_flow.on_failure
+def handle_on_completion(flw: Flow, run: FlowRun, state: State):
+    record_stage_run("s03", run, state)
 
 
 if __name__ == "__main__":
     generate_audio_guides_flow(
         place_data_path="/Users/quanbm/Dev/sides/localgaid_notebooks/run_data/data_silver/d87e4ee6-c5ff-41af-b351-c7f3b14577cb/Bạch Dinh.json",
         output_dir="/Users/quanbm/Dev/sides/localgaid_notebooks/run_data/data_gold",
-        # run_result_dir="/Users/quanbm/Dev/sides/localgaid_notebooks/run_data/run_results",
+        run_result_dir="/Users/quanbm/Dev/sides/localgaid_notebooks/run_data/run_results",
     )
@@ -1,23 +1,38 @@
 import os
 import io
 import time
+import hashlib
 from datetime import datetime, timezone
-from typing import List
+from typing import Dict, List, Optional
 from pydantic import BaseModel
 from pydantic_core import from_json
 
 from prefect import runtime, flow, task, Flow
 from prefect.client.schemas.objects import FlowRun
 from prefect.states import State
-from prefect_aws import AwsCredentials, S3Bucket
+from prefect.artifacts import create_progress_artifact, update_progress_artifact
+from prefect.task_runners import ThreadPoolTaskRunner
+from prefect_aws import AwsCredentials
 
-from supabase_block import SupabaseCredentials
-from supabase import create_client, Client
+from caching import LOCAL_COMPUTE_EXPIRATION, NOT_CACHED, cached
+from audio_processing import read_hls_segment_paths
+from catalog import CatalogPublisher
+from common_types import PlaceDataGold, AudioGuide, ImageAsset
+from dynamodb_writer import DynamoDBPlaceWriter
+from fingerprints import FingerprintIndex, fingerprint
+from handoff import checkpoint_place_data, handed_over_place_data, load_checkpoint
+from image_processing import default_variant
+from instrumentation import instrument_task
+from storage import S3ObjectUploader, UploadProgress, audio_guide_file_paths, content_folder_key, content_key, file_sha256
+from supabase_writer import SupabasePlaceWriter, get_supabase_client
+from telemetry import record_stage_run
+from upload_journal import UploadJournal, default_journal_path, DONE, FAILED, PENDING
 
-from common_types import PlaceDataGold, AudioGuide
+DATABASE_BACKENDS = ["supabase", "dynamodb"]
 
 
-@task(log_prints=True, name="Load place data (gold) task")
+@task(log_prints=True, name="Load place data (gold) task", **cached(LOCAL_COMPUTE_EXPIRATION))
+@instrument_task
 def load_place_data(place_data_path: str) -> PlaceDataGold:
     with open(place_data_path, "r") as file:
         place_data = PlaceDataGold.model_validate(
@@ -27,100 +42,360 @@ def load_place_data(place_data_path: str) -> PlaceDataGold:
     return place_data
 
 
-@task(log_prints=True, name="Upsert to database table task")
-def upsert_to_database_table_task(place_data: PlaceDataGold,
-                                  database_block_name: str = "supabase-localgaid-dev"):
-    credentials = SupabaseCredentials.load(database_block_name)
-
-    supabase: Client = create_client(
-        supabase_url=credentials.url, supabase_key=credentials.key.get_secret_value())
-
-    supabase.rpc(
-        "upsert_place", {
-            "p_name": place_data.name,
-            "p_tags": [],
-            "p_latitude": place_data.latitude,
-            "p_longitude": place_data.longitude,
-            "p_images": place_data.images
-        }).execute()
-
-    place = (
-        supabase.table("places")
-        .select("id")
-        .eq("name", place_data.name)
-        .single()
-        .execute()
-    )
-    print(
-        f"Upserted place '{place_data.name}'(ID={place.data["id"]}) into 'places' table.")
+@task(log_prints=True, name="Upsert to database table task", **NOT_CACHED)
+@instrument_task
+def upsert_places_to_database_task(places: List[PlaceDataGold],
+                                   database_block_name: str = "supabase-localgaid-dev",
+                                   batch_size: int = 50) -> Dict[str, str]:
+    writer = SupabasePlaceWriter(client=get_supabase_client(database_block_name),
+                                 batch_size=batch_size)
 
-    audio_guides = [ag.model_dump() for ag in place_data.audio_guides]
+    place_ids = writer.upsert_places(places)
 
-    print("Audio guides to be upsert:")
-    print(audio_guides)
+    for place_data in places:
+        print(
+            f"Upserted place '{place_data.name}'(ID={place_ids.get(place_data.name)}) with {len(place_data.audio_guides)} audio guides.")
+    return place_ids
 
-    supabase.rpc("update_audio_guides",
-                 {
-                     "p_place_id": place.data["id"],
-                     "audio_guides": audio_guides
-                 }).execute()
-    print(
-        f"Updated {len(audio_guides)} audio guides for '{place_data.name}'(ID={place.data["id"]}) into 'audio_guides' table.")
-    return
+
+@task(log_prints=True, name="Upsert to DynamoDB tables task", **NOT_CACHED)
+@instrument_task
+def upsert_places_to_dynamodb_task(places: List[PlaceDataGold],
+                                   aws_credentials_block_name: str = "localgaid-aws-credentials",
+                                   places_table_name: str = "localgaid-places",
+                                   audio_guides_table_name: str = "localgaid-audio-guides") -> Dict[str, str]:
+    aws_credentials = AwsCredentials.load(aws_credentials_block_name)
+    writer = DynamoDBPlaceWriter(client=aws_credentials.get_client("dynamodb"),
+                                 places_table_name=places_table_name,
+                                 audio_guides_table_name=audio_guides_table_name)
+
+    place_ids = writer.upsert_places(places)
+
+    for place_data in places:
+        print(
+            f"Upserted place '{place_data.name}'(ID={place_ids[place_data.name]}) with {len(place_data.audio_guides)} audio guides into '{places_table_name}'.")
+    return place_ids
 
 
-@task(log_prints=True, name="Put objects to storage task")
+@task(log_prints=True, name="Put objects to storage task", **NOT_CACHED)
+@instrument_task
 def put_objects_to_storage_task(audio_guides: List[AudioGuide], bucket_name: str,
                                 folder_name: str,
-                                aws_credentials_block_name: str = "localgaid-aws-credentials") -> List[AudioGuide]:
-    uploaded_audio_guides: List[AudioGuide] = []
-
+                                aws_credentials_block_name: str = "localgaid-aws-credentials",
+                                max_workers: int = 8,
+                                journal_path: Optional[str] = None) -> List[AudioGuide]:
     aws_credentials = AwsCredentials.load(aws_credentials_block_name)
-    s3_bucket = S3Bucket(
-        bucket_name=bucket_name,
-        credentials=aws_credentials
-    )
+    journal = UploadJournal(journal_path) if journal_path else None
+    uploader = S3ObjectUploader(s3_client=aws_credentials.get_s3_client(),
+                                bucket_name=bucket_name,
+                                max_workers=max_workers,
+                                journal=journal)
 
+    # Keys are derived from the file contents, unchanged files map to objects already in the bucket
+    sha256s = {}
+    keys = {}
+    playlist_paths = []
     for ag in audio_guides:
-        s3_audio_path = s3_bucket.upload_from_path(from_path=ag.audio_url,
-                                                   to_path=os.path.join(folder_name, ag.audio_url.rsplit("/", 1)[1]))
-        s3_subtitle_path = s3_bucket.upload_from_path(from_path=ag.subtitle_url,
-                                                      to_path=os.path.join(folder_name, ag.subtitle_url.rsplit("/", 1)[1]))
+        for path in audio_guide_file_paths(ag):
+            sha256s[path] = file_sha256(path)
+            keys[path] = content_key(folder_name, path, sha256s[path])
+
+        if ag.hls_playlist_url:
+            hls_paths = read_hls_segment_paths(
+                ag.hls_playlist_url) + [ag.hls_playlist_url]
+            for path in hls_paths:
+                sha256s[path] = file_sha256(path)
+            hls_folder_name = os.path.join(content_folder_key(folder_name, [sha256s[path] for path in hls_paths]),
+                                           os.path.basename(os.path.dirname(ag.hls_playlist_url)))
+            for path in hls_paths:
+                keys[path] = os.path.join(hls_folder_name,
+                                          os.path.basename(path))
+            playlist_paths.append(ag.hls_playlist_url)
+
+    progress_artifact_id = create_progress_artifact(
+        progress=0.0,
+        description="Indicates the bytes uploaded to the storage.")
+
+    def report_progress(progress: UploadProgress):
+        # Unchanged objects count as done, they are just not sent again
+        update_progress_artifact(artifact_id=progress_artifact_id,
+                                 progress=progress.done_bytes / progress.total_bytes * 100 if progress.total_bytes else 100.0)
+
+    # Segments go first so a published playlist never points at a missing segment
+    try:
+        results = uploader.upload_many([(path, key, sha256s[path]) for path, key in keys.items() if path not in playlist_paths],
+                                       on_progress=report_progress)
+        results.update(uploader.upload_many(
+            [(path, keys[path], sha256s[path]) for path in playlist_paths]))
+    finally:
+        if journal:
+            journal.close()
+    update_progress_artifact(
+        artifact_id=progress_artifact_id, progress=100.0)
 
+    uploaded = [r for r in results.values() if not r.skipped]
+    skipped = [r for r in results.values() if r.skipped]
+    print(
+        f"Uploaded {len(uploaded)} objects ({sum(r.size_bytes for r in uploaded)} bytes) to '{bucket_name}', "
+        f"skipped {len(skipped)} unchanged objects ({sum(r.size_bytes for r in skipped)} bytes).")
+
+    uploaded_audio_guides: List[AudioGuide] = []
+
+    for ag in audio_guides:
+        word_index_key = results[ag.word_index_url].key if ag.word_index_url else None
         uploaded_audio_guides.append(
             AudioGuide(
                 title=ag.title,
-                full_subtitle=ag.full_subtitle,
+                # The word index carries the full text, no need to inline it in the database row
+                full_subtitle=None if word_index_key else ag.full_subtitle,
                 duration_seconds=ag.duration_seconds,
-                audio_url=s3_audio_path,
-                subtitle_url=s3_subtitle_path
+                audio_url=results[ag.audio_url].key,
+                subtitle_url=results[ag.subtitle_url].key,
+                renditions=[rendition.model_copy(update={"audio_url": results[rendition.audio_url].key})
+                            for rendition in ag.renditions],
+                hls_playlist_url=results[ag.hls_playlist_url].key if ag.hls_playlist_url else None,
+                vtt_url=results[ag.vtt_url].key if ag.vtt_url else None,
+                word_index_url=word_index_key,
             )
         )
-        print(f"Uploaded audio to {s3_audio_path}")
-        print(f"Uploaded subititle to {s3_subtitle_path}")
+        print(f"Uploaded audio guide '{ag.title}' to {results[ag.audio_url].key}")
     return uploaded_audio_guides
 
 
-@flow(log_prints=True, name="Update production database flow")
+@task(log_prints=True, name="Put images to storage task", **NOT_CACHED)
+@instrument_task
+def put_images_to_storage_task(image_assets: List[ImageAsset], bucket_name: str,
+                               folder_name: str,
+                               aws_credentials_block_name: str = "localgaid-aws-credentials",
+                               max_workers: int = 8,
+                               journal_path: Optional[str] = None) -> List[ImageAsset]:
+    aws_credentials = AwsCredentials.load(aws_credentials_block_name)
+    journal = UploadJournal(journal_path) if journal_path else None
+    uploader = S3ObjectUploader(s3_client=aws_credentials.get_s3_client(),
+                                bucket_name=bucket_name,
+                                max_workers=max_workers,
+                                journal=journal)
+
+    uploads = []
+    for asset in image_assets:
+        for variant in asset.variants:
+            sha256 = file_sha256(variant.image_url)
+            uploads.append((variant.image_url, content_key(f"{folder_name}/images", variant.image_url, sha256), sha256))
+
+    try:
+        results = uploader.upload_many(uploads)
+    finally:
+        if journal:
+            journal.close()
+
+    uploaded = [r for r in results.values() if not r.skipped]
+    print(
+        f"Uploaded {len(uploaded)} image variants ({sum(r.size_bytes for r in uploaded)} bytes) to '{bucket_name}', "
+        f"skipped {len(results) - len(uploaded)} unchanged variants.")
+
+    return [asset.model_copy(update={"variants": [variant.model_copy(update={"image_url": results[variant.image_url].key})
+                                                  for variant in asset.variants]})
+            for asset in image_assets]
+
+
+@task(log_prints=True, name="Publish catalog manifests task", **NOT_CACHED)
+@instrument_task
+def publish_catalog_task(places: List[PlaceDataGold], city: str, bucket_name: str,
+                         aws_credentials_block_name: str = "localgaid-aws-credentials",
+                         folder_name: str = "catalog",
+                         asset_base_url: Optional[str] = None,
+                         removed_place_names: Optional[List[str]] = None) -> dict:
+    aws_credentials = AwsCredentials.load(aws_credentials_block_name)
+    publisher = CatalogPublisher(s3_client=aws_credentials.get_s3_client(),
+                                 bucket_name=bucket_name,
+                                 folder_name=folder_name)
+
+    pointer = publisher.publish(city=city, places=places,
+                                removed_place_names=removed_place_names,
+                                asset_base_url=asset_base_url)
+    print(
+        f"Published catalog of '{city}' version {pointer['catalog_version']} ({pointer['place_count']} places) to {pointer['city_manifest']}")
+    return pointer
+
+
+def write_places_to_database(places: List[PlaceDataGold], journal_paths: Dict[str, str],
+                             database_backend: str = "supabase",
+                             database_block_name: str = "supabase-localgaid-dev",
+                             aws_credentials_block_name: str = "localgaid-aws-credentials",
+                             places_table_name: str = "localgaid-places",
+                             audio_guides_table_name: str = "localgaid-audio-guides"):
+    if database_backend not in DATABASE_BACKENDS:
+        raise ValueError(
+            f"Unknown database backend '{database_backend}', available: {', '.join(DATABASE_BACKENDS)}")
+
+    journals = {place_data.name: UploadJournal(journal_paths[place_data.name])
+                for place_data in places}
+    try:
+        # The block, or the tables, written to: publishing to dev doesn't make prod up to date
+        if database_backend == "dynamodb":
+            target = f"{aws_credentials_block_name}/{places_table_name}/{audio_guides_table_name}"
+        else:
+            target = database_block_name
+
+        # Skip the places whose very same payload was already written by a previous run
+        payload_sha256s = {place_data.name: hashlib.sha256(place_data.model_dump_json().encode()).hexdigest()
+                           for place_data in places}
+        pending_places = []
+        for place_data in places:
+            if journals[place_data.name].database_write_done(place_data.name, database_backend, target,
+                                                             payload_sha256s[place_data.name]):
+                print(
+                    f"'{place_data.name}' is already up to date in {database_backend} ({target}), skipping.")
+            else:
+                pending_places.append(place_data)
+
+        if not pending_places:
+            return
+
+        def mark(state: str, error: Optional[str] = None):
+            for place_data in pending_places:
+                journals[place_data.name].mark_database_write(place_data.name, database_backend, target,
+                                                              payload_sha256s[place_data.name], state, error=error)
+
+        mark(PENDING)
+        try:
+            if database_backend == "dynamodb":
+                upsert_places_to_dynamodb_task(places=pending_places,
+                                               aws_credentials_block_name=aws_credentials_block_name,
+                                               places_table_name=places_table_name,
+                                               audio_guides_table_name=audio_guides_table_name)
+            else:
+                upsert_places_to_database_task(places=pending_places,
+                                               database_block_name=database_block_name)
+        except Exception as e:
+            mark(FAILED, error=str(e))
+            raise
+        mark(DONE)
+    finally:
+        for journal in journals.values():
+            journal.close()
+
+
+def local_object_paths(place_data: PlaceDataGold) -> List[str]:
+    paths = []
+    for ag in place_data.audio_guides:
+        paths += audio_guide_file_paths(ag)
+        if ag.hls_playlist_url:
+            paths += read_hls_segment_paths(ag.hls_playlist_url) + [ag.hls_playlist_url]
+    paths += [variant.image_url for asset in place_data.image_assets for variant in asset.variants]
+    return paths
+
+
+def publish_place(place_data: PlaceDataGold, journal_path: str,
+                  bucket_name: str,
+                  parent_folder_name: str,
+                  aws_credentials_block_name: str) -> PlaceDataGold:
+    # Audio and images go up side by side, on the threads of the flow's task runner
+    audio_guides_future = put_objects_to_storage_task.submit(audio_guides=place_data.audio_guides,
+                                                             bucket_name=bucket_name,
+                                                             folder_name=parent_folder_name,
+                                                             aws_credentials_block_name=aws_credentials_block_name,
+                                                             journal_path=journal_path)
+    image_assets_future = None
+    if place_data.image_assets:
+        image_assets_future = put_images_to_storage_task.submit(image_assets=place_data.image_assets,
+                                                                bucket_name=bucket_name,
+                                                                folder_name=parent_folder_name,
+                                                                aws_credentials_block_name=aws_credentials_block_name,
+                                                                journal_path=journal_path)
+
+    place_data.audio_guides = audio_guides_future.result()
+
+    if image_assets_future:
+        place_data.image_assets = image_assets_future.result()
+        # The app keeps reading `images`, now pointing at our copies instead of the original sites
+        place_data.images = [default_variant(asset).image_url
+                             for asset in place_data.image_assets]
+
+    return place_data
+
+
+def published_place_data_path(place_data_path: str) -> str:
+    return f"{place_data_path.rsplit('.', 1)[0]}.published.json"
+
+
+@flow(log_prints=True, name="Update production database flow", task_runner=ThreadPoolTaskRunner(max_workers=4))
 def update_production_database_flow(place_data_path: str,
                                     bucket_name: str = "localgaid-dev",
                                     parent_folder_name: str = "audio-guides",
                                     database_block_name: str = "supabase-localgaid-dev",
-                                    aws_credentials_block_name: str = "localgaid-aws-credentials"):
-    run_id = str(
-        runtime.flow_run.root_flow_run_id) if runtime.flow_run.root_flow_run_id is not None else str(runtime.flow_run.id)
+                                    aws_credentials_block_name: str = "localgaid-aws-credentials",
+                                    journal_path: Optional[str] = None,
+                                    database_backend: str = "supabase",
+                                    places_table_name: str = "localgaid-places",
+                                    audio_guides_table_name: str = "localgaid-audio-guides",
+                                    city: Optional[str] = None,
+                                    catalog_folder_name: str = "catalog",
+                                    asset_base_url: Optional[str] = None,
+                                    removed_place_names: Optional[List[str]] = None,
+                                    write_database: bool = True,
+                                    force: bool = False,
+                                    run_result_dir: Optional[str] = None) -> PlaceDataGold:
+    """Uploads the files of the place and writes it to the database.
+
+    A batch run passes `write_database=False` and writes all of its places at once with
+    `write_places_to_database` after the uploads.
+    """
+    if journal_path is None:
+        journal_path = default_journal_path(place_data_path)
+
+    # Handed over by the previous stage in the same process, read from its checkpoint on resume
+    place_data = handed_over_place_data(place_data_path, PlaceDataGold)
+    if place_data is None:
+        place_data = load_place_data(place_data_path=place_data_path)
+    else:
+        # The handed over object may still be written to its checkpoint, the keys go on a copy
+        place_data = place_data.model_copy()
 
-    place_data = load_place_data(place_data_path=place_data_path)
+    # The published objects and where they go, a place is uploaded again only when one changed
+    fingerprints = FingerprintIndex(os.path.dirname(os.path.dirname(place_data_path)))
+    input_fingerprint = fingerprint(place_data.model_dump(mode="json"),
+                                    {path: file_sha256(path) for path in local_object_paths(place_data)},
+                                    bucket_name,
+                                    parent_folder_name)
+    existing_output_path = None if force else fingerprints.lookup("s04", place_data.name, input_fingerprint)
+    if existing_output_path:
+        print(f"'{place_data.name}' is already published as {existing_output_path}, skipping the upload.")
+        place_data = load_checkpoint(existing_output_path, PlaceDataGold).data
+    else:
+        place_data = publish_place(place_data, journal_path,
+                                   bucket_name=bucket_name,
+                                   parent_folder_name=parent_folder_name,
+                                   aws_credentials_block_name=aws_credentials_block_name)
+        fingerprints.record_when_written("s04", place_data.name, input_fingerprint,
+                                         checkpoint_place_data(published_place_data_path(place_data_path), place_data))
 
-    uploaded_audio_guides = put_objects_to_storage_task(audio_guides=place_data.audio_guides,
-                                                        bucket_name=bucket_name,
-                                                        folder_name=f"{parent_folder_name}/{run_id}",
-                                                        aws_credentials_block_name=aws_credentials_block_name)
+    if write_database:
+        # The journal skips the write when the database already has this very place
+        write_places_to_database(places=[place_data],
+                                 journal_paths={place_data.name: journal_path},
+                                 database_backend=database_backend,
+                                 database_block_name=database_block_name,
+                                 aws_credentials_block_name=aws_credentials_block_name,
+                                 places_table_name=places_table_name,
+                                 audio_guides_table_name=audio_guides_table_name)
+
+    if city:
+        publish_catalog_task(places=[place_data],
+                             city=city,
+                             bucket_name=bucket_name,
+                             aws_credentials_block_name=aws_credentials_block_name,
+                             folder_name=catalog_folder_name,
+                             asset_base_url=asset_base_url,
+                             removed_place_names=removed_place_names)
+
+    return place_data
 
-    place_data.audio_guides = uploaded_audio_guides
 
-    upsert_to_database_table_task(place_data=place_data,
-                                  database_block_name=database_block_name)
+@update_production_database_flow.on_completion
+@update_production_database_flow.on_failure
+def handle_on_completion(flw: Flow, run: FlowRun, state: State):
+    record_stage_run("s04", run, state)
 
 
 if __name__ == "__main__":
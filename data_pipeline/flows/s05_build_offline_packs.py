@@ -0,0 +1,184 @@
+import os
+from typing import List, Optional, Tuple
+from pydantic_core import from_json
+
+from prefect import flow, task
+from prefect.artifacts import create_table_artifact
+from prefect_aws import AwsCredentials
+
+from caching import LOCAL_COMPUTE_EXPIRATION, NOT_CACHED, cached
+from catalog import MANIFEST_FORMAT_VERSION, CatalogPublisher, audio_guide_manifest, place_manifest, slugify
+from common_types import PlaceDataGold, AudioGuide
+from image_processing import default_variant
+from instrumentation import instrument_task
+from offline_pack import PackIndex, build_pack, write_json, write_pack_index
+from storage import S3ObjectUploader, content_key, file_sha256
+
+PACK_MANIFEST_PATH = "manifest.json"
+
+
+@task(log_prints=True, name="Load places data (gold) task", **cached(LOCAL_COMPUTE_EXPIRATION))
+@instrument_task
+def load_places_data(place_data_paths: List[str]) -> List[PlaceDataGold]:
+    places = []
+    for place_data_path in place_data_paths:
+        with open(place_data_path, "r") as file:
+            places.append(PlaceDataGold.model_validate(
+                from_json(file.read(), allow_partial=True)
+            ))
+    print(f"Loaded {len(places)} places (gold).")
+    return places
+
+
+def compact_audio_path(ag: AudioGuide) -> str:
+    # The smallest rendition, the original MP3 when no rendition was transcoded
+    renditions = [rendition for rendition in ag.renditions if os.path.exists(rendition.audio_url)]
+    if not renditions:
+        return ag.audio_url
+    return min(renditions, key=lambda rendition: rendition.size_bytes).audio_url
+
+
+def pack_audio_guide(ag: AudioGuide, folder: str) -> Tuple[dict, List[Tuple[str, str]]]:
+    files = []
+
+    def add(local_path: Optional[str]) -> Optional[str]:
+        if not local_path:
+            return None
+        pack_path = f"{folder}/{os.path.basename(local_path)}"
+        files.append((pack_path, local_path))
+        return pack_path
+
+    audio_path = compact_audio_path(ag)
+    packed = AudioGuide(
+        title=ag.title,
+        duration_seconds=ag.duration_seconds,
+        audio_url=add(audio_path),
+        subtitle_url=add(ag.subtitle_url),
+        vtt_url=add(ag.vtt_url),
+        word_index_url=add(ag.word_index_url),
+        renditions=[rendition.model_copy(update={"audio_url": f"{folder}/{os.path.basename(audio_path)}"})
+                    for rendition in ag.renditions if rendition.audio_url == audio_path],
+    )
+    return audio_guide_manifest(packed), files
+
+
+def pack_place(place_data: PlaceDataGold) -> Tuple[dict, List[Tuple[str, str]]]:
+    manifest = place_manifest(place_data)
+    folder = f"places/{manifest['slug']}"
+    files = []
+
+    audio_guides = []
+    for ag in place_data.audio_guides:
+        ag_manifest, ag_files = pack_audio_guide(ag, folder)
+        audio_guides.append(ag_manifest)
+        files += ag_files
+
+    # One resized variant per image is enough offline. Without derivatives the images aren't
+    # packed, the app keeps loading them from their remote URLs
+    images = place_data.images
+    if place_data.image_assets:
+        images = []
+        for asset in place_data.image_assets:
+            variant = default_variant(asset)
+            pack_path = f"{folder}/images/{os.path.basename(variant.image_url)}"
+            files.append((pack_path, variant.image_url))
+            images.append(pack_path)
+
+    return {**manifest, "images": images, "image_assets": [], "audio_guides": audio_guides}, files
+
+
+@task(log_prints=True, name="Build offline pack task", **NOT_CACHED)
+@instrument_task
+def build_offline_pack_task(places: List[PlaceDataGold], city: str, output_dir: str) -> Tuple[str, str, PackIndex]:
+    pack_folder = os.path.join(output_dir, slugify(city))
+
+    files = []
+    place_manifests = []
+    for place_data in places:
+        manifest, place_files = pack_place(place_data)
+        place_manifests.append(manifest)
+        files += place_files
+
+    manifest_path = write_json(os.path.join(pack_folder, PACK_MANIFEST_PATH), {
+        "format_version": MANIFEST_FORMAT_VERSION,
+        "city": city,
+        "places": sorted(place_manifests, key=lambda place: place["slug"]),
+    })
+    # The manifest goes first so the app can read it before the rest of the pack arrives
+    files.insert(0, (PACK_MANIFEST_PATH, manifest_path))
+
+    # The same file can be shared by several guides, it is stored once
+    files = list(dict(files).items())
+
+    pack_path, index = build_pack(slugify(city), files, pack_folder)
+    index_path = write_pack_index(pack_path, index)
+
+    create_table_artifact(
+        key=f"offline-pack-{slugify(city)}",
+        table=[{"path": entry.path, "size": entry.size, "offset": entry.offset} for entry in index.entries],
+        description=f"Files of the offline pack of {city}.",
+    )
+    print(
+        f"Built offline pack of '{city}' with {len(index.entries)} files ({index.pack_size} bytes) at {pack_path}")
+    return pack_path, index_path, index
+
+
+@task(log_prints=True, name="Publish offline pack task", **NOT_CACHED)
+@instrument_task
+def publish_offline_pack_task(pack_path: str, index_path: str, city: str, bucket_name: str,
+                              folder_name: str = "offline-packs",
+                              aws_credentials_block_name: str = "localgaid-aws-credentials",
+                              catalog_folder_name: Optional[str] = "catalog",
+                              asset_base_url: Optional[str] = None) -> str:
+    aws_credentials = AwsCredentials.load(aws_credentials_block_name)
+    s3_client = aws_credentials.get_s3_client()
+    uploader = S3ObjectUploader(s3_client=s3_client, bucket_name=bucket_name)
+
+    # The pack is already content-addressed, the index is keyed by its own hash
+    pack_key = f"{folder_name}/{slugify(city)}/{os.path.basename(pack_path)}"
+    index_sha256 = file_sha256(index_path)
+    index_key = content_key(f"{folder_name}/{slugify(city)}", index_path, index_sha256)
+    results = uploader.upload_many([(pack_path, pack_key, file_sha256(pack_path)),
+                                    (index_path, index_key, index_sha256)])
+    print(f"Published offline pack of '{city}' to {results[pack_path].key}, index at {results[index_path].key}")
+
+    if catalog_folder_name:
+        publisher = CatalogPublisher(s3_client=s3_client, bucket_name=bucket_name,
+                                     folder_name=catalog_folder_name)
+        publisher.attach_offline_pack(city, index_key, asset_base_url)
+    return index_key
+
+
+@flow(log_prints=True, name="Build offline packs flow")
+def build_offline_packs_flow(place_data_paths: List[str],
+                             city: str,
+                             output_dir: str = "run_data/offline_packs",
+                             bucket_name: Optional[str] = None,
+                             folder_name: str = "offline-packs",
+                             aws_credentials_block_name: str = "localgaid-aws-credentials",
+                             catalog_folder_name: Optional[str] = "catalog",
+                             asset_base_url: Optional[str] = None):
+    places = load_places_data(place_data_paths=place_data_paths)
+
+    pack_path, index_path, _ = build_offline_pack_task(places=places, city=city, output_dir=output_dir)
+
+    if bucket_name:
+        publish_offline_pack_task(pack_path=pack_path,
+                                  index_path=index_path,
+                                  city=city,
+                                  bucket_name=bucket_name,
+                                  folder_name=folder_name,
+                                  aws_credentials_block_name=aws_credentials_block_name,
+                                  catalog_folder_name=catalog_folder_name,
+                                  asset_base_url=asset_base_url)
+    return index_path
+
+
+if __name__ == "__main__":
+    build_offline_packs_flow(
+        place_data_paths=[
+            "/Users/quanbm/Dev/sides/localgaid_notebooks/run_data/data_gold/f759a403-1df2-4387-bf8e-da67a85c7a89/Dinh Ông Nam Hải.json",
+        ],
+        city="vungtau",
+        output_dir="run_data/offline_packs",
+    )
@@ -28,6 +28,14 @@ def create_places_table(dynamodb, table_name: str = "localgaid-places"):
                 {
                     'AttributeName': 'name',
                     'AttributeType': 'S'
+                },
+                {
+                    'AttributeName': 'geohash_cell',
+                    'AttributeType': 'S'
+                },
+                {
+                    'AttributeName': 'geohash',
+                    'AttributeType': 'S'
                 }
             ],
             GlobalSecondaryIndexes=[
@@ -41,8 +49,24 @@ def create_places_table(dynamodb, table_name: str = "localgaid-places"):
                     ],
                     'Projection': {
                         'ProjectionType': 'ALL'
-                    },
-                    'BillingMode': 'PAY_PER_REQUEST'
+                    }
+                },
+                {
+                    # Nearby queries: one partition per geohash cell, sorted by full geohash
+                    'IndexName': 'geohash-index',
+                    'KeySchema': [
+                        {
+                            'AttributeName': 'geohash_cell',
+                            'KeyType': 'HASH'
+                        },
+                        {
+                            'AttributeName': 'geohash',
+                            'KeyType': 'RANGE'
+                        }
+                    ],
+                    'Projection': {
+                        'ProjectionType': 'ALL'
+                    }
                 }
             ],
             BillingMode='PAY_PER_REQUEST'
@@ -94,8 +118,7 @@ def create_audio_guides_table(dynamodb, table_name: str = "localgaid-audio-guide
                     ],
                     'Projection': {
                         'ProjectionType': 'ALL'
-                    },
-                    'BillingMode': 'PAY_PER_REQUEST'
+                    }
                 }
             ],
             BillingMode='PAY_PER_REQUEST'
@@ -143,8 +166,8 @@ def setup_dynamodb_tables(aws_credentials_block_name: str = "localgaid-aws-crede
     print(f"Places table: {places_table_name}")
     print(f"Audio guides table: {audio_guides_table_name}")
     print("\nTable schemas:")
-    print(f"- {places_table_name}: id (PK), name, latitude, longitude, images, tags, updated_at")
-    print(f"- {audio_guides_table_name}: id (PK), place_id (GSI), title, full_subtitle, audio_url, duration_seconds, subtitle_url, created_at")
+    print(f"- {places_table_name}: id (PK), name, latitude, longitude, geohash_cell + geohash (GSI), images, tags, updated_at")
+    print(f"- {audio_guides_table_name}: id (PK), place_id (GSI), title, full_subtitle (absent with a word index), audio_url, duration_seconds, subtitle_url, renditions, hls_playlist_url, vtt_url, word_index_url, created_at")
     print("\nYou can now run your production database flow!")
 
 
@@ -0,0 +1,43 @@
+import threading
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List
+
+from storage import S3ObjectUploader, UploadResult, content_key, file_sha256
+
+
+class SectionStager:
+    """Uploads the files of each rendered section in the background while the next ones are synthesized.
+
+    Files go to the same content-addressed keys stage 4 uses, and are recorded in the uploader's
+    journal under the staging bucket. Nothing references them until stage 4 writes the database
+    rows and the catalog, so they stay staged until approval, which then only has metadata left
+    to write when it publishes to the same bucket; to another bucket it uploads them again.
+    """
+
+    def __init__(self, uploader: S3ObjectUploader, folder_name: str, max_workers: int = 4):
+        self.uploader = uploader
+        self.folder_name = folder_name
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.futures: Dict[str, Future] = {}
+        self.lock = threading.Lock()
+
+    def upload(self, local_path: str) -> UploadResult:
+        sha256 = file_sha256(local_path)
+        return self.uploader.upload(local_path, content_key(self.folder_name, local_path, sha256), sha256)
+
+    def stage(self, local_paths: List[str]):
+        with self.lock:
+            for local_path in local_paths:
+                if local_path not in self.futures:
+                    self.futures[local_path] = self.executor.submit(self.upload, local_path)
+
+    def wait(self) -> Dict[str, UploadResult]:
+        with self.lock:
+            futures = dict(self.futures)
+        return {local_path: future.result() for local_path, future in futures.items()}
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        if self.uploader.journal:
+            self.uploader.journal.close()
@@ -0,0 +1,191 @@
+import hashlib
+import mimetypes
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+from typing import Callable, Dict, List, Optional, Tuple
+from pydantic import BaseModel
+
+from common_types import AudioGuide
+from upload_journal import UploadJournal, DONE, FAILED, PENDING
+
+MB = 1024 * 1024
+
+CONTENT_TYPES = {
+    ".mp3": "audio/mpeg",
+    ".opus": "audio/ogg",
+    ".m4a": "audio/mp4",
+    ".m3u8": "application/vnd.apple.mpegurl",
+    ".ts": "video/mp2t",
+    ".srt": "application/x-subrip",
+    ".vtt": "text/vtt",
+    ".json": "application/json",
+    ".webp": "image/webp",
+    ".avif": "image/avif",
+}
+
+
+class UploadResult(BaseModel):
+    local_path: str
+    key: str
+    sha256: str
+    size_bytes: int
+    skipped: bool
+
+
+class UploadProgress:
+    """Bytes of one `upload_many` call, updated from its upload threads."""
+
+    def __init__(self, total_bytes: int):
+        self.total_bytes = total_bytes
+        self.uploaded_bytes = 0
+        # Already in the bucket, per the journal or the HEAD check
+        self.skipped_bytes = 0
+        self.lock = threading.Lock()
+
+    def add_uploaded_bytes(self, size: int):
+        with self.lock:
+            self.uploaded_bytes += size
+
+    def add_skipped_bytes(self, size: int):
+        with self.lock:
+            self.skipped_bytes += size
+
+    @property
+    def done_bytes(self) -> int:
+        return self.uploaded_bytes + self.skipped_bytes
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(MB), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def content_type(path: str) -> str:
+    _, extension = os.path.splitext(path)
+    if extension in CONTENT_TYPES:
+        return CONTENT_TYPES[extension]
+    return mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+
+def content_key(folder_name: str, local_path: str, sha256: str) -> str:
+    # The digest in the key makes the object immutable: same bytes, same key
+    return f"{folder_name}/{sha256[:16]}/{os.path.basename(local_path)}"
+
+
+def content_folder_key(folder_name: str, sha256s: List[str]) -> str:
+    # For files referencing each other by relative path (an HLS playlist and its segments)
+    digest = hashlib.sha256("".join(sorted(sha256s)).encode()).hexdigest()
+    return f"{folder_name}/{digest[:16]}"
+
+
+def audio_guide_file_paths(ag: AudioGuide) -> List[str]:
+    paths = [ag.audio_url, ag.subtitle_url]
+    paths += [path for path in (ag.vtt_url, ag.word_index_url) if path]
+    paths += [rendition.audio_url for rendition in ag.renditions]
+    return paths
+
+
+class S3ObjectUploader:
+    """Uploads local files to content-addressed keys in a thread pool.
+
+    Large files go through boto3's managed transfer (multipart above `multipart_threshold`).
+    An object already stored under the same key with the same sha256 metadata is skipped,
+    so is an object the journal records as done, without asking S3.
+    """
+
+    def __init__(self, s3_client, bucket_name: str, max_workers: int = 8,
+                 multipart_threshold: int = 8 * MB, multipart_chunksize: int = 8 * MB,
+                 journal: Optional[UploadJournal] = None):
+        from boto3.s3.transfer import TransferConfig
+
+        self.s3_client = s3_client
+        self.journal = journal
+        self.bucket_name = bucket_name
+        self.max_workers = max_workers
+        self.transfer_config = TransferConfig(multipart_threshold=multipart_threshold,
+                                              multipart_chunksize=multipart_chunksize,
+                                              max_concurrency=4)
+
+    def remote_sha256(self, key: str) -> Optional[str]:
+        from botocore.exceptions import ClientError
+
+        try:
+            head = self.s3_client.head_object(Bucket=self.bucket_name, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        return head.get("Metadata", {}).get("sha256")
+
+    def upload(self, local_path: str, key: str, sha256: Optional[str] = None,
+               progress: Optional[UploadProgress] = None) -> UploadResult:
+        sha256 = sha256 or file_sha256(local_path)
+        size = os.path.getsize(local_path)
+
+        if self.journal and self.journal.completed_key(self.bucket_name, local_path, sha256) == key:
+            if progress:
+                progress.add_skipped_bytes(size)
+            return UploadResult(local_path=local_path, key=key, sha256=sha256,
+                                size_bytes=size, skipped=True)
+
+        if self.remote_sha256(key) == sha256:
+            if self.journal:
+                self.journal.mark_object(self.bucket_name, local_path, sha256, key, size, DONE)
+            if progress:
+                progress.add_skipped_bytes(size)
+            return UploadResult(local_path=local_path, key=key, sha256=sha256,
+                                size_bytes=size, skipped=True)
+
+        if self.journal:
+            self.journal.mark_object(self.bucket_name, local_path, sha256, key, size, PENDING)
+        try:
+            self.s3_client.upload_file(local_path, self.bucket_name, key,
+                                       ExtraArgs={
+                                           "ContentType": content_type(local_path),
+                                           "Metadata": {"sha256": sha256},
+                                       },
+                                       Config=self.transfer_config,
+                                       Callback=progress.add_uploaded_bytes if progress else None)
+        except Exception as e:
+            if self.journal:
+                self.journal.mark_object(
+                    self.bucket_name, local_path, sha256, key, size, FAILED, error=str(e))
+            raise
+        if self.journal:
+            self.journal.mark_object(self.bucket_name, local_path, sha256, key, size, DONE)
+        return UploadResult(local_path=local_path, key=key, sha256=sha256,
+                            size_bytes=size, skipped=False)
+
+    def upload_many(self, uploads: List[Tuple[str, str, Optional[str]]],
+                    on_progress: Optional[Callable[[UploadProgress], None]] = None) -> Dict[str, UploadResult]:
+        """Uploads (local_path, key, sha256) triples, returns the results by local path.
+
+        `on_progress(progress)` is called from the calling thread, with the bytes of this call only.
+        """
+        progress = UploadProgress(total_bytes=sum(os.path.getsize(local_path)
+                                                  for local_path, _, _ in uploads))
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.upload, local_path, key, sha256, progress)
+                       for local_path, key, sha256 in uploads]
+            pending = set(futures)
+            try:
+                while pending:
+                    done, pending = wait(pending, timeout=1,
+                                         return_when=FIRST_EXCEPTION)
+                    for future in done:
+                        future.result()
+                    if on_progress:
+                        on_progress(progress)
+            except BaseException:
+                # Surface the first failure without starting the queued uploads, only the
+                # running ones are waited for
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise
+
+        return {future.result().local_path: future.result() for future in futures}
@@ -0,0 +1,82 @@
+import json
+
+from bisect import bisect_right
+from typing import List, Tuple
+from pydantic import BaseModel
+
+# Edge TTS reports offsets and durations in 100-nanosecond ticks, we keep the same unit
+TICKS_PER_MILLISECOND = 10_000
+
+WORD_INDEX_VERSION = 1
+
+
+class WordBoundary(BaseModel):
+    offset: int
+    duration: int
+    text: str
+
+
+def format_timestamp(ticks: int, decimal_separator: str) -> str:
+    milliseconds = ticks // TICKS_PER_MILLISECOND
+    hours, milliseconds = divmod(milliseconds, 3_600_000)
+    minutes, milliseconds = divmod(milliseconds, 60_000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}{decimal_separator}{milliseconds:03d}"
+
+
+def make_srt(word_boundaries: List[WordBoundary]) -> str:
+    # One cue per word, the same layout as edge_tts.SubMaker.get_srt()
+    cues = []
+    for i, wb in enumerate(word_boundaries):
+        start = format_timestamp(wb.offset, ",")
+        end = format_timestamp(wb.offset + wb.duration, ",")
+        cues.append(f"{i + 1}\n{start} --> {end}\n{wb.text}\n")
+    return "\n".join(cues)
+
+
+def make_vtt(word_boundaries: List[WordBoundary]) -> str:
+    cues = ["WEBVTT\n"]
+    for wb in word_boundaries:
+        start = format_timestamp(wb.offset, ".")
+        end = format_timestamp(wb.offset + wb.duration, ".")
+        cues.append(f"{start} --> {end}\n{wb.text}\n")
+    return "\n".join(cues)
+
+
+def make_word_index(word_boundaries: List[WordBoundary]) -> str:
+    """Delta-encoded word timings in milliseconds.
+
+    Start times are stored as differences to the previous start so the numbers stay small,
+    a client rebuilds the absolute starts with a running sum once and then binary searches them.
+    """
+    start_deltas = []
+    durations = []
+    previous_start = 0
+    for wb in word_boundaries:
+        start = wb.offset // TICKS_PER_MILLISECOND
+        start_deltas.append(start - previous_start)
+        durations.append(wb.duration // TICKS_PER_MILLISECOND)
+        previous_start = start
+
+    return json.dumps({
+        "version": WORD_INDEX_VERSION,
+        "unit": "ms",
+        "words": [wb.text for wb in word_boundaries],
+        "start_deltas": start_deltas,
+        "durations": durations,
+    }, ensure_ascii=False, separators=(",", ":"))
+
+
+def decode_word_index(word_index: str) -> Tuple[List[str], List[int], List[int]]:
+    data = json.loads(word_index)
+    starts = []
+    position = 0
+    for delta in data["start_deltas"]:
+        position += delta
+        starts.append(position)
+    return data["words"], starts, data["durations"]
+
+
+def find_word_at(starts: List[int], position_ms: int) -> int:
+    """Index of the word being spoken at the playback position, -1 before the first word."""
+    return bisect_right(starts, position_ms) - 1
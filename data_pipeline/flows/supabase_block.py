@@ -6,4 +6,6 @@ class SupabaseCredentials(Block):
     key: SecretStr
 
 
-SupabaseCredentials.register_type_and_schema()
\ No newline at end of file
+if __name__ == "__main__":
+    # Once per workspace, so the block can be created from the UI
+    SupabaseCredentials.register_type_and_schema()
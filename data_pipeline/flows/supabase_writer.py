@@ -0,0 +1,61 @@
+import threading
+
+from typing import TYPE_CHECKING, Dict, List
+
+from common_types import PlaceDataGold
+from supabase_block import SupabaseCredentials
+
+if TYPE_CHECKING:
+    from supabase import Client
+
+UPSERT_PLACES_RPC = "upsert_places_with_audio_guides"
+
+# One client per block and per worker process, shared by the tasks running in its threads
+_clients: Dict[str, "Client"] = {}
+_clients_lock = threading.Lock()
+
+
+def get_supabase_client(database_block_name: str) -> "Client":
+    from supabase import create_client
+
+    with _clients_lock:
+        if database_block_name not in _clients:
+            credentials = SupabaseCredentials.load(database_block_name)
+            _clients[database_block_name] = create_client(
+                supabase_url=credentials.url, supabase_key=credentials.key.get_secret_value())
+        return _clients[database_block_name]
+
+
+def place_payload(place_data: PlaceDataGold) -> dict:
+    return {
+        "name": place_data.name,
+        "tags": [],
+        "latitude": place_data.latitude,
+        "longitude": place_data.longitude,
+        "images": place_data.images,
+        "image_assets": [asset.model_dump() for asset in place_data.image_assets],
+        "audio_guides": [ag.model_dump() for ag in place_data.audio_guides],
+    }
+
+
+class SupabasePlaceWriter:
+    """Upserts places and their audio guides with one RPC call per batch.
+
+    `client` only needs `.rpc(name, params).execute()`, a postgrest client pointed at a local
+    PostgREST works as well as the Supabase one.
+    """
+
+    def __init__(self, client, batch_size: int = 50):
+        self.client = client
+        self.batch_size = batch_size
+
+    def upsert_places(self, places: List[PlaceDataGold]) -> Dict[str, str]:
+        place_ids = {}
+        for i in range(0, len(places), self.batch_size):
+            batch = places[i:i + self.batch_size]
+            response = self.client.rpc(UPSERT_PLACES_RPC, {
+                "p_places": [place_payload(place_data) for place_data in batch]
+            }).execute()
+            for row in response.data:
+                place_ids[row["name"]] = row["id"]
+        return place_ids
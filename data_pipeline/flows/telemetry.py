@@ -0,0 +1,226 @@
+import argparse
+import json
+import math
+import os
+import sqlite3
+import threading
+
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+from common_types import StageRunResult
+
+TELEMETRY_FILE_NAME = "telemetry.sqlite"
+
+_lock = threading.Lock()
+
+
+def default_telemetry_path(run_result_dir: str) -> str:
+    return os.path.join(run_result_dir, TELEMETRY_FILE_NAME)
+
+
+class TelemetryStore:
+    """Append-only SQLite table with one row per stage run."""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        # Several workers may append to the same file, wait for their writes instead of failing
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS stage_runs (
+                    id TEXT NOT NULL,
+                    flow_run_id TEXT PRIMARY KEY,
+                    stage TEXT NOT NULL,
+                    place TEXT,
+                    status TEXT,
+                    start_time TEXT,
+                    end_time TEXT,
+                    duration_seconds REAL,
+                    input TEXT,
+                    output TEXT,
+                    output_size_bytes INTEGER,
+                    counts TEXT NOT NULL
+                )""")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS stage_runs_stage_start_time ON stage_runs (stage, start_time)")
+
+    def append(self, result: StageRunResult):
+        with _lock, self.connection:
+            self.connection.execute("""
+                INSERT OR REPLACE INTO stage_runs (id, flow_run_id, stage, place, status, start_time, end_time,
+                                                   duration_seconds, input, output, output_size_bytes, counts)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                                    (result.id, result.flow_run_id, result.stage, result.place, result.status,
+                                     result.start_time, result.end_time, result.duration_seconds, result.input,
+                                     result.output, result.output_size_bytes, json.dumps(result.counts)))
+
+    def stage_runs(self, since: Optional[datetime] = None) -> List[StageRunResult]:
+        statement = "SELECT * FROM stage_runs"
+        parameters = ()
+        if since is not None:
+            statement += " WHERE start_time >= ?"
+            parameters = (since.isoformat(),)
+        cursor = self.connection.execute(statement + " ORDER BY start_time", parameters)
+        columns = [column[0] for column in cursor.description]
+        results = []
+        for row in cursor.fetchall():
+            values = dict(zip(columns, row))
+            values["counts"] = json.loads(values["counts"])
+            results.append(StageRunResult(**values))
+        return results
+
+    def close(self):
+        self.connection.close()
+
+
+def place_data_counts(place_data) -> Dict[str, float]:
+    counts = {}
+    if hasattr(place_data, "images"):
+        counts["images"] = len(place_data.images)
+    if hasattr(place_data, "content"):
+        counts["content_chars"] = len(place_data.content)
+    if hasattr(place_data, "script"):
+        counts["script_chars"] = len(place_data.script)
+    if hasattr(place_data, "audio_guides"):
+        counts["audio_guides"] = len(place_data.audio_guides)
+        counts["audio_seconds"] = sum(ag.duration_seconds for ag in place_data.audio_guides)
+    return counts
+
+
+def state_result(state):
+    # In memory the flow's return value is the state data itself, persisted it is wrapped in a record
+    data = state.data
+    return getattr(data, "result", data)
+
+
+def record_stage_run(stage: str, flow_run, state):
+    """Flow state hook body: appends a lean StageRunResult to `{run_result_dir}/telemetry.sqlite`.
+
+    Does nothing when the flow run has no `run_result_dir`, and never fails the run.
+    """
+    run_result_dir = flow_run.parameters.get("run_result_dir")
+    if not run_result_dir:
+        return
+
+    try:
+        from prefect import runtime
+
+        run_id = str(
+            runtime.flow_run.root_flow_run_id) if runtime.flow_run.root_flow_run_id is not None else str(flow_run.id)
+        end_time = datetime.now(timezone.utc)
+        start_time = flow_run.start_time or end_time
+        input_path = flow_run.parameters.get("place_data_path") or flow_run.parameters.get("config_file_path")
+
+        output = state_result(state) if state.is_completed() else None
+        place_data = getattr(output, "data", output)
+        output_path = getattr(output, "path", None)
+        if hasattr(output, "wait"):
+            output.wait()
+
+        result = StageRunResult(
+            id=run_id,
+            flow_run_id=str(flow_run.id),
+            stage=stage,
+            place=getattr(place_data, "name", None) or (os.path.basename(input_path).rsplit(".", 1)[0] if input_path else None),
+            status=state.name,
+            start_time=start_time.isoformat(),
+            end_time=end_time.isoformat(),
+            duration_seconds=(end_time - start_time).total_seconds(),
+            input=input_path,
+            output=output_path,
+            output_size_bytes=os.path.getsize(output_path) if output_path and os.path.exists(output_path) else None,
+            counts=place_data_counts(place_data) if place_data is not None else {},
+        )
+        store = TelemetryStore(default_telemetry_path(run_result_dir))
+        try:
+            store.append(result)
+        finally:
+            store.close()
+    except Exception as e:
+        print(f"Could not record the telemetry of {stage}: {e}")
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    # Nearest rank
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+
+def active_seconds(results: List[StageRunResult]) -> float:
+    """Wall-clock seconds during which at least one of the runs was going, overlaps counted once."""
+    intervals = sorted((datetime.fromisoformat(r.start_time), datetime.fromisoformat(r.end_time))
+                       for r in results if r.start_time and r.end_time)
+    seconds = 0.0
+    current_start, current_end = None, None
+    for start, end in intervals:
+        if current_end is None or start > current_end:
+            if current_end is not None:
+                seconds += (current_end - current_start).total_seconds()
+            current_start, current_end = start, end
+        else:
+            current_end = max(current_end, end)
+    if current_end is not None:
+        seconds += (current_end - current_start).total_seconds()
+    return seconds
+
+
+def report(store: TelemetryStore, days: int = 30, period: str = "day") -> List[dict]:
+    """p50/p95 latency and throughput per stage and per day or week."""
+    since = datetime.now(timezone.utc) - timedelta(days=days)
+    groups: Dict[tuple, List[StageRunResult]] = {}
+    for result in store.stage_runs(since):
+        started = datetime.fromisoformat(result.start_time)
+        key = started.strftime("%G-W%V") if period == "week" else started.strftime("%Y-%m-%d")
+        groups.setdefault((result.stage, key), []).append(result)
+
+    rows = []
+    for (stage, key), results in sorted(groups.items()):
+        completed = [r for r in results if r.status == "Completed" and r.duration_seconds is not None]
+        durations = [r.duration_seconds for r in completed]
+        # Concurrent runs share the wall clock, summing their durations would undercount throughput
+        busy_seconds = active_seconds(completed)
+        audio_seconds = sum(r.counts.get("audio_seconds", 0) for r in completed)
+        rows.append({
+            "stage": stage,
+            period: key,
+            "runs": len(results),
+            "failed": len(results) - len(completed),
+            "p50_s": percentile(durations, 0.50),
+            "p95_s": percentile(durations, 0.95),
+            "places_per_hour": len(completed) / busy_seconds * 3600 if busy_seconds else None,
+            "audio_s_per_s": audio_seconds / busy_seconds if busy_seconds and audio_seconds else None,
+        })
+    return rows
+
+
+def print_table(rows: List[dict]):
+    if not rows:
+        print("No stage runs recorded.")
+        return
+    columns = list(rows[0])
+
+    def cell(value) -> str:
+        if value is None:
+            return "-"
+        return f"{value:.2f}" if isinstance(value, float) else str(value)
+
+    widths = {c: max(len(c), *(len(cell(row[c])) for row in rows)) for c in columns}
+    print("  ".join(c.ljust(widths[c]) for c in columns))
+    for row in rows:
+        print("  ".join(cell(row[c]).ljust(widths[c]) for c in columns))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stage latency and throughput trends across runs.")
+    parser.add_argument("run_result_dir", help="Folder holding telemetry.sqlite")
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--period", choices=["day", "week"], default="day")
+    args = parser.parse_args()
+
+    telemetry_store = TelemetryStore(default_telemetry_path(args.run_result_dir))
+    print_table(report(telemetry_store, days=args.days, period=args.period))
+    telemetry_store.close()
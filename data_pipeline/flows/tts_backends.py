@@ -0,0 +1,151 @@
+import io
+import os
+
+from typing import Dict, List, Optional, Protocol
+from pydantic import BaseModel
+
+from rate_limiter import EDGE_TTS
+from subtitles import TICKS_PER_MILLISECOND, WordBoundary, make_srt
+
+
+class SynthesisResult(BaseModel):
+    audio: bytes
+    subtitle: str
+    word_boundaries: List[WordBoundary]
+
+
+class TTSBackend(Protocol):
+    name: str
+    # Rate limit every synthesis acquires from, to stay under the remote service quota
+    rate_limit: Optional[str]
+    voices: Dict[str, str]
+
+    def synthesize(self, text: str, voice: str) -> SynthesisResult:
+        ...
+
+
+class EdgeTTSBackend:
+    name = "edge"
+    rate_limit = EDGE_TTS
+    voices = {
+        "vi": "vi-VN-NamMinhNeural",
+        "en": "en-US-AndrewNeural",
+    }
+
+    def synthesize(self, text: str, voice: str) -> SynthesisResult:
+        import edge_tts
+
+        communicate = edge_tts.Communicate(text, voice)
+        submaker = edge_tts.SubMaker()
+
+        audio_file = io.BytesIO()
+        word_boundaries = []
+
+        for chunk in communicate.stream_sync():
+            if chunk["type"] == "audio":
+                audio_file.write(chunk["data"])
+            elif chunk["type"] == "WordBoundary":
+                submaker.feed(chunk)
+                word_boundaries.append(WordBoundary(offset=chunk["offset"],
+                                                    duration=chunk["duration"],
+                                                    text=chunk["text"]))
+
+        return SynthesisResult(
+            audio=audio_file.getvalue(),
+            subtitle=submaker.get_srt(),
+            word_boundaries=word_boundaries,
+        )
+
+
+class FakeTTSBackend:
+    """Offline backend producing silent MP3 frames with deterministic word timings.
+
+    The frames use the same format edge-tts returns (MPEG-2 Layer III, 24 kHz, 48 kbps, mono),
+    so the output can be read by mutagen and any later audio stage exactly like the real files.
+    """
+    name = "fake"
+    rate_limit = None
+    voices = {
+        "vi": "fake-vi",
+        "en": "fake-en",
+    }
+
+    frame_header = b"\xff\xf3\x64\xc4"
+    frame_size_bytes = 144
+    frame_duration_ms = 24
+
+    leading_silence_ms = 100
+    word_gap_ms = 50
+
+    def word_duration_ms(self, word: str) -> int:
+        return 150 + 50 * len(word)
+
+    def synthesize(self, text: str, voice: str) -> SynthesisResult:
+        word_boundaries = []
+        position_ms = self.leading_silence_ms
+        for word in text.split():
+            duration_ms = self.word_duration_ms(word)
+            word_boundaries.append(WordBoundary(offset=position_ms * TICKS_PER_MILLISECOND,
+                                                duration=duration_ms * TICKS_PER_MILLISECOND,
+                                                text=word))
+            position_ms += duration_ms + self.word_gap_ms
+
+        frame_count = -(-position_ms // self.frame_duration_ms)
+        frame = self.frame_header + \
+            bytes(self.frame_size_bytes - len(self.frame_header))
+
+        return SynthesisResult(
+            audio=frame * frame_count,
+            subtitle=make_srt(word_boundaries),
+            word_boundaries=word_boundaries,
+        )
+
+
+TTS_BACKENDS = {
+    EdgeTTSBackend.name: EdgeTTSBackend,
+    FakeTTSBackend.name: FakeTTSBackend,
+}
+
+DEFAULT_TTS_BACKEND = EdgeTTSBackend.name
+
+
+def parse_backend_setting(setting: str) -> Dict[str, str]:
+    # Either a single backend name ("fake") or per language pairs ("vi=edge,en=fake")
+    if "=" not in setting:
+        return {"*": setting.strip()}
+    by_language = {}
+    for pair in setting.split(","):
+        language, backend_name = pair.split("=", 1)
+        by_language[language.strip()] = backend_name.strip()
+    return by_language
+
+
+def resolve_tts_backend_name(language: str, backend_name: Optional[str] = None) -> str:
+    if backend_name:
+        return backend_name
+
+    setting = os.environ.get("LOCALGAID_TTS_BACKEND")
+    if setting:
+        by_language = parse_backend_setting(setting)
+        if language in by_language:
+            return by_language[language]
+        if "*" in by_language:
+            return by_language["*"]
+
+    return DEFAULT_TTS_BACKEND
+
+
+def get_tts_backend(name: str) -> TTSBackend:
+    if name not in TTS_BACKENDS:
+        raise ValueError(
+            f"Unknown TTS backend '{name}', available: {', '.join(TTS_BACKENDS)}")
+    return TTS_BACKENDS[name]()
+
+
+def resolve_voice(backend: TTSBackend, language: str, voice: Optional[str] = None) -> str:
+    if voice:
+        return voice
+    if language not in backend.voices:
+        raise ValueError(
+            f"TTS backend '{backend.name}' has no voice for language '{language}'")
+    return backend.voices[language]
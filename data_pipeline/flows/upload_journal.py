@@ -0,0 +1,108 @@
+import os
+import sqlite3
+import threading
+
+from datetime import datetime, timezone
+from typing import Optional
+
+JOURNAL_FILE_NAME = "upload_journal.sqlite"
+# Journals written before the entries named their target are dropped, they can't say where a file went
+SCHEMA_VERSION = 2
+
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+
+
+def default_journal_path(place_data_path: str) -> str:
+    # One journal per gold run directory, next to the files it tracks
+    return os.path.join(os.path.dirname(place_data_path), JOURNAL_FILE_NAME)
+
+
+class UploadJournal:
+    """Local record of what stage 4 already published.
+
+    Objects are tracked by (bucket, local path, sha256) so a file changed since the last run, or
+    published to another bucket, is uploaded again. Database writes are tracked by place name,
+    backend and target (the block or tables written to), with a hash of the written payload.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        # The audio and image uploads of a place write to the same journal from two connections
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.connection:
+            if self.connection.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+                self.connection.execute("DROP TABLE IF EXISTS objects")
+                self.connection.execute("DROP TABLE IF EXISTS database_writes")
+                self.connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS objects (
+                    bucket_name TEXT NOT NULL,
+                    local_path TEXT NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    size_bytes INTEGER NOT NULL,
+                    state TEXT NOT NULL,
+                    error TEXT,
+                    updated_at TEXT NOT NULL,
+                    PRIMARY KEY (bucket_name, local_path, sha256)
+                )""")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS database_writes (
+                    place_name TEXT NOT NULL,
+                    backend TEXT NOT NULL,
+                    target TEXT NOT NULL,
+                    payload_sha256 TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    error TEXT,
+                    updated_at TEXT NOT NULL,
+                    PRIMARY KEY (place_name, backend, target)
+                )""")
+
+    def execute(self, statement: str, parameters: tuple):
+        with self.lock, self.connection:
+            return self.connection.execute(statement, parameters).fetchone()
+
+    def completed_key(self, bucket_name: str, local_path: str, sha256: str) -> Optional[str]:
+        row = self.execute("""
+            SELECT key FROM objects WHERE bucket_name = ? AND local_path = ? AND sha256 = ? AND state = ?""",
+                           (bucket_name, local_path, sha256, DONE))
+        return row[0] if row else None
+
+    def mark_object(self, bucket_name: str, local_path: str, sha256: str, key: str, size_bytes: int,
+                    state: str, error: Optional[str] = None):
+        self.execute("""
+            INSERT INTO objects (bucket_name, local_path, sha256, key, size_bytes, state, error, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (bucket_name, local_path, sha256) DO UPDATE SET
+                key = excluded.key, size_bytes = excluded.size_bytes, state = excluded.state,
+                error = excluded.error, updated_at = excluded.updated_at""",
+                     (bucket_name, local_path, sha256, key, size_bytes, state, error,
+                      str(datetime.now(timezone.utc))))
+
+    def database_write_done(self, place_name: str, backend: str, target: str, payload_sha256: str) -> bool:
+        row = self.execute("""
+            SELECT payload_sha256, state FROM database_writes WHERE place_name = ? AND backend = ? AND target = ?""",
+                           (place_name, backend, target))
+        return row is not None and row[0] == payload_sha256 and row[1] == DONE
+
+    def mark_database_write(self, place_name: str, backend: str, target: str, payload_sha256: str,
+                            state: str, error: Optional[str] = None):
+        self.execute("""
+            INSERT INTO database_writes (place_name, backend, target, payload_sha256, state, error, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (place_name, backend, target) DO UPDATE SET
+                payload_sha256 = excluded.payload_sha256, state = excluded.state,
+                error = excluded.error, updated_at = excluded.updated_at""",
+                     (place_name, backend, target, payload_sha256, state, error, str(datetime.now(timezone.utc))))
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,27 @@
+-- Spatial index on `places` and a nearby lookup for the app, so it can fetch the places around
+-- the user instead of the whole catalog. Requires the PostGIS extension.
+create extension if not exists postgis;
+
+-- Derived from the latitude/longitude written by `upsert_place`, no pipeline change needed
+alter table public.places
+    add column if not exists location geography(Point, 4326)
+    generated always as (st_setsrid(st_makepoint(longitude, latitude), 4326)::geography) stored;
+
+create index if not exists places_location_idx on public.places using gist (location);
+
+-- Places within `p_radius_m` meters of the point, nearest first
+create or replace function public.places_nearby(p_latitude double precision,
+                                                p_longitude double precision,
+                                                p_radius_m double precision,
+                                                p_limit integer default 50)
+returns table (place jsonb, distance_m double precision)
+language sql
+stable
+as $$
+    select to_jsonb(p) - 'location' as place,
+           st_distance(p.location, st_setsrid(st_makepoint(p_longitude, p_latitude), 4326)::geography) as distance_m
+    from public.places p
+    where st_dwithin(p.location, st_setsrid(st_makepoint(p_longitude, p_latitude), 4326)::geography, p_radius_m)
+    order by p.location <-> st_setsrid(st_makepoint(p_longitude, p_latitude), 4326)::geography
+    limit p_limit;
+$$;
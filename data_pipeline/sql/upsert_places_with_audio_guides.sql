@@ -0,0 +1,66 @@
+-- Batched version of the `upsert_place` + `update_audio_guides` RPCs used by stage 4.
+-- Upserts every place of `p_places` with its audio guides in one request and returns the
+-- place IDs, so the pipeline no longer has to look them up by name.
+--
+-- p_places: [{"name", "tags", "latitude", "longitude", "images", "image_assets", "audio_guides": [...]}, ...]
+--           audio guides: {"title", "full_subtitle", "audio_url", "duration_seconds", "subtitle_url",
+--                          "renditions", "hls_playlist_url", "vtt_url", "word_index_url"}
+-- returns:  [{"name", "id"}, ...]
+
+-- Resized image variants with their widths, `images` keeps one URL per image
+alter table public.places add column if not exists image_assets jsonb not null default '[]'::jsonb;
+
+-- The audio files next to the MP3 and SRT: compact renditions, HLS playlist, WebVTT and word
+-- timings. With a word index the full subtitle is no longer stored, the app reads the index.
+alter table public.audio_guides add column if not exists renditions jsonb not null default '[]'::jsonb;
+alter table public.audio_guides add column if not exists hls_playlist_url text;
+alter table public.audio_guides add column if not exists vtt_url text;
+alter table public.audio_guides add column if not exists word_index_url text;
+alter table public.audio_guides alter column full_subtitle drop not null;
+
+create or replace function public.upsert_places_with_audio_guides(p_places jsonb)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_place jsonb;
+    v_place_id places.id%type;
+    v_result jsonb := '[]'::jsonb;
+begin
+    for v_place in select * from jsonb_array_elements(p_places)
+    loop
+        perform public.upsert_place(
+            p_name := v_place->>'name',
+            p_tags := array(select jsonb_array_elements_text(coalesce(v_place->'tags', '[]'::jsonb))),
+            p_latitude := (v_place->>'latitude')::double precision,
+            p_longitude := (v_place->>'longitude')::double precision,
+            p_images := array(select jsonb_array_elements_text(coalesce(v_place->'images', '[]'::jsonb)))
+        );
+
+        update public.places
+        set image_assets = coalesce(v_place->'image_assets', '[]'::jsonb)
+        where name = v_place->>'name'
+        returning id into v_place_id;
+
+        perform public.update_audio_guides(
+            p_place_id := v_place_id,
+            audio_guides := coalesce(v_place->'audio_guides', '[]'::jsonb)
+        );
+
+        -- `update_audio_guides` only knows the original columns, the new ones are set on the rows it
+        -- wrote, matched by their content-addressed audio key
+        update public.audio_guides ag
+        set renditions = coalesce(g->'renditions', '[]'::jsonb),
+            hls_playlist_url = g->>'hls_playlist_url',
+            vtt_url = g->>'vtt_url',
+            word_index_url = g->>'word_index_url'
+        from jsonb_array_elements(coalesce(v_place->'audio_guides', '[]'::jsonb)) g
+        where ag.place_id = v_place_id
+          and ag.audio_url = g->>'audio_url';
+
+        v_result := v_result || jsonb_build_object('name', v_place->>'name', 'id', v_place_id);
+    end loop;
+
+    return v_result;
+end;
+$$;
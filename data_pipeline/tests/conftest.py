@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_PIPELINE_DIR = os.path.dirname(TESTS_DIR)
+FLOWS_DIR = os.path.join(DATA_PIPELINE_DIR, "flows")
+BENCHMARKS_DIR = os.path.join(DATA_PIPELINE_DIR, "benchmarks")
+
+# The flow modules import each other by file name
+sys.path[:0] = [FLOWS_DIR, BENCHMARKS_DIR]
+
+
+@pytest.fixture(scope="session")
+def prefect_harness():
+    # Tasks called outside of a flow still report to an API, a temporary one for the session
+    from prefect.testing.utilities import prefect_test_harness
+
+    with prefect_test_harness():
+        yield
@@ -0,0 +1,84 @@
+import gzip
+import json
+
+import boto3
+import pytest
+
+from moto import mock_aws
+
+from catalog import CatalogPublisher
+from common_types import AudioGuide, PlaceDataGold
+
+BUCKET_NAME = "localgaid-test"
+CITY = "Vũng Tàu"
+
+
+def make_place(name: str, title: str = "Giới thiệu") -> PlaceDataGold:
+    return PlaceDataGold(name=name, latitude=10.35, longitude=107.08, content="", images=[], script="",
+                         audio_guides=[AudioGuide(title=title, audio_url=f"audio/{name}.mp3",
+                                                  duration_seconds=60, subtitle_url=f"audio/{name}.srt")])
+
+
+@pytest.fixture
+def publisher():
+    with mock_aws():
+        s3_client = boto3.client("s3", region_name="us-east-1")
+        s3_client.create_bucket(Bucket=BUCKET_NAME)
+        yield CatalogPublisher(s3_client=s3_client, bucket_name=BUCKET_NAME)
+
+
+def read_delta(publisher: CatalogPublisher, pointer: dict, version: int) -> dict:
+    key = f"{publisher.city_folder(CITY)}/deltas/{pointer['deltas'][str(version)]}"
+    body = publisher.s3_client.get_object(Bucket=BUCKET_NAME, Key=key)["Body"].read()
+    return json.loads(gzip.decompress(body))
+
+
+def test_publish_after_a_crash_between_the_delta_and_the_pointer(publisher, monkeypatch):
+    publisher.publish(CITY, [make_place("Bạch Dinh")])
+
+    def crash(*args, **kwargs):
+        raise RuntimeError("worker lost")
+
+    # The delta of version 2 is written, latest.json never points at it
+    with monkeypatch.context() as patch:
+        patch.setattr(publisher, "write_pointer", crash)
+        with pytest.raises(RuntimeError):
+            publisher.publish(CITY, [make_place("Tượng Chúa Kitô")])
+
+    pointer = publisher.publish(CITY, [make_place("Hải đăng Vũng Tàu")])
+
+    assert pointer["catalog_version"] == 2
+    assert [place["name"] for place in read_delta(publisher, pointer, 2)["places"]["added"]] == ["Hải đăng Vũng Tàu"]
+
+
+def test_publish_retries_after_a_concurrent_publish(publisher, monkeypatch):
+    publisher.publish(CITY, [make_place("Bạch Dinh")])
+    write_pointer = publisher.write_pointer
+
+    def publish_concurrently_first(city, pointer, previous_etag):
+        # Another publisher moves latest.json between our read and our write
+        monkeypatch.setattr(publisher, "write_pointer", write_pointer)
+        CatalogPublisher(s3_client=publisher.s3_client, bucket_name=BUCKET_NAME).publish(
+            CITY, [make_place("Tượng Chúa Kitô")])
+        write_pointer(city, pointer, previous_etag)
+
+    monkeypatch.setattr(publisher, "write_pointer", publish_concurrently_first)
+    monkeypatch.setattr("catalog.time.sleep", lambda seconds: None)
+    pointer = publisher.publish(CITY, [make_place("Hải đăng Vũng Tàu")])
+
+    assert pointer["catalog_version"] == 3
+    assert pointer["place_count"] == 3
+    assert sorted(pointer["deltas"]) == ["1", "2", "3"]
+
+
+def test_old_deltas_are_pruned_outside_the_window(publisher):
+    publisher.snapshot_interval = 4
+    publisher.delta_window = 6
+    for version in range(1, 13):
+        pointer = publisher.publish(CITY, [make_place("Bạch Dinh", title=f"Phần {version}")])
+
+    assert pointer["min_delta_version"] == 12 - 6
+    assert sorted(map(int, pointer["deltas"])) == list(range(7, 13))
+    stored = publisher.s3_client.list_objects_v2(Bucket=BUCKET_NAME,
+                                                 Prefix=f"{publisher.city_folder(CITY)}/deltas/")["Contents"]
+    assert sorted(item["Key"].rsplit("/", 1)[-1] for item in stored) == sorted(pointer["deltas"].values())
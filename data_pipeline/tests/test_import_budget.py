@@ -0,0 +1,11 @@
+import pytest
+
+from import_budget import BUDGETS, measure
+
+
+@pytest.mark.parametrize("module", BUDGETS)
+def test_entry_point_does_not_load_stage_dependencies(module):
+    # In a fresh interpreter, the test session has most of them loaded already
+    _, forbidden = BUDGETS[module]
+    loaded = sorted(set(forbidden) & set(measure(module)["packages"]))
+    assert not loaded, f"importing {module} loads {', '.join(loaded)}"
@@ -0,0 +1,56 @@
+from types import SimpleNamespace
+
+import pytest
+
+import s04_update_production_database
+from common_types import AudioGuide, PlaceDataGold
+from s04_update_production_database import write_places_to_database
+
+
+class FakeSupabaseClient:
+    def __init__(self):
+        self.calls = []
+
+    def rpc(self, name: str, params: dict):
+        self.calls.append((name, params))
+        rows = [{"name": place["name"], "id": f"id-{place['name']}"} for place in params["p_places"]]
+        return SimpleNamespace(execute=lambda: SimpleNamespace(data=rows))
+
+
+def make_place(name: str) -> PlaceDataGold:
+    return PlaceDataGold(name=name, latitude=10.35, longitude=107.08, content="", images=[], script="",
+                         audio_guides=[AudioGuide(title="Giới thiệu", audio_url=f"audio/{name}.mp3",
+                                                  duration_seconds=60, subtitle_url=f"audio/{name}.srt")])
+
+
+@pytest.fixture
+def client(monkeypatch, prefect_harness):
+    client = FakeSupabaseClient()
+    monkeypatch.setattr(s04_update_production_database, "get_supabase_client", lambda block_name: client)
+    return client
+
+
+def test_a_batch_of_places_is_written_with_one_rpc_call(client, tmp_path):
+    places = [make_place(f"Place {i}") for i in range(5)]
+    # One gold folder, and journal, per place as in a batch run
+    journal_paths = {}
+    for i, place in enumerate(places):
+        (tmp_path / str(i)).mkdir()
+        journal_paths[place.name] = str(tmp_path / str(i) / "upload_journal.sqlite")
+
+    write_places_to_database(places=places, journal_paths=journal_paths)
+
+    assert len(client.calls) == 1
+    assert [place["name"] for place in client.calls[0][1]["p_places"]] == [place.name for place in places]
+
+
+def test_places_already_written_are_skipped(client, tmp_path):
+    places = [make_place("Bạch Dinh"), make_place("Tượng Chúa Kitô")]
+    journal_paths = {place.name: str(tmp_path / "upload_journal.sqlite") for place in places}
+    write_places_to_database(places=places, journal_paths=journal_paths)
+
+    places[1].audio_guides[0].duration_seconds = 90
+    write_places_to_database(places=places, journal_paths=journal_paths)
+
+    assert len(client.calls) == 2
+    assert [place["name"] for place in client.calls[1][1]["p_places"]] == ["Tượng Chúa Kitô"]
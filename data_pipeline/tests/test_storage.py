@@ -0,0 +1,53 @@
+import boto3
+import pytest
+
+from moto import mock_aws
+
+from storage import S3ObjectUploader
+
+BUCKET_NAME = "localgaid-test"
+
+
+@pytest.fixture
+def s3_client():
+    with mock_aws():
+        s3_client = boto3.client("s3", region_name="us-east-1")
+        s3_client.create_bucket(Bucket=BUCKET_NAME)
+        yield s3_client
+
+
+def test_upload_many_stops_at_the_first_failure(s3_client, tmp_path, monkeypatch):
+    uploader = S3ObjectUploader(s3_client=s3_client, bucket_name=BUCKET_NAME, max_workers=1)
+    uploads = []
+    for i in range(5):
+        path = tmp_path / f"{i}.mp3"
+        path.write_bytes(bytes([i]) * 1024)
+        uploads.append((str(path), f"audio/{i}.mp3", None))
+    started = []
+
+    def fail(local_path, key, sha256=None, progress=None):
+        started.append(key)
+        raise ConnectionError("connection reset")
+
+    monkeypatch.setattr(uploader, "upload", fail)
+    with pytest.raises(ConnectionError):
+        uploader.upload_many(uploads)
+
+    # The uploads queued behind the failed one never start, but for the one the worker may
+    # have taken before the failure reached the calling thread
+    assert started[0] == "audio/0.mp3"
+    assert len(started) <= 2
+
+
+def test_upload_many_skips_stored_objects(s3_client, tmp_path):
+    uploader = S3ObjectUploader(s3_client=s3_client, bucket_name=BUCKET_NAME)
+    path = tmp_path / "intro.mp3"
+    path.write_bytes(b"\x00" * 1024)
+    reports = []
+
+    first = uploader.upload_many([(str(path), "audio/intro.mp3", None)])
+    second = uploader.upload_many([(str(path), "audio/intro.mp3", None)], on_progress=reports.append)
+
+    assert not first[str(path)].skipped
+    assert second[str(path)].skipped
+    assert reports[-1].skipped_bytes == reports[-1].total_bytes == 1024